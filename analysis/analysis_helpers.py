@@ -1,5 +1,8 @@
+import os
+import hashlib
 import numpy as np
 from itertools import groupby
+from functools import lru_cache
 import numpy as np
 import scipy.stats as stats
 import pandas as pd
@@ -26,6 +29,19 @@ MODEL_COLS = [
 DATASET_ABSTRACTION_COLS = ['Encoder Training Dataset',
     'Dynamics Training Dataset', 'Readout Train Data']
 DATASET_ABSTRACTED_COLS = [c + " Type" for c in DATASET_ABSTRACTION_COLS]
+# Which flags returned by get_exclusion_flags lead to a session being excluded?
+EXCLUSION_REASONS = ['longStreak', 'alternating', 'lowAcc', 'highRT']
+# mapping of the response column to responseBool.
+# Next can show up when we feed in the results of a familiarization dataframe—ignore it for present purposes
+RESPONSE_MAPPER = {'YES': True, 'NO': False, "Next": np.nan}
+# string columns of the human data that are stored as categoricals
+# (not choices, which holds lists in the frames pulled from mongo)
+HUMAN_CATEGORICAL_COLS = ['gameID', 'prolificIDAnon', 'stim_ID', 'scenarioName', 'response']
+# bump whenever load_and_preprocess_data or basic_preprocessing change their output, so that cached frames are rebuilt
+PREPROCESSING_VERSION = 3
+# where load_and_preprocess_data keeps preprocessed frames and how much disk it may use for them
+PREPROCESSING_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'preprocessing_cache')
+PREPROCESSING_CACHE_MAX_BYTES = 2 * 1024**3
 
 
 def item(x):
@@ -33,25 +49,61 @@ def item(x):
     return x.tail(1).item()
 
 
-def get_streak_thresh(numTrials, probResp):
+def get_longest_run_distribution(numTrials, probResp):
+    '''
+    exact distribution of the longest streak (run of identical responses) in a random
+    binary sequence, computed by dynamic programming over run lengths
+
+    input:
+        numTrials: how many trials
+        probResp: probability of True response
+    output:
+        array of length numTrials+1 with the probability of each longest streak length
+    '''
+    if numTrials < 1:
+        return np.ones(1)
+    maxLengths = np.arange(1, numTrials+1)
+    # P[i, l-1] is the probability of currently being in a True (resp. False) run of length l
+    # while no run so far has exceeded maxLengths[i]
+    allowed = np.arange(numTrials)[None, :] < maxLengths[:, None]
+    P_true = np.zeros((numTrials, numTrials))
+    P_false = np.zeros((numTrials, numTrials))
+    P_true[:, 0] = probResp
+    P_false[:, 0] = 1 - probResp
+    for _ in range(numTrials - 1):
+        switch_to_true = P_false.sum(axis=1) * probResp
+        switch_to_false = P_true.sum(axis=1) * (1 - probResp)
+        P_true[:, 1:] = P_true[:, :-1] * probResp
+        P_false[:, 1:] = P_false[:, :-1] * (1 - probResp)
+        P_true[:, 0] = switch_to_true
+        P_false[:, 0] = switch_to_false
+        P_true *= allowed
+        P_false *= allowed
+    cdf = np.concatenate([[0.], P_true.sum(axis=1) + P_false.sum(axis=1)])
+    return np.diff(cdf, prepend=0.)
+
+
+# precomputed get_streak_thresh values, keyed on (numTrials, probResp, percentile)
+STREAK_THRESH_TABLE = {
+    (150, 0.5, 97.5): 12.0,
+}
+
+
+@lru_cache(maxsize=None)
+def get_streak_thresh(numTrials, probResp, percentile=97.5):
     '''
     input:
         numTrials: how many trials
         probResp: probability of True response
+        percentile: which percentile of the longest streak length to return
     output:
-        prints the 97.5th percentile for unusual streak lengths
+        returns the 97.5th (or other) percentile for unusual streak lengths under random responding
     '''
-    X = np.random.choice(a=['False', 'True'], size=(
-        1000, numTrials), p=[probResp, 1-probResp])
-    Maxx = []
-    for x in X:
-        lst = []
-        for n, c in groupby(x):
-            num, count = n, sum(1 for i in c)
-            lst.append((num, count))
-        maxx = max([y for x, y in lst])
-        Maxx.append(maxx)
-    return np.percentile(Maxx, 97.5)
+    if (numTrials, probResp, percentile) in STREAK_THRESH_TABLE:
+        return STREAK_THRESH_TABLE[(numTrials, probResp, percentile)]
+    cdf = np.cumsum(get_longest_run_distribution(numTrials, probResp))
+    # smallest streak length whose cumulative probability reaches the percentile
+    return float(np.searchsorted(cdf, percentile/100. - 1e-12))
 
 
 def get_longest_streak_length(seq):
@@ -62,29 +114,460 @@ def get_longest_streak_length(seq):
     return max([y for x, y in lst])
 
 
+def _run_lengths_to(mask, user_codes):
+    '''
+    length of the run of consecutive True values in mask ending at each position,
+    where runs are not allowed to cross from one participant into the next
+    (user_codes must be sorted)
+    '''
+    idx = np.arange(len(mask))
+    new_user = np.ones(len(mask), dtype=bool)
+    new_user[1:] = user_codes[1:] != user_codes[:-1]
+    # positions that reset the run: False entries, or (virtually) the slot before a participant's first entry
+    reset = np.where(~mask, idx, -1)
+    reset = np.where(new_user & mask, idx - 1, reset)
+    return idx - np.maximum.accumulate(reset)
+
+
+def get_exclusion_flags(D, familiarization_D=None, userIDcol=None, streak_thresh=None, verbose=False):
+    '''
+    Vectorized version of the per-participant checks in `apply_exclusion_criteria`.
+    All participants are processed in one pass over arrays sorted by participant.
+
+    input:
+        D: dataframe from a specific experiment w/ a specific physical domain (after `basic_preprocessing`)
+        familiarization_D: optional dataframe with the familiarization trials
+        userIDcol: column identifying participants, defaults to prolificIDAnon if present, else gameID
+        streak_thresh: streak length above which a session is flagged, defaults to `get_streak_thresh(150, 0.5)`
+    output:
+        flag table indexed by participant with the summary statistic and boolean flag for each criterion,
+        whether the participant is flagged, and a comma-separated list of the reasons.
+        `failedFamiliarization` is reported but (as in `apply_exclusion_criteria`) not used to flag sessions.
+    '''
+    if userIDcol is None:
+        userIDcol = 'prolificIDAnon' if 'prolificIDAnon' in D.columns else 'gameID'
+    if streak_thresh is None:
+        streak_thresh = get_streak_thresh(150, 0.5)
+
+    # responses are coded in order of first appearance so that the alternation pattern is arange(k)
+    resp_codes, resp_uniques = pd.factorize(D['response'])
+    user_codes, users = pd.factorize(D[userIDcol], sort=True)
+    # stable sort keeps the trial order within each participant, drop rows without participant
+    order = np.argsort(user_codes, kind='stable')
+    order = order[user_codes[order] >= 0]
+    resp_codes = resp_codes[order]
+    user_codes = user_codes[order]
+    nUsers = len(users)
+
+    # longest streak: NaN responses form runs of their own, just like in get_longest_streak_length
+    starts = np.ones(len(resp_codes), dtype=bool)
+    starts[1:] = (resp_codes[1:] != resp_codes[:-1]) | (user_codes[1:] != user_codes[:-1])
+    run_starts = np.flatnonzero(starts)
+    run_lengths = np.diff(np.append(run_starts, len(resp_codes)))
+    run_users = user_codes[run_starts]
+    longest = np.zeros(nUsers, dtype=int)
+    np.maximum.at(longest, run_users, run_lengths)
+
+    # alternation: a window of 10 repetitions of the response cycle within a participant's non-NaN responses
+    k = len(resp_uniques)
+    valid = resp_codes >= 0
+    alt_codes = resp_codes[valid]
+    alt_users = user_codes[valid]
+    alternating = np.zeros(nUsers, dtype=bool)
+    if k == 0:
+        alternating[:] = True  # the empty pattern is contained in every sequence
+    elif len(alt_codes):
+        first = np.ones(len(alt_users), dtype=bool)
+        first[1:] = alt_users[1:] != alt_users[:-1]
+        first_idx = np.flatnonzero(first)
+        pos = np.arange(len(alt_users)) - np.repeat(first_idx, np.diff(np.append(first_idx, len(alt_users))))
+        patternLength = 10 * k
+        for phase in range(k):
+            run_to = _run_lengths_to(alt_codes == (pos - phase) % k, alt_users)
+            # the window ending here has to start at the beginning of a cycle
+            hit = (run_to >= patternLength) & ((pos + 1 - phase) % k == 0)
+            alternating[np.unique(alt_users[hit])] = True
+
+    # low accuracy: mean accuracy more than 3 SD below the mean across participants
+    correct = D['correct'].values[order]
+    has_correct = pd.notna(correct)
+    acc_users = user_codes[has_correct]
+    acc_counts = np.bincount(acc_users, minlength=nUsers)
+    acc_sums = np.bincount(acc_users, weights=correct[has_correct].astype(int), minlength=nUsers)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        meanAcc = np.where(acc_counts > 0, acc_sums / acc_counts, np.nan)
+    has_acc = acc_counts > 0
+    lowAcc = np.zeros(nUsers, dtype=bool)
+    if has_acc.any():
+        acc_thresh = np.mean(meanAcc[has_acc]) - 3*np.std(meanAcc[has_acc])
+        lowAcc[has_acc] = meanAcc[has_acc] < acc_thresh
+
+    # high RT: median log RT more than 3 SD above the median across participants
+    logRT = D['logRT'].values.astype(float)[order]
+    rt_order = np.lexsort((logRT, user_codes))  # NaNs sort last within each participant
+    sorted_rt = logRT[rt_order]
+    rt_counts = np.bincount(user_codes[~np.isnan(logRT)], minlength=nUsers)
+    user_starts = np.searchsorted(user_codes, np.arange(nUsers))
+    lo = user_starts + np.maximum(rt_counts - 1, 0)//2
+    hi = user_starts + rt_counts//2
+    with np.errstate(invalid='ignore'):
+        medianLogRT = np.where(rt_counts > 0, (sorted_rt[lo] + sorted_rt[hi])/2, np.nan)
+        # np.median propagates NaNs while the spread ignores them, as in the pandas implementation
+        rt_thresh = np.median(medianLogRT) + 3*np.nanstd(medianLogRT)
+        highRT = medianLogRT > rt_thresh
+
+    # familiarization: 30% correct or lower
+    failedFamiliarization = np.zeros(nUsers, dtype=bool)
+    if familiarization_D is None and 'condition' in D.columns:
+        if np.sum(D['condition'] == 'familiarization_prediction') > 0:
+            familiarization_D = D[D['condition'] == 'familiarization_prediction']
+    if familiarization_D is not None:
+        try:
+            C_df = familiarization_D.groupby('gameID', observed=True).agg({'correct': ['sum', 'count']})
+            ratio = C_df[('correct', 'sum')]/C_df[('correct', 'count')]
+            excludedGames = ratio.index[ratio <= .3]
+            # min is not defined for (unordered) categorical IDs
+            famUsers = familiarization_D[familiarization_D['gameID'].isin(excludedGames)].astype(
+                {userIDcol: object}).groupby('gameID', observed=True)[userIDcol].min()
+            failedFamiliarization = users.isin(famUsers.values)
+        except Exception:
+            if verbose: print("An error occured during familiarization exclusion")
+
+    flags = pd.DataFrame({
+        'longestStreak': longest,
+        'longStreak': longest > streak_thresh,
+        'alternating': alternating,
+        'meanAccuracy': meanAcc,
+        'lowAcc': lowAcc,
+        'medianLogRT': medianLogRT,
+        'highRT': highRT,
+        'failedFamiliarization': failedFamiliarization,
+    }, index=pd.Index(users, name=userIDcol))
+    reason_flags = flags[EXCLUSION_REASONS].values
+    flags['flagged'] = reason_flags.any(axis=1)
+    flags['reasons'] = [','.join(np.array(EXCLUSION_REASONS)[row]) for row in reason_flags]
+    return flags
+
+
+def bootstrap_indices(n, start, stop, random_state=None):
+    '''
+    input:
+        n: number of observations to resample
+        start, stop: which bootstrap iterations to draw
+        random_state: None to reproduce `D.sample(n=n, random_state=currIter, replace=True)` for each
+            iteration currIter, or a seed/np.random.Generator to draw the whole block at once
+    output:
+        (stop - start) x n matrix of resample indices, one row per bootstrap iteration
+    '''
+    if random_state is None:
+        idx = np.empty((stop - start, n), dtype=np.int64)
+        rs = np.random.RandomState()
+        for i, currIter in enumerate(range(start, stop)):
+            rs.seed(currIter)
+            idx[i] = rs.choice(n, size=n, replace=True)
+        return idx
+    rng = np.random.default_rng(random_state)
+    return rng.integers(0, n, size=(stop - start, n))
+
+
+def _bootstrap_group_means(values, nIter=1000, random_state=None, chunk_size=None):
+    '''bootstrap means of every column of the (n x k) array values, returned as an nIter x k array'''
+    n = len(values)
+    if chunk_size is None:
+        # cap the resampled block at ~64MB
+        chunk_size = max(1, int(2**23 // max(1, n * values.shape[1])))
+    if random_state is not None:
+        rng = np.random.default_rng(random_state)
+    means = np.empty((nIter, values.shape[1]))
+    for start in range(0, nIter, chunk_size):
+        stop = min(start + chunk_size, nIter)
+        idx = bootstrap_indices(n, start, stop, None if random_state is None else rng)
+        means[start:stop] = values[idx].mean(axis=1)
+    return means
+
+
+def _bootstrap_group_means_star(args):
+    return _bootstrap_group_means(*args)
+
+
+def bootstrap_stats(D, cols='correct', groupby=None, nIter=1000, percentiles=(2.5, 97.5),
+                    random_state=None, chunk_size=None, n_jobs=1, return_samples=False):
+    '''
+    bootstrap the mean of several columns, separately for each group
+
+    input:
+        D: dataframe
+        cols: column or list of columns to bootstrap
+        groupby: optional column or list of columns; each group is resampled on its own
+        nIter: number of bootstrap iterations
+        percentiles: lower and upper percentile of the confidence interval
+        random_state: None reproduces `bootstrap_mean` (iteration i uses random_state=i),
+            otherwise a seed for drawing the iterations in blocks (results then depend on chunk_size)
+        chunk_size: number of iterations resampled at once, to cap memory
+        n_jobs: number of processes to bootstrap groups in parallel
+        return_samples: also return the bootstrap means per group
+    output:
+        dataframe with one row per group and (column, statistic) columns for
+        obs_mean, boot_mean, ci_lb and ci_ub,
+        and if return_samples, a dict mapping each group to an nIter x len(cols) array of bootstrap means
+    '''
+    if isinstance(cols, str):
+        cols = [cols]
+    if isinstance(groupby, list) and len(groupby) == 1:
+        groupby = groupby[0]
+    if groupby is None:
+        groups = [(None, D)]
+    else:
+        groups = list(D.groupby(groupby, observed=True))
+    keys = [key for key, _ in groups]
+    # astype('float64') maps the NAs of nullable columns to NaN
+    values = [group[cols].astype('float64').values for _, group in groups]
+
+    jobs = [(v, nIter, random_state, chunk_size) for v in values]
+    if n_jobs > 1 and len(jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            samples = list(executor.map(_bootstrap_group_means_star, jobs))
+    else:
+        samples = [_bootstrap_group_means_star(job) for job in jobs]
+
+    rows = []
+    for v, means in zip(values, samples):
+        lb, ub = np.percentile(means, percentiles, axis=0)
+        rows.append(np.stack([v.mean(axis=0), means.mean(axis=0), lb, ub], axis=1).ravel())
+    columns = pd.MultiIndex.from_product([cols, ['obs_mean', 'boot_mean', 'ci_lb', 'ci_ub']])
+    if groupby is None:
+        index = None
+    elif isinstance(groupby, list):
+        index = pd.MultiIndex.from_tuples(keys, names=groupby)
+    else:
+        index = pd.Index(keys, name=groupby)
+    stats_df = pd.DataFrame(rows, columns=columns, index=index)
+    if return_samples:
+        return stats_df, dict(zip(keys, samples))
+    return stats_df
+
+
 def bootstrap_mean(D, col='correct', nIter=1000):
-    bootmean = []
-    for currIter in np.arange(nIter):
-        bootD = D.sample(n=len(D), random_state=currIter, replace=True)
-        bootmean.append(np.mean(bootD[col].values))
-    return bootmean
+    _, samples = bootstrap_stats(D, cols=col, nIter=nIter, return_samples=True)
+    return list(samples[None][:, 0])
 
 
-def load_and_preprocess_data(path_to_data):
+def get_response_matrix(D, userIDcol='prolificIDAnon', stimcol='stim_ID', respcol='responseBool'):
     '''
-    apply basic preprocessing to human dataframe
+    input:
+        D: dataframe with one row per response
+    output:
+        respMat: numSubs x numStims int8 array of responses (1 for YES, 0 for NO, -1 where missing)
+        mask: numSubs x numStims boolean array, True where a response was observed
+        users, stims: row and column labels (sorted)
+    '''
+    D = D[D[respcol].notna()]
+    user_codes, users = pd.factorize(D[userIDcol], sort=True)
+    stim_codes, stims = pd.factorize(D[stimcol], sort=True)
+    respMat = np.full((len(users), len(stims)), -1, dtype=np.int8)
+    respMat[user_codes, stim_codes] = D[respcol].values.astype(np.int8)
+    return respMat, respMat >= 0, np.asarray(users), np.asarray(stims)
+
+
+def _masked_pair_sums(X, M):
+    '''pairwise counts and sums over jointly observed stimuli for every pair of rows'''
+    N = M @ M.T
+    S_i = X @ M.T  # sum of row i over the stimuli also observed in row j
+    return N, S_i, S_i.T, X @ X.T
+
+
+def pairwise_cohens_kappas(respMat, mask=None):
+    '''
+    Cohen's kappa between every pair of participants on the stimuli both responded to,
+    same values as calling sklearn.metrics.cohen_kappa_score on each pair
+
+    input: respMat, mask as returned by get_response_matrix
+    output: array of kappas for all pairs i < j
+    '''
+    if mask is None:
+        mask = respMat >= 0
+    M = mask.astype(float)
+    X = np.where(mask, respMat, 0).astype(float)
+    N, yes_i, yes_j, yes_both = _masked_pair_sums(X, M)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        observed_disagreement = (yes_i + yes_j - 2*yes_both) / N
+        expected_disagreement = (yes_i*(N - yes_j) + (N - yes_i)*yes_j) / N**2
+        kappas = 1 - observed_disagreement/expected_disagreement
+    return kappas[np.triu_indices(len(respMat), k=1)]
+
+
+def pairwise_correlations(respMat, mask=None):
+    '''
+    Pearson correlation between the responses of every pair of participants on the stimuli both responded to
+
+    input: respMat, mask as returned by get_response_matrix
+    output: array of correlations for all pairs i < j
+    '''
+    if mask is None:
+        mask = respMat >= 0
+    M = mask.astype(float)
+    X = np.where(mask, respMat, 0).astype(float)
+    N, S_i, S_j, S_ij = _masked_pair_sums(X, M)
+    # responses are binary, so the sum of squares equals the sum
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = S_ij - S_i*S_j/N
+        var_i = S_i - S_i**2/N
+        var_j = S_j - S_j**2/N
+        corrs = cov / np.sqrt(var_i*var_j)
+    return corrs[np.triu_indices(len(respMat), k=1)]
+
+
+def split_half_correlations(respMat, mask=None, nIter=1000, random_state=None):
+    '''
+    Pearson correlation between the mean responses per stimulus of two random halves of the participants
+
+    input:
+        respMat, mask: as returned by get_response_matrix
+        nIter: number of random splits
+        random_state: seed for the splits
+    output:
+        array of nIter correlations; stimuli without responses in one of the halves are ignored
+    '''
+    if mask is None:
+        mask = respMat >= 0
+    M = mask.astype(float)
+    X = np.where(mask, respMat, 0).astype(float)
+    numSubs = len(respMat)
+    rng = np.random.default_rng(random_state)
+    # group A is the first half of a random permutation of the participants
+    ranks = rng.random((nIter, numSubs)).argsort(axis=1).argsort(axis=1)
+    in_A = (ranks < numSubs//2).astype(float)
+    sum_A, count_A = in_A @ X, in_A @ M
+    sum_B, count_B = X.sum(axis=0) - sum_A, M.sum(axis=0) - count_A
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_A = sum_A / count_A
+        mean_B = sum_B / count_B
+    w = (count_A > 0) & (count_B > 0)
+    mean_A = np.where(w, mean_A, 0)
+    mean_B = np.where(w, mean_B, 0)
+    n = w.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dA = np.where(w, mean_A - (mean_A.sum(axis=1)/n)[:, None], 0)
+        dB = np.where(w, mean_B - (mean_B.sum(axis=1)/n)[:, None], 0)
+        return (dA*dB).sum(axis=1) / np.sqrt((dA**2).sum(axis=1) * (dB**2).sum(axis=1))
+
+
+def summarize_human_agreement(D, userIDcol='prolificIDAnon', nIter=1000, random_state=None):
+    '''
+    Compute the human-human agreement summaries for every scenario in D
+
+    input:
+        D: preprocessed dataframe (after exclusions) with a scenarioName column
+    output (scenarios with fewer than 2 subjects are skipped):
+        corrs: one row per scenario in the layout of human_pairwiseCorrs_by_scenario.csv
+        kappas: one row per scenario in the layout of human_pairwiseCohensKs_by_scenario.csv
+    '''
+    corr_rows = []
+    kappa_rows = []
+    for scenarioName, _D in D.groupby('scenarioName', observed=True):
+        if _D[userIDcol].nunique() < 2:
+            # no pairs of subjects to compare
+            continue
+        respMat, mask, _, _ = get_response_matrix(_D, userIDcol=userIDcol)
+        pairwiseCorrs = pairwise_correlations(respMat, mask)
+        pearsons_rs = split_half_correlations(respMat, mask, nIter=nIter, random_state=random_state)
+        kappas = pairwise_cohens_kappas(respMat, mask)
+        lb, med, ub = np.nanpercentile(pairwiseCorrs, [2.5, 50, 97.5])
+        r_lb, r_med, r_ub = np.nanpercentile(pearsons_rs, [2.5, 50, 97.5])
+        corr_rows.append(['human', scenarioName, lb, med, ub, np.nanmean(pearsons_rs), r_lb, r_ub, r_med])
+        kappa_rows.append(['human', scenarioName] + list(np.nanpercentile(kappas, [2.5, 50, 97.5])))
+    corrs = pd.DataFrame(corr_rows, columns=['agent', 'scenario', 'corr_lb', 'corr_med', 'corr_ub',
+                                             'r_mean', 'r_lb', 'r_ub', 'r_med'])
+    kappas = pd.DataFrame(kappa_rows, columns=['agent', 'scenario', 'corr_lb', 'corr_med', 'corr_ub'])
+    return corrs, kappas
+
+
+def get_file_hash(path, block_size=2**20):
+    '''
+    sha1 of the content of the file at path
+    '''
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _cached_file_hash(path, size, mtime_ns):
+    # size and mtime are part of the key so that a file that changes in place is hashed again
+    return get_file_hash(path)
+
+
+def get_preprocessing_cache_key(path_to_data):
+    '''
+    key of the preprocessed frame of the csv at path_to_data: changes when the content of the csv, its name
+    (which the scenario name is read from) or PREPROCESSING_VERSION change
     '''
+    st = os.stat(path_to_data)
+    content_hash = _cached_file_hash(os.path.abspath(path_to_data), st.st_size, st.st_mtime_ns)
+    return '{}-{}-v{}'.format(content_hash, os.path.basename(path_to_data), PREPROCESSING_VERSION)
 
-    # load in data
-    d = pd.read_csv(path_to_data)
+
+def evict_preprocessing_cache(cache_dir=PREPROCESSING_CACHE_DIR, max_bytes=PREPROCESSING_CACHE_MAX_BYTES):
+    '''
+    delete the least recently used cached frames until the cache takes at most max_bytes on disk
+    '''
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith('.pkl') and os.path.isfile(path):
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    # oldest first (cache hits touch the mtime of their file)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def clear_preprocessing_cache(cache_dir=PREPROCESSING_CACHE_DIR):
+    evict_preprocessing_cache(cache_dir, max_bytes=0)
+
+
+def load_and_preprocess_data(path_to_data, use_cache=True, cache_dir=PREPROCESSING_CACHE_DIR,
+                             max_cache_bytes=PREPROCESSING_CACHE_MAX_BYTES):
+    '''
+    apply basic preprocessing to human dataframe
+
+    The preprocessed frame is cached (as a pickle, which keeps the dtypes) in cache_dir under a hash of the
+    content of the csv, so changing the csv or PREPROCESSING_VERSION rebuilds it. Least recently used frames are
+    evicted once the cache is larger than max_cache_bytes. Pass use_cache=False to always read the csv.
+    '''
+    if use_cache:
+        cache_path = os.path.join(cache_dir, get_preprocessing_cache_key(path_to_data) + '.pkl')
+        if os.path.exists(cache_path):
+            try:
+                _D = pd.read_pickle(cache_path)
+                os.utime(cache_path)  # mark as recently used
+                return _D
+            except Exception as e:
+                print('Could not read cached {} ({}), preprocessing again'.format(cache_path, e))
+
+    # load in data (only the columns we use, string columns straight into categoricals)
+    colnames = ['gameID', 'trialNum', 'prolificIDAnon', 'stim_ID',
+        'response', 'target_hit_zone_label', 'correct', 'choices', 'rt']
+    d = pd.read_csv(path_to_data, usecols=lambda col: col in colnames,
+                    dtype={col: 'category' for col in HUMAN_CATEGORICAL_COLS if col in colnames})
 
     # add column for scenario name
     scenarioName = path_to_data.split('/')[-1].split('-')[1].split('_')[0]
 
     # some utility vars
     # colnames_with_variable_entries = [col for col in sorted(d.columns) if len(np.unique(d[col]))>1]
-    colnames = ['gameID', 'trialNum', 'prolificIDAnon', 'stim_ID',
-        'response', 'target_hit_zone_label', 'correct', 'choices', 'rt']
     # colnames = ['gameID','trialNum','stim_ID','response','target_hit_zone_label','correct','choices','rt']
     # include all the columns that we can
     intersect_cols = [col for col in colnames if col in d.columns]
@@ -95,28 +578,98 @@ def load_and_preprocess_data(path_to_data):
 
     _D = basic_preprocessing(_D)
 
+    if use_cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temporary file first so that a concurrent reader never sees a partial pickle
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        _D.to_pickle(tmp_path)
+        os.replace(tmp_path, cache_path)
+        evict_preprocessing_cache(cache_dir, max_cache_bytes)
+
     return _D
 
+
+def map_categorical(values, func):
+    '''
+    apply func to each unique value of a series (not to every row) and return the result as a categorical
+    '''
+    codes, uniques = pd.factorize(values)
+    new_codes, new_uniques = pd.factorize(np.array([func(u) for u in uniques], dtype=object), sort=True)
+    new_codes = np.append(new_codes, -1)  # code -1 (missing values) stays missing
+    return pd.Categorical.from_codes(new_codes[codes], new_uniques)
+
+
 def basic_preprocessing(_D):
-    try:
-        # preprocess RTs (subtract 2500ms presentation time, log transform)
-        _D = _D.assign(RT=_D['rt'] - 2500)
-        _D = _D.assign(logRT=np.log(_D['RT']))
-        _D = _D.drop(columns=['rt'], axis=1)
-    except:
-        _D['RT'] = np.nan
-        _D['logRT'] = np.nan
+    '''
+    input: dataframe with (at least) the response and stim_ID columns of the human data
+    output: dataframe with RT, logRT (float32), responseBool (bool, or nullable boolean if there are missing
+        responses), the stim_ID without "_img" and HUMAN_CATEGORICAL_COLS as categoricals.
+        Raises a ValueError if columns are missing or hold values that cannot be converted.
+    '''
+    missing = [col for col in ['response', 'stim_ID'] if col not in _D.columns]
+    if len(missing) > 0:
+        raise ValueError("Missing columns for preprocessing: {}".format(missing))
+    _D = _D.copy()
+
+    # preprocess RTs (subtract 2500ms presentation time, log transform)
+    if 'rt' in _D.columns:
+        try:
+            RT = pd.to_numeric(_D['rt']).values.astype(float) - 2500
+        except (ValueError, TypeError) as e:
+            raise ValueError("Column rt has values that are not numeric: {}".format(e))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            logRT = np.log(RT)
+        _D = _D.drop(columns=['rt'])
+    else:
+        # e.g. familiarization data without RTs
+        RT = logRT = np.full(len(_D), np.nan)
+    _D['RT'] = RT.astype(np.float32)
+    _D['logRT'] = logRT.astype(np.float32)
 
     # convert responses to boolean
-    binary_mapper = {'YES': True, 'NO': False, np.nan: np.nan, "Next":np.nan} # Next can show up when we feed in the results of a familiarization dataframe—ignore it for present purposes
-    _D = _D.assign(responseBool=_D['response'].apply(
-        lambda x: binary_mapper[x]), axis=0)
+    codes, uniques = pd.factorize(_D['response'])
+    unknown = [u for u in uniques if u not in RESPONSE_MAPPER]
+    if len(unknown) > 0:
+        raise ValueError("Unexpected values in response column: {}".format(unknown))
+    mapped = np.array([RESPONSE_MAPPER[u] for u in uniques] + [np.nan], dtype=float)[codes]
+    if np.isnan(mapped).any():
+        _D['responseBool'] = pd.array(np.where(np.isnan(mapped), None, mapped == 1), dtype='boolean')
+    else:
+        _D['responseBool'] = mapped == 1
 
     # remove _img from stimulus name
-    _D['stim_ID'] = _D['stim_ID'].apply(lambda n: n.split("_img")[0])
+    if _D['stim_ID'].isna().any():
+        raise ValueError("Column stim_ID has missing values")
+    _D['stim_ID'] = map_categorical(_D['stim_ID'], lambda n: n.split("_img")[0])
+
+    for col in ['correct', 'target_hit_zone_label']:
+        if col in _D.columns and _D[col].dtype == object:
+            _D[col] = _D[col].astype('boolean')
+    for col in HUMAN_CATEGORICAL_COLS:
+        if col not in _D.columns:
+            continue
+        if not isinstance(_D[col].dtype, pd.CategoricalDtype):
+            _D[col] = _D[col].astype('category')
+        elif not _D[col].cat.categories.is_monotonic_increasing:
+            # sorted categories keep groupby results in the same order as for string columns
+            _D[col] = _D[col].cat.reorder_categories(sorted(_D[col].cat.categories))
     return _D
 
 
+def concat_preprocessed(frames):
+    '''
+    concatenate preprocessed dataframes (e.g. of several scenarios) keeping the categorical columns categorical:
+    pd.concat falls back to object columns when the categories differ.
+    '''
+    frames = list(frames)
+    cat_cols = [col for col in HUMAN_CATEGORICAL_COLS
+                if all(col in f.columns and isinstance(f[col].dtype, pd.CategoricalDtype) for f in frames)]
+    for col in cat_cols:
+        categories = pd.api.types.union_categoricals([f[col].values for f in frames]).categories
+        frames = [f.assign(**{col: f[col].cat.set_categories(categories)}) for f in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
 def apply_exclusion_criteria(D, familiarization_D=None, verbose=False):
     '''
      Based on `preregistration_neurips2021.md`
@@ -145,95 +698,38 @@ def apply_exclusion_criteria(D, familiarization_D=None, verbose=False):
         if verbose:
             print("WARNING: no prolificIDAnon column found. Using gameID instead.")
 
-    # init flaggedIDs var
-    flaggedIDs = []
-
     # what is 97.5th percentile for random sequences of length numTrials and p=0.5?
     thresh = get_streak_thresh(150, 0.5)
     if verbose:
         print('97.5th percentile for streak length is {}.'.format(thresh))
 
-    # flag sessions with long streaks
-    streakyIDs = []
-    for name, group in D.groupby(userIDcol):
-        seq = group['response'].values
-        streak_length = get_longest_streak_length(group['response'].values)
-        if streak_length > thresh:
-            streakyIDs.append(name)
-    if verbose:
-        print('There are {} flagged IDs so far due to long streaks.'.format(
-            len(streakyIDs)))
-
-    # flag sessions with suspicious alternation pattern
-    alternatingIDs = []
-    pattern = list(D['response'].dropna().unique())*10
-    for name, group in D.groupby(userIDcol):
-        seq = group['response'].dropna().values
-        substr = ''.join(pattern)
-        fullstr = ''.join(seq)
-        if substr in fullstr:
-            alternatingIDs.append(name)
-    if verbose:
-        print('There are {} flagged IDs so far due to alternating sequences.'.format(
-            len(alternatingIDs)))
-
-    # flag sessions that failed familiarization
-    # see familiarization_exclusion.py
-    if familiarization_D is None:
+    if familiarization_D is None and verbose:
         # is familirization dataframe provided in D?
-        try:
-            if np.sum(D['condition'] == 'familiarization_prediction') > 0:
-                familiarization_D = D[D['condition'] == 'familiarization_prediction']
-                if verbose:
-                    print('Familiarization dataframe provided in D.')
-        except:
-                if verbose: print('Familiarization dataframe not provided in D.')
-    if familiarization_D is not None:
+        if 'condition' in D.columns and np.sum(D['condition'] == 'familiarization_prediction') > 0:
+            print('Familiarization dataframe provided in D.')
+        else:
+            print('Familiarization dataframe not provided in D.')
+    if familiarization_D is not None and verbose:
         # do we have coverage for all prolific IDs?
-        if verbose: print('Familiarization dataframe has {} rows.'.format(len(familiarization_D)))
+        print('Familiarization dataframe has {} rows.'.format(len(familiarization_D)))
         if set(np.unique(familiarization_D[userIDcol])) != set(np.unique(D[userIDcol])):
-            if verbose: print('Not all prolific IDs are covered in familiarization data. Make sure you pass familiarization data for all trials!')
-        try:
-            C_df = familiarization_D.groupby('gameID').agg({'correct': ['sum', 'count']})
-            # get ratio
-            C_df['ratio'] = C_df[('correct', 'sum')]/C_df[('correct', 'count')]
-            C_df_excluded = C_df[C_df['ratio'] <= .3]
-            # get ProlificIDs for excluded sessions
-            excludedIDs = C_df_excluded.index.values
-            # get ProlificIDs for gameIDs
-            famIDs = []
-            for gameID in excludedIDs:
-                famIDs.append(np.unique(familiarization_D[familiarization_D['gameID'] == gameID][userIDcol])[0])
-        except:
-            if verbose: print("An error occured during familiarization exclusion")
-        if verbose:
-            print("There are {} flagged IDs due to failing the familiarization trials".format(len(C_df_excluded)))
-    else:
-        if verbose: print('No familiarization data provided. Pass a dataframe with data from the familiarization trials (full dataframe is okay). Skipping familiarization exclusion.')
-    
-    # flag sessions with unusually low accuracy
-    # ignore nan responses
-    Dacc = D[D['correct'].isna() == False]
-    Dacc['correct'] = Dacc['correct'].astype(int)
-    Dacc = Dacc.groupby(userIDcol).agg({'correct':'mean'})
-    thresh = np.mean(Dacc['correct']) - 3*np.std(Dacc['correct'])
-    Dacc = Dacc.assign(lowAcc = Dacc['correct']<thresh)
-    lowAccIDs = list(Dacc[Dacc['lowAcc']==True].index)
-    if verbose:
-        print('There are {} flagged IDs so far due to low accuracy.'.format(len(lowAccIDs))) 
-    
-    # flag sessions with unusually high RTs
-    Drt = D.groupby(userIDcol).agg({'logRT':np.median})
-    thresh = np.median(Drt['logRT']) + 3*np.std(Drt['logRT'])
-    Drt = Drt.assign(highRT = Drt['logRT']>thresh)
-    highRTIDs = list(Drt[Drt['highRT']==True].index)
+            print('Not all prolific IDs are covered in familiarization data. Make sure you pass familiarization data for all trials!')
+
+    # compute all per-session flags in one pass
+    # see get_exclusion_flags for the individual criteria
+    flags = get_exclusion_flags(D, familiarization_D=familiarization_D, userIDcol=userIDcol,
+                                streak_thresh=thresh, verbose=verbose)
     if verbose:
-        print('There are {} flagged IDs so far due to high RTs.'.format(len(highRTIDs)))    
-    
+        print('There are {} flagged IDs so far due to long streaks.'.format(flags['longStreak'].sum()))
+        print('There are {} flagged IDs so far due to alternating sequences.'.format(flags['alternating'].sum()))
+        print("There are {} flagged IDs due to failing the familiarization trials".format(flags['failedFamiliarization'].sum()))
+        print('There are {} flagged IDs so far due to low accuracy.'.format(flags['lowAcc'].sum()))
+        print('There are {} flagged IDs so far due to high RTs.'.format(flags['highRT'].sum()))
+
     # combining all flagged sessions
-    flaggedIDs = streakyIDs + alternatingIDs + lowAccIDs + highRTIDs
+    flaggedIDs = list(flags.index[flags['flagged']])
     if verbose:
-        print('There are a total of {} flagged IDs.'.format(len(np.unique(flaggedIDs))))  
+        print('There are a total of {} flagged IDs.'.format(len(flaggedIDs)))
 
     # we also need to exclude ledge stimuli until their reprodicibility is fixed
     mask = ~D['stim_ID'].str.contains("ledge")
@@ -243,6 +739,10 @@ def apply_exclusion_criteria(D, familiarization_D=None, verbose=False):
 
     # removing flagged sessions from dataset
     D = D[~D[userIDcol].isin(flaggedIDs)]
+    # drop the categories of the removed sessions and stimuli so they do not show up in groupbys
+    for col in D.columns:
+        if isinstance(D[col].dtype, pd.CategoricalDtype):
+            D = D.assign(**{col: D[col].cat.remove_unused_categories()})
     numSubs = len(np.unique(D[userIDcol].values))
     if verbose:
         print('There are a total of {} valid and complete sessions for {}.'.format(numSubs, scenarionName))   
@@ -251,6 +751,84 @@ def apply_exclusion_criteria(D, familiarization_D=None, verbose=False):
 
 def same_or_nan(acol,bcol): return [a if a != b else np.nan for a,b in zip(acol,bcol)]
 
+# scenario names that the model results use, and their names in the human data
+MODEL_SCENARIO_RENAMES = {
+    'rollslide': 'rollingsliding',
+    'cloth': 'clothiness',
+    'no_rollslide': 'no_rollingsliding',
+    'no_cloth': 'no_clothiness'}
+# columns (in order) that are joined into ModelID and Model Kind. None stands for the literal "readout"
+MODEL_ID_COLS = ['Model', 'Encoder Type', 'Encoder Training Seed', 'Encoder Training Task',
+    'Encoder Training Dataset', 'Dynamics Training Task', 'Dynamics Training Seed', 'Dynamics Training Dataset',
+    None, 'Readout Type', 'Readout Train Data', 'filename']
+MODEL_KIND_COLS = ['Model', 'Encoder Type', 'Encoder Training Seed', 'Encoder Training Task',
+    'Encoder Training Dataset Type', 'Dynamics Training Task', 'Dynamics Training Seed',
+    # 'Dynamics Training Dataset Type',
+    'Readout Train Data Type']
+
+
+def factorize_as_str(col):
+    '''
+    input: series
+    output: (codes, labels) such that labels[codes] == col.astype(str), with only the unique values converted
+    '''
+    codes, uniques = pd.factorize(col)
+    labels = pd.Series(uniques).astype(str).values
+    missing = codes == -1
+    if missing.any():
+        # missing values are a category of their own
+        labels = np.append(labels, col[missing].iloc[:1].astype(str).values)
+        codes[missing] = len(labels) - 1
+    return codes, labels
+
+
+def replace_values(MD, mapping):
+    '''
+    same as MD.replace(mapping) for exact matches of string values, but only looks up each unique value once
+    '''
+    MD = MD.copy()
+    for col in MD.columns:
+        values = MD[col]
+        if values.dtype == object:
+            codes, uniques = pd.factorize(values)
+            if not any(u in mapping for u in uniques):
+                continue
+            new_uniques = np.empty(len(uniques), dtype=object)
+            new_uniques[:] = [mapping.get(u, u) for u in uniques]
+            new_values = values.values.copy()
+            present = codes != -1
+            new_values[present] = new_uniques[codes[present]]
+            MD[col] = new_values
+        elif isinstance(values.dtype, pd.CategoricalDtype):
+            MD[col] = values.replace(mapping)
+    return MD
+
+
+def join_columns_as_str(MD, cols, sep="_", factorized=None):
+    '''
+    vectorized ["_".join(attr) for attr in zip(*[MD[c].astype(str) for c in cols])]: only the strings of the
+    unique combinations of cols are built. None in cols stands for the literal "readout".
+    factorized is an optional dict of already computed factorize_as_str results by column, which gets filled in.
+    '''
+    if factorized is None:
+        factorized = {}
+    key = np.zeros(len(MD), dtype=np.int64)
+    for col in cols:
+        if col is None:
+            continue
+        if col not in factorized:
+            factorized[col] = factorize_as_str(MD[col])
+        codes, labels = factorized[col]
+        # keep the combined key dense so it does not overflow
+        key, _ = pd.factorize(key * len(labels) + codes)
+    _, first = np.unique(key, return_index=True)
+    parts = [["readout"] * len(first) if col is None else factorized[col][1][factorized[col][0][first]]
+             for col in cols]
+    strings = np.empty(len(first), dtype=object)
+    strings[:] = [sep.join(attr) for attr in zip(*parts)]
+    return strings[key]
+
+
 def process_model_dataframe(MD):
     """Apply a couple of steps to read in the output of the model results"""
 
@@ -258,67 +836,33 @@ def process_model_dataframe(MD):
     MD['correct'] = MD['Actual Outcome'] == MD['Predicted Outcome']
 
     # reverse renaming of scenarios
-    MD = MD.replace('rollslide','rollingsliding')
-    MD = MD.replace('cloth','clothiness')
-    MD = MD.replace('no_rollslide','no_rollingsliding')
-    MD = MD.replace('no_cloth','no_clothiness')
+    MD = replace_values(MD, MODEL_SCENARIO_RENAMES)
 
     # add canonical stim name (ie remove redyellow)
-    MD['Canon Stimulus Name'] = MD['Stimulus Name'].apply(lambda n: "".join(n.split('-redyellow')))
+    codes, stim_names = factorize_as_str(MD['Stimulus Name'])
+    canon_names = np.empty(len(stim_names), dtype=object)
+    canon_names[:] = ["".join(n.split('-redyellow')) for n in stim_names]
+    MD['Canon Stimulus Name'] = canon_names[codes]
 
     # set dataset columns to 'same' if they match the test data
+    test_data = MD["Readout Test Data"].values
+    no_test_data = ("no_" + MD["Readout Test Data"].astype(object)).values
     for col in DATASET_ABSTRACTION_COLS:
-        MD[col+" Type"] = MD[col]
-        MD.loc[MD[col] == MD["Readout Test Data"],col+" Type"] = "same"
-        MD.loc[MD[col] == ["no_"+n for n in MD["Readout Test Data"]],col+" Type"] = "all_but_this"
+        values = MD[col].values
+        typed = MD[col].copy()
+        typed[values == test_data] = "same"
+        typed[values == no_test_data] = "all_but_this"
+        MD[col+" Type"] = typed
         # MD.loc[MD[col] == "all",col+" Type"] == "all
 
     # force unique model string
-    MD['ModelID'] = ["_".join(attr) for attr in zip(
-    MD['Model'].astype(str),
-    MD['Encoder Type'].astype(str),
-    MD['Encoder Training Seed'].astype(str),
-    MD['Encoder Training Task'].astype(str), 
-    MD['Encoder Training Dataset'].astype(str),
-    MD['Dynamics Training Task'].astype(str),
-    MD['Dynamics Training Seed'].astype(str),
-    MD['Dynamics Training Dataset'].astype(str),
-    ["readout"]*len(MD),
-    MD['Readout Type'].astype(str),
-    MD['Readout Train Data'].astype(str),
-    MD['filename'].astype(str)
-    )]
-    
-    # force unique model string
-    MD['ModelID'] = ["_".join(attr) for attr in zip(
-    MD['Model'].astype(str),
-    MD['Encoder Type'].astype(str),
-    MD['Encoder Training Seed'].astype(str),
-    MD['Encoder Training Task'].astype(str), 
-    MD['Encoder Training Dataset'].astype(str),
-    MD['Dynamics Training Task'].astype(str),
-    MD['Dynamics Training Seed'].astype(str),
-    MD['Dynamics Training Dataset'].astype(str),
-    ["readout"]*len(MD),
-    MD['Readout Type'].astype(str),
-    MD['Readout Train Data'].astype(str),
-    MD['filename'].astype(str)
-    )]
+    factorized = {}
+    MD['ModelID'] = join_columns_as_str(MD, MODEL_ID_COLS, factorized=factorized)
 
     # add a model kind—the granularity that we want to plot over—columns
     # this ignores the specific datasets if they match the testing data, but not otherwise
     # ignores Dynamics Training, so we can loop over it in plotting
     # get a list of models to plot
-    MD['Model Kind'] = ["_".join(attr) for attr in zip(
-        MD['Model'].astype(str),
-        MD['Encoder Type'].astype(str),
-        MD['Encoder Training Seed'].astype(str),
-        MD['Encoder Training Task'].astype(str), 
-        MD['Encoder Training Dataset Type'].astype(str),
-        MD['Dynamics Training Task'].astype(str),
-        MD['Dynamics Training Seed'].astype(str),
-        # MD['Dynamics Training Dataset Type'].astype(str),
-        MD['Readout Train Data Type'].astype(str),
-    )]
+    MD['Model Kind'] = join_columns_as_str(MD, MODEL_KIND_COLS, factorized=factorized)
 
     return MD
@@ -0,0 +1,93 @@
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+import analysis_helpers as h
+
+'''
+Checks that analysis_helpers.process_model_dataframe gives the same output as the original (row by row)
+implementation on a synthetic concatenation of model result csvs and reports rows/sec for both, e.g.:
+python benchmark_process_model_dataframe.py --num_models=500 --num_stims=150
+'''
+
+SCENARIOS = ['dominoes', 'support', 'collide', 'contain', 'drop', 'link', 'rollslide', 'cloth']
+
+
+def process_model_dataframe_legacy(MD):
+    """original implementation of analysis_helpers.process_model_dataframe, kept as reference"""
+    MD['correct'] = MD['Actual Outcome'] == MD['Predicted Outcome']
+    MD = MD.replace('rollslide','rollingsliding')
+    MD = MD.replace('cloth','clothiness')
+    MD = MD.replace('no_rollslide','no_rollingsliding')
+    MD = MD.replace('no_cloth','no_clothiness')
+    MD['Canon Stimulus Name'] = MD['Stimulus Name'].apply(lambda n: "".join(n.split('-redyellow')))
+    for col in h.DATASET_ABSTRACTION_COLS:
+        MD[col+" Type"] = MD[col]
+        MD.loc[MD[col] == MD["Readout Test Data"],col+" Type"] = "same"
+        MD.loc[MD[col] == ["no_"+n for n in MD["Readout Test Data"]],col+" Type"] = "all_but_this"
+    MD['ModelID'] = ["_".join(attr) for attr in zip(
+        *[MD[c].astype(str) if c is not None else ["readout"]*len(MD) for c in h.MODEL_ID_COLS])]
+    MD['ModelID'] = ["_".join(attr) for attr in zip(
+        *[MD[c].astype(str) if c is not None else ["readout"]*len(MD) for c in h.MODEL_ID_COLS])]
+    MD['Model Kind'] = ["_".join(attr) for attr in zip(*[MD[c].astype(str) for c in h.MODEL_KIND_COLS])]
+    return MD
+
+
+def make_model_results(num_models=200, num_stims=150, seed=0):
+    '''
+    synthetic stand-in for pd.concat of the model result csvs: one block of num_stims rows per model,
+    readout type and test scenario
+    '''
+    rng = np.random.RandomState(seed)
+    frames = []
+    for m in range(num_models):
+        train = rng.choice(SCENARIOS + ['all'] + ['no_' + s for s in SCENARIOS])
+        seed_value = rng.choice([0.0, 1.0, 2.0, np.nan])
+        for test in SCENARIOS:
+            for readout in ['A', 'B', 'C']:
+                filename = 'model{}_{}_{}_results.csv'.format(m, readout, test)
+                stims = ['pilot_{}_{:04d}{}'.format(test, i, '-redyellow' if i % 2 else '') for i in range(num_stims)]
+                frames.append(pd.DataFrame({
+                    'Model': 'model{}'.format(m % 20),
+                    'Encoder Type': 'encoder{}'.format(m % 7),
+                    'Encoder Training Seed': seed_value,
+                    'Encoder Training Task': 'task{}'.format(m % 3),
+                    'Encoder Training Dataset': train,
+                    'Dynamics Training Task': 'task{}'.format(m % 3),
+                    'Dynamics Training Seed': int(m % 3),
+                    'Dynamics Training Dataset': rng.choice([train, test, 'all']),
+                    'Readout Type': readout,
+                    'Readout Train Data': rng.choice([test, 'no_' + test, 'all']),
+                    'Readout Test Data': test,
+                    'Stimulus Name': stims,
+                    'Actual Outcome': rng.rand(num_stims) > 0.5,
+                    'Predicted Outcome': rng.rand(num_stims) > 0.5,
+                    'filename': filename}))
+    return pd.concat(frames)
+
+
+def time_rows_per_sec(func, MD, repeats=1):
+    best = np.inf
+    for _ in range(repeats):
+        _MD = MD.copy()
+        start = time.time()
+        out = func(_MD)
+        best = min(best, time.time() - start)
+    return out, len(MD) / best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_models', type=int, help='number of synthetic models', default=200)
+    parser.add_argument('--num_stims', type=int, help='number of stimuli per model and scenario', default=150)
+    parser.add_argument('--repeats', type=int, help='report the best of this many runs', default=3)
+    args = parser.parse_args()
+
+    MD = make_model_results(args.num_models, args.num_stims)
+    print('Benchmarking on {} rows'.format(len(MD)))
+    legacy, legacy_rate = time_rows_per_sec(process_model_dataframe_legacy, MD, args.repeats)
+    current, current_rate = time_rows_per_sec(h.process_model_dataframe, MD, args.repeats)
+    pd.testing.assert_frame_equal(legacy, current)
+    print('before: {:,.0f} rows/sec'.format(legacy_rate))
+    print('after:  {:,.0f} rows/sec ({:.1f}x)'.format(current_rate, current_rate / legacy_rate))
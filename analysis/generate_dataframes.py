@@ -2,6 +2,11 @@
 
 import os
 import sys
+import time
+import json
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 os.getcwd()
 sys.path.append("..")
@@ -69,6 +74,9 @@ def anonymize(subjID):
         sys.exit()
     return ''.join([mapper[char] for char in list(subjID)])
 
+## local store of the raw (not anonymized!) responses and high water marks for incremental pulls
+cache_dir = os.path.join(analysis_dir,'mongo_cache')
+
 ## create directories that don't already exist        
 result = [make_dir_if_not_exists(x) for x in [results_dir,csv_dir]]
 
@@ -129,75 +137,84 @@ neurips2021_iterations = [
     'iterationName' : 'production_2_testing'},
 ]
 
-def get_dfs_from_mongo(study,bucket_name,stim_version,iterationName):
-    """Get's and saves the given iteration from the mongoDB. Writes out two dataframes."""
-    df_trial_entries, df_familiarization_entries = pull_dataframes_from_mongo(study, bucket_name, stim_version, iterationName)
+# fields of the session documents that the analysis uses, with the dtypes they are stored with when streaming
+ANALYSIS_FIELDS = {
+    'gameID' : 'string',
+    'prolificID' : 'string',
+    'studyID' : 'string',
+    'sessionID' : 'string',
+    'iterationName' : 'string',
+    'condition' : 'string',
+    'trial_type' : 'string',
+    'trialNum' : 'float64',
+    'stim_ID' : 'string',
+    'stim_url' : 'string',
+    'map_url' : 'string',
+    'response' : 'string',
+    'choices' : 'string',
+    'target_hit_zone_label' : 'boolean',
+    'correct' : 'boolean',
+    'rt' : 'float64',
+}
+
+def get_dfs_from_mongo(study,bucket_name,stim_version,iterationName,**pull_kwargs):
+    """Get's and saves the given iteration from the mongoDB. Writes out two dataframes. Keyword arguments are passed on to pull_dataframes_from_mongo."""
+    df_trial_entries, df_familiarization_entries = pull_dataframes_from_mongo(study, bucket_name, stim_version, iterationName, **pull_kwargs)
+    save_dfs(study, iterationName, df_trial_entries, df_familiarization_entries)
+    return
 
+def save_dfs(study, iterationName, df_trial_entries, df_familiarization_entries, per_stim_agg=None):
+    """Saves the trial and familiarization entries and the per stim accuracy (computed from the trial entries unless given)."""
     # save out df_trials_entries
     df_trial_entries.to_csv(os.path.join(csv_dir,"human_responses-{}-{}.csv".format(study,iterationName)))
     # save out df_famili arizations_entries
     df_familiarization_entries.to_csv(os.path.join(csv_dir,"familiarization_human_responses-{}-{}.csv".format(study,iterationName)))
 
     #generate per stim aggregated df
-    df_trial_entries['c'] = 1 #add dummy variable for count in agg
-    per_stim_agg = df_trial_entries.groupby('stim_ID').agg({
-        'correct' : lambda cs: np.mean([1 if c == True else 0 for c in cs]),
-        'c' : 'count',
-    })
+    if per_stim_agg is None:
+        per_stim_agg = get_per_stim_accuracy(df_trial_entries)
     #save
     per_stim_agg.to_csv(os.path.join(csv_dir,"human_accuracy-{}-{}.csv".format(study,iterationName)))
-    return
 
+def get_per_stim_accuracy(df_trial_entries):
+    """Aggregates the trial entries into accuracy and number of responses per stimulus."""
+    df_trial_entries = df_trial_entries.assign(c=1) #add dummy variable for count in agg
+    return df_trial_entries.groupby('stim_ID', observed=True).agg({
+        'correct' : lambda cs: cs.fillna(False).astype(float).mean(), # missing counts as incorrect
+        'c' : 'count',
+    })
+
+def pull_dataframes_from_mongo(study, bucket_name, stim_version, iterationName, database_name='human_physics_benchmarking', fields=None, stream_to=None, batch_size=1000, client=None):
+    """Gets dataframes from mongo and returns both the experimental and the familiarization trials.
 
-def pull_dataframes_from_mongo(study, bucket_name, stim_version, iterationName, database_name='human_physics_benchmarking'):
-    """Gets dataframes from mongo and returns both the experimental and the familiarization trials"""
+    Pass `fields` (e.g. ANALYSIS_FIELDS) to only pull those fields from the server, and `stream_to` (path to a .parquet file) to read the cursor in batches of `batch_size` documents that are converted to typed columns and appended to that file, instead of holding every raw document in memory."""
     # connect to database
-    db = conn[database_name]
+    client = client or conn
+    db = client[database_name]
     coll = db[study]
-    stim_db = conn['stimuli']
+    stim_db = client['stimuli']
     stim_coll = stim_db[bucket_name+'_'+stim_version]
 
     # get dataframe of served stims
-    stim_df = pd.DataFrame(stim_coll.find({}))
-    stim_df.set_index('_id')
-    df = coll.find({
+    stim_df = pd.DataFrame(stim_coll.find({}, projection={'stims' : 1, 'games' : 1}))
+    query = {
             'iterationName':iterationName,
             'prolificID': {'$exists' : True},
             'studyID': {'$exists' : True},
             'sessionID': {'$exists' : True},
-    })
-    df = pd.DataFrame(df)
+    }
+    df = read_mongo_collection(coll, query, fields=fields, stream_to=stream_to, batch_size=batch_size)
     
     assert len(df)>0, "df from mongo empty"
 
     #Which gameids have completed all trials that were served to them? 
     #Note that this will also exclude complete trials whose games aren't in the stim database anymore (ie if it has been dropped)
-    complete_gameids = []
-    for gameid in tqdm(df['gameID'].unique()):
-        #get the corresponding games
-        served_stim_ID = None
-        for stims_ID in stim_df.index:
-            try:
-                if gameid in stim_df.iloc[stims_ID]['games']:
-                    #great, we found our corresponding stim_ID
-                    served_stim_ID = stims_ID
-            except TypeError as e:
-    #             print("No games listed for",stims_ID)
-                    pass
-        if served_stim_ID == None:
-            #we haven't found the stim_ID
-            print("No recorded entry for game_ID in stimulus database:",gameid)
-            continue
-        served_stims = stim_df.at[served_stim_ID,'stims']
-        #let's check if we can find an entry for each stim
-        found_empty = False
-        for stim_ID in [s['stim_ID'] for s in served_stims.values()]:
-            #check if we have an entry for that stimulus
-            if len(df.query("gameID == '"+gameid+"' & stim_ID == '"+stim_ID+"'")) == 0:
-                found_empty = True
-                break
-        if not found_empty: complete_gameids.append(gameid)
+    complete_gameids = get_complete_gameids(df, stim_df)
     
+    return split_dataframes(df, study, complete_gameids)
+
+def split_dataframes(df, study, complete_gameids):
+    """Applies preprocessing and exclusion criteria to the raw session entries and returns the experimental and the familiarization trials of the complete games"""
     # add scenario name
     df['scenarioName'] = study.split('_')[0]
 
@@ -228,22 +245,272 @@ def pull_dataframes_from_mongo(study, bucket_name, stim_version, iterationName,
         df_familiarization_entries.drop(labels=['prolificID'],axis=1, inplace=True)
     return df_trial_entries,df_familiarization_entries
 
-def pull_straight_df_from_mongo(study, database_name):
-    """Simply gets entire study from mongo, no processing applied"""
-    db = conn[database_name]
+def get_complete_gameids(df, stim_df, verbose=True):
+    """Returns the gameIDs in df that have a response for every stimulus that was served to them.
+
+    Builds an inverted index from gameID to the stimulus set (row of stim_df) that lists it and a set of the
+    (gameID, stim_ID) pairs that have a response, so every game is checked with set lookups only."""
+    start = time.time()
+    # map each game to the stim set it was served. If a game is listed in several sets, the last one wins
+    game_to_stim_set = {}
+    if 'games' in stim_df.columns:
+        for stims_ID, games in enumerate(stim_df['games'].values):
+            if isinstance(games, (list, tuple, set, np.ndarray)):
+                for gameid in games:
+                    game_to_stim_set[gameid] = stims_ID
+    index_time = time.time()
+    # all (gameID, stim_ID) pairs that have an entry
+    observed = set(zip(df['gameID'].values, df['stim_ID'].values))
+    pairs_time = time.time()
+
+    complete_gameids = []
+    for gameid in df['gameID'].unique():
+        if gameid not in game_to_stim_set:
+            #we haven't found the stim_ID
+            print("No recorded entry for game_ID in stimulus database:",gameid)
+            continue
+        served_stims = stim_df['stims'].values[game_to_stim_set[gameid]]
+        #let's check if we can find an entry for each stim
+        if all((gameid, s['stim_ID']) in observed for s in served_stims.values()):
+            complete_gameids.append(gameid)
+    end = time.time()
+    if verbose:
+        print("Completeness check: indexed {} games in {:.2f}s, {} responses in {:.2f}s, checked games in {:.2f}s".format(
+            len(game_to_stim_set), index_time - start, len(observed), pairs_time - index_time, end - pairs_time))
+    return complete_gameids
+
+def pull_straight_df_from_mongo(study, database_name, fields=None, stream_to=None, batch_size=1000, client=None):
+    """Simply gets entire study from mongo, no processing applied. See pull_dataframes_from_mongo for `fields` and `stream_to`."""
+    client = client or conn
+    db = client[database_name]
     coll = db[study]
 
     # get dataframe of served stims
-    df = coll.find({})
-    df = pd.DataFrame(df)
+    df = read_mongo_collection(coll, {}, fields=fields, stream_to=stream_to, batch_size=batch_size)
     
     assert len(df)>0, "df from mongo empty"
 
     return df
 
+def read_mongo_collection(coll, query, fields=None, stream_to=None, batch_size=1000):
+    """Returns the documents matching query as a dataframe, pulling only `fields` if given and streaming through `stream_to` if given."""
+    if stream_to is None:
+        projection = None if fields is None else {field : 1 for field in fields}
+        return pd.DataFrame(coll.find(query, projection=projection))
+    # streaming needs a fixed schema
+    fields = fields or ANALYSIS_FIELDS
+    stream_mongo_to_parquet(coll, query, stream_to, fields=fields, batch_size=batch_size)
+    return read_parquet_as_objects(stream_to)
+
+def iter_mongo_batches(coll, query, fields=ANALYSIS_FIELDS, batch_size=1000):
+    """Yields the documents matching query as dataframes of at most batch_size rows with the columns (and dtypes) given by `fields`."""
+    cursor = coll.find(query, projection={field : 1 for field in fields}, batch_size=batch_size)
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) == batch_size:
+            yield typed_batch(batch, fields)
+            batch = []
+    if len(batch) > 0:
+        yield typed_batch(batch, fields)
+
+def typed_batch(docs, fields):
+    """Converts a list of documents into a dataframe with a fixed schema: the columns in fields with the dtypes in ANALYSIS_FIELDS, strings for everything else."""
+    batch = pd.DataFrame(docs, columns=list(fields))
+    for col in batch.columns:
+        dtype = ANALYSIS_FIELDS.get(col, 'string')
+        if dtype == 'string':
+            # lists (e.g. choices), ObjectIds and other objects are stored as their string representation
+            batch[col] = batch[col].map(lambda v: v if isinstance(v, (str, float, type(None))) else str(v))
+        batch[col] = batch[col].astype(dtype)
+    return batch
+
+def stream_mongo_to_parquet(coll, query, path, fields=ANALYSIS_FIELDS, batch_size=1000):
+    """Appends the documents matching query batch by batch to a parquet file at path, so only one batch is held in memory. Returns the number of rows written."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Streaming from mongo requires pyarrow (pip install pyarrow)")
+    writer = None
+    num_rows = 0
+    try:
+        for batch in iter_mongo_batches(coll, query, fields=fields, batch_size=batch_size):
+            table = pa.Table.from_pandas(batch, preserve_index=False)
+            if writer is None:
+                schema = table.schema
+                writer = pq.ParquetWriter(path, schema)
+            else:
+                table = table.cast(schema)
+            writer.write_table(table)
+            num_rows += len(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        # nothing matched, still leave an (empty) file behind
+        typed_batch([], fields).to_parquet(path)
+    return num_rows
+
+def read_parquet_as_objects(path, columns=None):
+    """Reads a parquet file written by stream_mongo_to_parquet back with object columns and NaN for missing values, like pd.DataFrame(cursor) would."""
+    return typed_to_objects(pd.read_parquet(path, columns=columns))
+
+def typed_to_objects(df):
+    """Converts the string and boolean columns of a typed dataframe to object columns with NaN for missing values."""
+    df = df.copy()
+    for col in df.columns:
+        if str(df[col].dtype) in ['string', 'boolean']:
+            df[col] = df[col].astype(object).where(df[col].notna(), np.nan)
+    return df
+
+high_water_marks_lock = threading.Lock()
+
+def load_high_water_marks():
+    """Returns the state of the incremental pulls: per study & iteration the last pulled ObjectId and the complete gameIDs"""
+    path = os.path.join(cache_dir,'high_water_marks.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_high_water_marks(state):
+    make_dir_if_not_exists(cache_dir)
+    path = os.path.join(cache_dir,'high_water_marks.json')
+    with open(path+'.tmp','w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(path+'.tmp', path)
+
+def get_dfs_from_mongo_incremental(study,bucket_name,stim_version,iterationName,database_name='human_physics_benchmarking',overlap_seconds=300,client=None):
+    """Like get_dfs_from_mongo, but only fetches the documents inserted since the last run of this function for that study and iteration.
+
+    New documents are merged into a local store of the raw responses (in cache_dir). Completeness is only rechecked for the games that received new
+    documents and the per stim accuracy is only recomputed for the stimuli whose set of responses changed. Exclusions are recomputed over all
+    participants, since the accuracy and RT thresholds depend on the whole scenario. To guard against documents with slightly out of order ObjectIds,
+    the last `overlap_seconds` before the high water mark are fetched again and deduplicated. Only the ANALYSIS_FIELDS are pulled and stored."""
+    from bson.objectid import ObjectId
+    client = client or conn
+    key = '{}-{}'.format(study,iterationName)
+    store_path = os.path.join(make_dir_if_not_exists(cache_dir),'raw_responses-{}.parquet'.format(key))
+    state = load_high_water_marks()
+    study_state = state.get(key, {})
+    start = time.time()
+
+    coll = client[database_name][study]
+    stim_coll = client['stimuli'][bucket_name+'_'+stim_version]
+    stim_df = pd.DataFrame(stim_coll.find({}, projection={'stims' : 1, 'games' : 1}))
+    query = {
+            'iterationName':iterationName,
+            'prolificID': {'$exists' : True},
+            'studyID': {'$exists' : True},
+            'sessionID': {'$exists' : True},
+    }
+    incremental = 'last_id' in study_state and os.path.exists(store_path)
+    if incremental:
+        since = ObjectId(study_state['last_id']).generation_time - datetime.timedelta(seconds=overlap_seconds)
+        query['_id'] = {'$gt' : ObjectId.from_datetime(since)}
+        stored = pd.read_parquet(store_path)
+    else:
+        stored = None
+
+    # fetch the delta and merge it into the local store
+    fields = dict(ANALYSIS_FIELDS, _id='string')
+    batches = list(iter_mongo_batches(coll, query, fields=fields))
+    new = pd.concat(batches, ignore_index=True) if len(batches) > 0 else typed_batch([], fields)
+    if stored is not None:
+        new = new[~new['_id'].isin(stored['_id'])]
+        merged = pd.concat([stored, new], ignore_index=True)
+    else:
+        merged = new
+    print("Fetched {} new documents for {} in {:.1f}s".format(len(new), key, time.time()-start))
+    if incremental and len(new) == 0:
+        print("Nothing new for {}.".format(key))
+        return
+    assert len(merged)>0, "df from mongo empty"
+    merged.to_parquet(store_path)
+    df = typed_to_objects(merged)
+
+    # only the games with new entries can change their completeness
+    affected_games = set(new['gameID'].dropna())
+    if incremental:
+        complete_gameids = [g for g in study_state.get('complete_gameids', []) if g not in affected_games]
+        complete_gameids += get_complete_gameids(df[df['gameID'].isin(affected_games)], stim_df)
+    else:
+        complete_gameids = get_complete_gameids(df, stim_df)
+
+    df_trial_entries, df_familiarization_entries = split_dataframes(df, study, complete_gameids)
+
+    # only recompute the accuracy of stims whose set of responses changed (new games, or games (un)excluded)
+    trial_path = os.path.join(csv_dir,"human_responses-{}-{}.csv".format(study,iterationName))
+    acc_path = os.path.join(csv_dir,"human_accuracy-{}-{}.csv".format(study,iterationName))
+    per_stim_agg = None
+    if incremental and os.path.exists(trial_path) and os.path.exists(acc_path):
+        old_entries = pd.read_csv(trial_path, usecols=['gameID','stim_ID'])
+        old_pairs = set(zip(old_entries['gameID'], old_entries['stim_ID']))
+        new_pairs = set(zip(df_trial_entries['gameID'], df_trial_entries['stim_ID']))
+        changed_stims = {stim_ID for _, stim_ID in old_pairs ^ new_pairs}
+        old_agg = pd.read_csv(acc_path, index_col='stim_ID')
+        per_stim_agg = pd.concat([
+            old_agg.drop(index=[s for s in changed_stims if s in old_agg.index]),
+            get_per_stim_accuracy(df_trial_entries[df_trial_entries['stim_ID'].isin(changed_stims)])
+        ]).sort_index()
+        print("Recomputed accuracy for {} of {} stims".format(len(changed_stims), len(per_stim_agg)))
+
+    save_dfs(study, iterationName, df_trial_entries, df_familiarization_entries, per_stim_agg=per_stim_agg)
+
+    # advance the high water mark only once everything has been written
+    with high_water_marks_lock: # other studies may be updating the state concurrently
+        state = load_high_water_marks()
+        state[key] = {'last_id' : str(merged['_id'].max()), 'complete_gameids' : list(complete_gameids)}
+        save_high_water_marks(state)
+    print("Updated {} in {:.1f}s".format(key, time.time()-start))
+
+def get_all_dfs_from_mongo(iterations=neurips2021_iterations, max_workers=None, retries=2, incremental=False, **pull_kwargs):
+    """Pulls and saves several studies concurrently, sharing the connection pool of the global MongoClient.
+
+    Each study runs in its own thread and is retried up to `retries` times (with backoff) on connection errors. A failing study does not stop the others.
+    Returns a dict mapping each study to None on success or to the exception that made it fail."""
+    def run(it_fields):
+        for attempt in range(retries+1):
+            try:
+                start = time.time()
+                if incremental:
+                    get_dfs_from_mongo_incremental(**it_fields, **pull_kwargs)
+                else:
+                    get_dfs_from_mongo(**it_fields, **pull_kwargs)
+                return time.time() - start
+            except pm.errors.PyMongoError as e:
+                if attempt == retries:
+                    raise
+                print("{}: attempt {} failed ({}), retrying".format(it_fields['study'], attempt+1, e))
+                time.sleep(2**attempt)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(iterations)) as executor:
+        futures = {executor.submit(run, it_fields) : it_fields['study'] for it_fields in iterations}
+        with tqdm(total=len(futures), desc="studies") as pbar:
+            for future in as_completed(futures):
+                study = futures[future]
+                try:
+                    elapsed = future.result()
+                    results[study] = None
+                    pbar.write("{} done in {:.1f}s".format(study, elapsed))
+                except Exception as e:
+                    results[study] = e
+                    pbar.write("ERROR: {} failed: {!r}".format(study, e))
+                pbar.update(1)
+    failed = [study for study, e in results.items() if e is not None]
+    if len(failed) > 0:
+        print("{} of {} studies failed: {}".format(len(failed), len(results), ", ".join(failed)))
+    return results
+
 if __name__ == "__main__":
-    print("Fetching neurIPS 2021 results")
-    for i,it_fields in enumerate(neurips2021_iterations):
-        print("Fetching",i+1,"from",len(neurips2021_iterations),"—",it_fields['study'])
-        get_dfs_from_mongo(**it_fields)
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--incremental', action='store_true', help='only fetch and merge the documents added since the last incremental run')
+    parser.add_argument('--workers', type=int, default=len(neurips2021_iterations), help='number of studies to pull concurrently (1 pulls them one after another)')
+    parser.add_argument('--retries', type=int, default=2, help='how often to retry a study after a connection error')
+    args = parser.parse_args()
+    print("Fetching neurIPS 2021 results" + (" (incremental)" if args.incremental else ""))
+    get_all_dfs_from_mongo(neurips2021_iterations, max_workers=args.workers, retries=args.retries, incremental=args.incremental)
     print("Done.")
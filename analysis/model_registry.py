@@ -0,0 +1,155 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+from analysis_helpers import MODEL_COLS
+
+'''
+Registry of the models in the results: a small table that gives every unique combination of MODEL_COLS an integer
+model_id. Large tables (e.g. the per-stimulus model predictions) can then carry only the model_id instead of the
+model columns, including the long ModelID and Model Kind strings, and group by it. The model columns are joined back
+when needed.
+
+The registry is kept as a csv. Ids that have been handed out are never changed, and new models get the next free
+ids, so the ids stay the same when the results are refreshed.
+
+To register the models of some result csvs, run:
+python model_registry.py --path_to_data=../results/csv/summary/model_human_accuracies.csv
+
+In a notebook, e.g.:
+MD, registry = intern_models(MD)
+MD.groupby('model_id')['correct'].mean()
+join_model_fields(MD, registry, cols=['Model Kind'])
+'''
+
+REGISTRY_PATH = '../results/csv/summary/model_registry.csv'
+ID_COL = 'model_id'
+
+
+def canonical_model_fields(df):
+    '''
+    input: dataframe with all MODEL_COLS
+    output: dataframe of MODEL_COLS as strings, so that the same model gets the same key no matter how the csv it
+        came from was parsed: missing values become '' and integral floats lose their '.0' (seed 0.0 == seed 0)
+    '''
+    missing = [col for col in MODEL_COLS if col not in df.columns]
+    if len(missing) > 0:
+        raise ValueError("Missing model columns: {}".format(missing))
+    fields = {}
+    for col in MODEL_COLS:
+        codes, uniques = pd.factorize(df[col])
+        labels = np.empty(len(uniques) + 1, dtype=object)
+        labels[:-1] = [canonical_value(u) for u in uniques]
+        labels[-1] = ''  # code -1, missing values
+        fields[col] = labels[codes]
+    return pd.DataFrame(fields, index=df.index)
+
+
+def canonical_value(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def load_model_registry(path_to_registry=REGISTRY_PATH):
+    '''
+    output: registry dataframe with columns model_id and MODEL_COLS (empty if there is no registry yet)
+    '''
+    if not os.path.exists(path_to_registry):
+        return pd.DataFrame({col: pd.Series([], dtype=np.int64 if col == ID_COL else object)
+                             for col in [ID_COL] + MODEL_COLS})
+    return pd.read_csv(path_to_registry, dtype={col: str for col in MODEL_COLS}, keep_default_na=False)
+
+
+def save_model_registry(registry, path_to_registry=REGISTRY_PATH):
+    if os.path.dirname(path_to_registry) != '':
+        os.makedirs(os.path.dirname(path_to_registry), exist_ok=True)
+    # write to a temporary file first so that an interrupted save does not lose ids
+    tmp_path = path_to_registry + '.tmp'
+    registry.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path_to_registry)
+
+
+def register_models(df, registry=None, path_to_registry=REGISTRY_PATH, save=True):
+    '''
+    input:
+        df: dataframe with all MODEL_COLS
+        registry: registry to add to (loaded from path_to_registry if None)
+        save: write the updated registry back to path_to_registry
+    output:
+        (model ids of the rows of df, updated registry). Models that are not in the registry yet get the next
+        free ids, in sorted order of their model columns so that the ids do not depend on the order of the rows.
+    '''
+    if registry is None:
+        registry = load_model_registry(path_to_registry)
+    fields = canonical_model_fields(df)
+    key_index = pd.MultiIndex.from_frame(registry[MODEL_COLS])
+    row_index = pd.MultiIndex.from_frame(fields)
+    ids = key_index.get_indexer(row_index)
+
+    new = ids == -1
+    if new.any():
+        new_models = fields[new].drop_duplicates().sort_values(MODEL_COLS)
+        next_id = registry[ID_COL].max() + 1 if len(registry) > 0 else 0
+        new_models.insert(0, ID_COL, np.arange(next_id, next_id + len(new_models)))
+        registry = pd.concat([registry, new_models], ignore_index=True)
+        if save:
+            save_model_registry(registry, path_to_registry)
+        key_index = pd.MultiIndex.from_frame(registry[MODEL_COLS])
+        ids = key_index.get_indexer(row_index)
+    model_ids = registry[ID_COL].values[ids]
+    return model_ids, registry
+
+
+def intern_models(df, registry=None, path_to_registry=REGISTRY_PATH, drop=True, save=True):
+    '''
+    input: dataframe with all MODEL_COLS
+    output: (dataframe with a model_id column instead of the MODEL_COLS (kept if drop=False), updated registry)
+    '''
+    model_ids, registry = register_models(df, registry, path_to_registry, save=save)
+    if drop:
+        df = df.drop(columns=MODEL_COLS)
+    else:
+        df = df.copy()
+    df.insert(0, ID_COL, model_ids.astype(np.int32))
+    return df, registry
+
+
+def join_model_fields(df, registry=None, cols=None, path_to_registry=REGISTRY_PATH):
+    '''
+    input:
+        df: dataframe with a model_id column
+        registry: registry the ids come from (loaded from path_to_registry if None)
+        cols: which model columns to add (all MODEL_COLS if None)
+    output:
+        df with the model columns added as categoricals
+    '''
+    if registry is None:
+        registry = load_model_registry(path_to_registry)
+    if cols is None:
+        cols = MODEL_COLS
+    positions = pd.Index(registry[ID_COL]).get_indexer(df[ID_COL])
+    if (positions == -1).any():
+        raise KeyError("model ids not in the registry: {}".format(sorted(set(df[ID_COL][positions == -1]))))
+    df = df.copy()
+    for col in cols:
+        values = registry[col].astype('category')
+        df[col] = pd.Categorical.from_codes(values.cat.codes.values[positions], values.cat.categories)
+    return df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path_to_data', type=str, nargs='+', help='result csvs with the model columns',
+                        default=['../results/csv/summary/model_human_accuracies.csv'])
+    parser.add_argument('--path_to_registry', type=str, help='registry csv to update', default=REGISTRY_PATH)
+    args = parser.parse_args()
+
+    registry = load_model_registry(args.path_to_registry)
+    num_before = len(registry)
+    for path_to_csv in args.path_to_data:
+        _, registry = register_models(pd.read_csv(path_to_csv), registry, args.path_to_registry)
+    print('Registry {} has {} models ({} new)'.format(args.path_to_registry, len(registry), len(registry) - num_before))
@@ -0,0 +1,161 @@
+import os
+import shutil
+import argparse
+from glob import glob
+import numpy as np
+import pandas as pd
+
+from analysis_helpers import MODEL_COLS, DATASET_ABSTRACTED_COLS
+
+'''
+Typed, columnar (parquet) copy of the csvs in results/csv. Each csv becomes a table that is partitioned by scenario
+and iteration (and by Model for the model results), so that loading only some scenarios, models or columns only reads
+those files.
+
+To build the store from the csvs, run:
+python result_store.py --path_to_data=../results/csv/ --path_to_store=../results/parquet/
+
+To load from it, e.g.:
+load_results('model_human_accuracies', scenarios=['dominoes'], columns=['Model Kind', 'model_correct'])
+'''
+
+# columns that the tables are partitioned by, if present
+PARTITION_COLS = ['scenario', 'iterationName', 'Model']
+
+
+def get_table_name(path_to_csv):
+    '''
+    human_responses-dominoes_pilot-production_1_testing.csv -> (human_responses, dominoes, production_1_testing)
+    model_human_accuracies.csv -> (model_human_accuracies, None, None)
+    '''
+    stem = os.path.splitext(os.path.basename(path_to_csv))[0]
+    parts = stem.split('-')
+    if len(parts) > 1:
+        return parts[0], parts[1].split('_')[0], '-'.join(parts[2:]) or None
+    return stem, None, None
+
+
+def get_partition_dir(table_dir, scenario, iteration):
+    # directory of the rows of one csv in a partitioned table
+    if iteration is None:
+        return os.path.join(table_dir, 'scenario={}'.format(scenario))
+    return os.path.join(table_dir, 'scenario={}'.format(scenario), 'iterationName={}'.format(iteration))
+
+
+def to_categoricals(df):
+    '''
+    store the model identifying columns and all other string columns as categoricals
+    '''
+    for col in df.columns:
+        if col in MODEL_COLS + DATASET_ABSTRACTED_COLS or df[col].dtype == object:
+            values = df[col]
+            if values.dtype == object:
+                # parquet needs categories of a single type
+                values = values.where(values.isna(), values.astype(str))
+            df[col] = values.astype('category')
+    return df
+
+
+def csv_to_table(path_to_csv, path_to_store):
+    '''
+    convert one csv into a partitioned table of the store, replacing the partition of its scenario and iteration if
+    it exists
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table_name, scenario, iteration = get_table_name(path_to_csv)
+    df = pd.read_csv(path_to_csv)
+    df = df.drop(columns=[c for c in df.columns if c.startswith('Unnamed: ')])
+    if scenario is not None:
+        df['scenario'] = scenario
+    if iteration is not None:
+        df['iterationName'] = iteration
+    df = to_categoricals(df)
+    partition_cols = [c for c in PARTITION_COLS if c in df.columns]
+
+    table_dir = os.path.join(path_to_store, table_name)
+    if scenario is not None:
+        target = get_partition_dir(table_dir, scenario, iteration)
+    else:
+        target = table_dir
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    if scenario is not None and iteration is not None:
+        # files of the scenario from before it was partitioned by iteration
+        for path in glob(os.path.join(table_dir, 'scenario={}'.format(scenario), '*.parquet')):
+            os.remove(path)
+    os.makedirs(table_dir, exist_ok=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if len(partition_cols) > 0:
+        pq.write_to_dataset(table, table_dir, partition_cols=partition_cols)
+    else:
+        pq.write_table(table, os.path.join(table_dir, 'part-0.parquet'))
+    return table_name
+
+
+def build_result_store(path_to_data='../results/csv/', path_to_store='../results/parquet/'):
+    '''
+    convert every csv under path_to_data into the store at path_to_store
+    '''
+    csv_paths = sorted([y for x in os.walk(path_to_data) for y in glob(os.path.join(x[0], '*.csv'))])
+    # each csv replaces its partition, so two csvs with the same one would silently drop the rows of the first
+    partitions = {}
+    for path_to_csv in csv_paths:
+        key = get_table_name(path_to_csv)
+        if key in partitions:
+            raise ValueError("{} and {} map to the same table and partition {}".format(
+                partitions[key], path_to_csv, key))
+        partitions[key] = path_to_csv
+    tables = set()
+    for path_to_csv in csv_paths:
+        tables.add(csv_to_table(path_to_csv, path_to_store))
+    return sorted(tables)
+
+
+def scan_results(table_name, path_to_store='../results/parquet/'):
+    '''
+    lazily open a table of the store as a pyarrow dataset, nothing is read until it is queried
+    '''
+    import pyarrow.dataset as ds
+    return ds.dataset(os.path.join(path_to_store, table_name), format='parquet',
+                      partitioning=ds.HivePartitioning.discover(infer_dictionary=True))
+
+
+def load_results(table_name, scenarios=None, models=None, columns=None, filter=None, path_to_store='../results/parquet/',
+                 iterations=None):
+    '''
+    input:
+        table_name: e.g. model_human_accuracies or human_responses
+        scenarios: list of scenarios to load (all if None)
+        iterations: list of iterations (iterationName) to load, for the tables of human data (all if None)
+        models: list of values of the Model column to load (all if None)
+        columns: list of columns to load (all if None)
+        filter: additional pyarrow.dataset expression, e.g. pyarrow.dataset.field('Readout Type') == 'A'
+    output:
+        dataframe with categorical model columns. Only the partitions and row groups that match the filters are read.
+    '''
+    import pyarrow.dataset as ds
+    dataset = scan_results(table_name, path_to_store=path_to_store)
+    expression = None
+    if scenarios is not None:
+        expression = ds.field('scenario').isin(list(scenarios))
+    if iterations is not None:
+        iteration_expression = ds.field('iterationName').isin(list(iterations))
+        expression = iteration_expression if expression is None else expression & iteration_expression
+    if models is not None:
+        model_expression = ds.field('Model').isin(list(models))
+        expression = model_expression if expression is None else expression & model_expression
+    if filter is not None:
+        expression = filter if expression is None else expression & filter
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path_to_data', type=str, help='path to the result csvs', default='../results/csv/')
+    parser.add_argument('--path_to_store', type=str, help='where to write the parquet store', default='../results/parquet/')
+    args = parser.parse_args()
+
+    tables = build_result_store(args.path_to_data, args.path_to_store)
+    print('Wrote {} tables to {}: {}'.format(len(tables), args.path_to_store, ', '.join(tables)))
@@ -1,32 +1,20 @@
-import os
-import boto3
+import os, sys
 import botocore
 import argparse
-from glob import glob
-import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stimuli'))
+from s3_sync import get_client, collect_local_files, list_remote, plan_sync, print_plan, run_sync, print_stats
 
 '''
 To upload results, run:
 python upload_results.py --path_to_data=../results/csv/ --bucket_name=physics-benchmarking-results
 
-'''
+To upload the parquet result store (see result_store.py), run:
+python upload_results.py --path_to_data=../results/parquet/ --ext=parquet --bucket_name=physics-benchmarking-results
 
-def check_exists(s3, bucket_name, filename):
-    '''
-    helper to speed things up by not uploading images if they already exist, can be overriden 
-    '''
-    try:
-        s3.Object(bucket_name,filename).load()    
-        return True
-    except botocore.exceptions.ClientError as e:    
-        if (e.response['Error']['Code'] == "404"):
-            print('The object does not exist.')
-            return False
-        else:
-            print('Something else has gone wrong with {}'.format(filename))
-
-def list_files(path, ext = 'npy'):
-    return [y for x in os.walk(path) for y in glob(os.path.join(x[0], '*.{}'.format(ext) ))]
+Only files that are not in the bucket yet or differ from it (by size and MD5) are uploaded.
+To see what would be uploaded without uploading, pass --dry_run=True.
+'''
 
 def str2bool(v):
     return v.lower() in ("yes", "true", "t", "1", "True", "TRUE")        
@@ -38,11 +26,14 @@ if __name__ == "__main__":
     parser.add_argument('--bucket_name', type=str, help='bucket_name', default='physics-benchmarking-results')
     parser.add_argument('--overwrite', type=str2bool, help='boolean flag to set to overwrite what is in S3 or not', default='False')
     parser.add_argument('--public_read', type=str2bool, help='boolean flag to set to publicly readable or not', default='False')
+    parser.add_argument('--ext', type=str, help='extension of the files to upload (csv, or parquet for the result store)', default='csv')
+    parser.add_argument('--dry_run', type=str2bool, help='boolean flag to only print what would be uploaded', default='False')
+    parser.add_argument('--workers', type=int, help='number of files to upload at the same time', default=16)
     args = parser.parse_args()
     
-    ## get list of paths to datafiles
-    csv_paths = list_files(args.path_to_data,ext='csv')
-    data_paths = csv_paths
+    ## get datafiles, keyed by the path relative to path_to_data, e.g. humans/human_accuracy-....csv or
+    ## model_human_accuracies/scenario=dominoes/Model=SVG/....parquet for the partitioned result store
+    local_files = collect_local_files(args.path_to_data, ext=args.ext)
 
     ## tell user some useful information
     print('Path to data is : {}'.format(args.path_to_data))
@@ -50,30 +41,32 @@ if __name__ == "__main__":
     print('Set ACL settings to public-read: {}'.format(args.public_read))
 
     ## establish connection to s3 
-    s3 = boto3.resource('s3')
+    client = get_client(args.workers)
 
     ## create a bucket with the appropriate bucket name
-    try: 
-        b = s3.create_bucket(Bucket=args.bucket_name) 
-        print('Created new bucket.')
-    except:
-        b = s3.Bucket(args.bucket_name)
-        print('Bucket already exists.')
+    if not args.dry_run:
+        try:
+            client.create_bucket(Bucket=args.bucket_name)
+            print('Created new bucket.')
+        except botocore.exceptions.ClientError:
+            print('Bucket already exists.')
 
-    ## set bucket and objects to public
-    if args.public_read==True:
-        b.Acl().put(ACL='public-read') ## sets bucket to public
+        ## set bucket and objects to public
+        if args.public_read==True:
+            client.put_bucket_acl(Bucket=args.bucket_name, ACL='public-read') ## sets bucket to public
 
-    ## now let's loop through data paths and actually upload to s3 
-    for i, path_to_file in enumerate(data_paths):
-        filename = path_to_file.split('/')[-1]
-        dirname = path_to_file.split('/')[-2]
-        keyname = os.path.join(dirname,filename)
+    ## compare with what is in the bucket (listed once)
+    try:
+        remote = list_remote(client, args.bucket_name)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchBucket':
+            raise
+        remote = {}
+    plan = plan_sync(local_files, remote, overwrite=args.overwrite)
+    print_plan(plan)
 
-        if ((check_exists(s3, args.bucket_name, keyname)==False) | (args.overwrite==True)):
-            print('Now uploading {} | {} of {}'.format(path_to_file.split('/')[-1],(i+1),len(data_paths)))
-            s3.Object(args.bucket_name,keyname).upload_file(path_to_file) ## upload data
-            if args.public_read==True:
-                s3.Object(args.bucket_name,keyname).Acl().put(ACL='public-read') ## set access controls
-        else: 
-            print('Skipping {} | {} of {} because it already exists.'.format(path_to_file.split('/')[-1],(i+1),len(data_paths)))
\ No newline at end of file
+    ## upload what is new or changed, setting access controls in the same request
+    if not args.dry_run:
+        stats = run_sync(client, args.bucket_name, plan, acl='public-read' if args.public_read else None,
+                         workers=args.workers)
+        print_stats(stats)
@@ -1,36 +1,265 @@
 import requests
 import tarfile
+import hashlib
+import threading
+import time
 import os
+import shutil
+import zlib
+from urllib3.exceptions import HTTPError as ConnectionHTTPError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
 
-def download_file(scenarios, types):
-    # This function is used to download dataset into corresponding folders
+# define some data root directory
+URL_BASE = "https://physics-benchmarking-neurips2021-dataset.s3.amazonaws.com/"
+DIR_BASE = "./physion_train/"
+CHUNK_SIZE = 2**20
 
-    # define some data root directory
-    url_base = "https://physics-benchmarking-neurips2021-dataset.s3.amazonaws.com/"
-    dir_base = "./physion_train/"
+
+class ArchiveReader(object):
+    '''
+    File-like object over an archive that is being downloaded: it first reads the part of the archive that is
+    already on disk, then the rest from the response (None if the part is complete), which it appends to the file on
+    disk. Everything that is read goes into an MD5, so the archive can be checked once tarfile is done with it.
+    '''
+    def __init__(self, part_path, response, progress=None):
+        self.local = open(part_path, 'rb') if os.path.getsize(part_path) > 0 else None
+        self.out = open(part_path, 'ab')
+        self.response = response
+        self.progress = progress
+        self.md5 = hashlib.md5()
+        self.num_bytes = 0  # bytes read from the response
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = CHUNK_SIZE
+        if self.local is not None:
+            data = self.local.read(size)
+            if data:
+                self.md5.update(data)
+                return data
+            self.local.close()
+            self.local = None
+        if self.response is None:
+            return b''
+        data = self.response.raw.read(size, decode_content=False)
+        if data:
+            self.out.write(data)
+            self.md5.update(data)
+            self.num_bytes += len(data)
+            if self.progress is not None:
+                self.progress(len(data))
+        return data
+
+    def drain(self):
+        # read what tarfile left after the end of the archive, so that the whole file is saved and hashed
+        while self.read(CHUNK_SIZE):
+            pass
+
+    def close(self):
+        if self.local is not None:
+            self.local.close()
+        self.out.close()
+
+
+def safe_members(archive, dir_file):
+    # do not write outside of dir_file, e.g. for member names like ../../x or /x
+    root = os.path.realpath(dir_file)
+    for member in archive:
+        target = os.path.realpath(os.path.join(root, member.name))
+        if os.path.commonpath([root, target]) != root or member.issym() or member.islnk():
+            raise ValueError("Refusing to extract {} outside of {}".format(member.name, dir_file))
+        yield member
+
+
+def move_into(src_dir, dst_dir):
+    # move the extracted files of src_dir into dst_dir (replacing files that are there), then remove src_dir
+    for root, dirs, files in os.walk(src_dir):
+        target = os.path.join(dst_dir, os.path.relpath(root, src_dir))
+        os.makedirs(target, exist_ok=True)
+        for name in files:
+            os.replace(os.path.join(root, name), os.path.join(target, name))
+    shutil.rmtree(src_dir)
+
+
+def get_expected_md5(response, dataset, checksums=None):
+    '''
+    MD5 that the archive has to have: from checksums if given, else from the ETag of the response if the
+    archive was not uploaded in parts (then the ETag is the MD5 of the content), else None
+    '''
+    if checksums is not None and dataset in checksums:
+        return checksums[dataset]
+    etag = response.headers.get('ETag', '').strip('"')
+    if len(etag) == 32 and '-' not in etag:
+        return etag
+    return None
+
+
+def download_archive(url, dir_file, part_path, checksums=None, progress=None, add_total=None, timeout=60):
+    '''
+    download the archive at url into part_path (resuming from what is already there with an HTTP range request)
+    while extracting it into dir_file. Returns (bytes downloaded, md5 of the archive).
+    The archive is extracted into a sibling of dir_file first and its files are only moved into dir_file once its
+    size and checksum are right.
+    '''
+    dataset = url.split('/')[-1]
+    etag_path = part_path + '.etag'
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {}
+    if offset > 0 and os.path.exists(etag_path):
+        # only resume if the archive did not change since the part was downloaded
+        with open(etag_path) as f:
+            headers = {'Range': 'bytes={}-'.format(offset), 'If-Range': f.read()}
+
+    response = requests.get(url, stream=True, headers=headers, timeout=timeout)
+    stream = response
+    if response.status_code == 416 and 'Range' in headers:
+        # nothing after offset: the part is complete (e.g. extracting it was interrupted), or it is not a part of
+        # the archive at all. Only the first is worth keeping, and only if the archive did not change since.
+        response.close()
+        response = requests.head(url, timeout=timeout)
+        total = int(response.headers.get('Content-Length', -1))
+        if response.status_code != 200 or total != offset or response.headers.get('ETag') != headers['If-Range']:
+            os.remove(part_path)
+            return download_archive(url, dir_file, part_path, checksums, progress, add_total, timeout)
+        stream = None
+    elif response.status_code == 200:
+        # whole archive (no resume, or the server did not honor the range)
+        open(part_path, 'wb').close()
+        total = int(response.headers.get('Content-Length', 0))
+    elif response.status_code == 206:
+        total = int(response.headers['Content-Range'].split('/')[-1])
+    else:
+        response.close()
+        raise requests.HTTPError("Downloading {} failed with status {}".format(url, response.status_code), response=response)
+    if 'ETag' in response.headers:
+        with open(etag_path, 'w') as f:
+            f.write(response.headers['ETag'])
+    if add_total is not None:
+        add_total(total - os.path.getsize(part_path))
+
+    staging_dir = os.path.normpath(dir_file) + '.' + dataset + '.extracting'
+    if os.path.exists(staging_dir):
+        shutil.rmtree(staging_dir)
+    reader = ArchiveReader(part_path, stream, progress)
+    try:
+        try:
+            with tarfile.open(fileobj=reader, mode="r|gz") as archive:
+                archive.extractall(path=staging_dir, members=safe_members(archive, staging_dir))
+            reader.drain()
+        finally:
+            reader.close()
+            response.close()
+
+        size = os.path.getsize(part_path)
+        if total > 0 and size != total:
+            raise IOError("{} has {} bytes, expected {}".format(dataset, size, total))
+        md5 = reader.md5.hexdigest()
+        expected = get_expected_md5(response, dataset, checksums)
+        if expected is not None and md5 != expected:
+            os.remove(part_path)
+            raise IOError("Checksum of {} is {}, expected {}".format(dataset, md5, expected))
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    move_into(staging_dir, dir_file)
+    return reader.num_bytes, md5
+
+
+def download_file(scenarios, types, url_base=URL_BASE, dir_base=DIR_BASE, workers=4, retries=3,
+                  checksums=None, overwrite=False, keep_archives=False):
+    '''
+    This function is used to download dataset into corresponding folders:
+    {dir_base}/{type}/{scenario}/ gets the content of {url_base}{scenario}_{type}_HDF5s.tar.gz
+
+    input:
+        workers: number of archives to download (and decompress) at the same time
+        retries: how often to retry an archive; retries resume the download where it stopped
+        checksums: optional dict of archive name -> MD5. Without it, archives are checked against their ETag
+            where that is an MD5
+        overwrite: download archives again even if they were extracted before
+        keep_archives: keep the .tar.gz files (in dir_base/archives) after extracting them
+    output:
+        dict of archive name -> error for the archives that failed
+    '''
+    archive_dir = os.path.join(dir_base, 'archives')
+    os.makedirs(archive_dir, exist_ok=True)
+    jobs = []
     for s in scenarios:
         for t in types:
             dataset = s + "_" + t  + "_HDF5s.tar.gz"
-            url = url_base + dataset
-            dir_file = dir_base + t + "/" + s + "/" 
-            # dir_target = dir_file + dataset
-            
-            # Check whether the specified path exists or not
-            isExist = os.path.exists(dir_file)
-
-            if not isExist:
-                # Create a new directory because it does not exist 
-                os.makedirs(dir_file)
-            
-            print("Downloading from " + url)
-            print("Moving file to and decompressing in " + dir_file)
+            dir_file = os.path.join(dir_base, t, s) + "/"
+            done_path = os.path.join(dir_file, '.' + dataset + '.done')
+            if not overwrite and os.path.exists(done_path):
+                print("Already extracted " + dataset)
+                continue
+            jobs.append((dataset, url_base + dataset, dir_file, done_path))
+
+    lock = threading.Lock()
+    progress = tqdm(total=0, unit='B', unit_scale=True, unit_divisor=1024)
 
-            # download & decompress
-            response = requests.get(url, stream=True)
-            
-            if response.status_code == 200:
-                file = tarfile.open(fileobj=response.raw, mode="r|gz")
-                file.extractall(path=dir_file)
+    def add_total(num_bytes):
+        with lock:
+            progress.total += num_bytes
+            progress.refresh()
 
-            print("Complete.")
-        print("All downloads complete!")
+    def update(num_bytes):
+        with lock:
+            progress.update(num_bytes)
+
+    def run(dataset, url, dir_file, done_path):
+        os.makedirs(dir_file, exist_ok=True)
+        part_path = os.path.join(archive_dir, dataset + '.part')
+        start = time.time()
+        num_bytes = 0
+        counted = []
+
+        def add_total_once(num_bytes):
+            # retries resume the same archive, it only counts towards the total once
+            if not counted:
+                counted.append(True)
+                add_total(num_bytes)
+
+        for attempt in range(retries + 1):
+            try:
+                n, md5 = download_archive(url, dir_file, part_path, checksums, update, add_total_once)
+                num_bytes += n
+                break
+            except (requests.RequestException, ConnectionHTTPError, IOError, EOFError, zlib.error, tarfile.TarError) as e:
+                if attempt == retries or (isinstance(e, requests.HTTPError) and e.response is not None
+                                          and e.response.status_code in (403, 404)):
+                    raise
+                tqdm.write("Retrying {} ({})".format(dataset, e))
+                time.sleep(2**attempt)
+        if keep_archives:
+            os.replace(part_path, os.path.join(archive_dir, dataset))
+        else:
+            os.remove(part_path)
+        if os.path.exists(part_path + '.etag'):
+            os.remove(part_path + '.etag')
+        with open(done_path, 'w') as f:
+            f.write(md5)
+        seconds = time.time() - start
+        tqdm.write("Complete: {} -> {} ({:.1f} MB in {:.0f}s, {:.1f} MB/s)".format(
+            dataset, dir_file, num_bytes / 1e6, seconds, num_bytes / 1e6 / max(seconds, 1e-9)))
+        return num_bytes
+
+    start = time.time()
+    total_bytes, failed = 0, {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for dataset, url, dir_file, done_path in jobs:
+            print("Downloading from " + url)
+            print("Moving file to and decompressing in " + dir_file)
+            futures[executor.submit(run, dataset, url, dir_file, done_path)] = dataset
+        for future in as_completed(futures):
+            try:
+                total_bytes += future.result()
+            except Exception as e:
+                tqdm.write("Failed: {} ({})".format(futures[future], e))
+                failed[futures[future]] = e
+    progress.close()
+    seconds = time.time() - start
+    print("All downloads complete! {} archives, {:.1f} MB in {:.0f}s ({:.1f} MB/s), {} failed".format(
+        len(jobs) - len(failed), total_bytes / 1e6, seconds, total_bytes / 1e6 / max(seconds, 1e-9), len(failed)))
+    return failed
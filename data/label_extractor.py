@@ -0,0 +1,167 @@
+import os
+import csv
+import time
+import argparse
+import h5py
+import numpy as np
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+
+'''
+Extracts the ground truth readout labels (whether the target touches the zone in any frame) from the HDF5s of a
+dataset, e.g. to make readout_labels.csv (see extract_labels.ipynb):
+
+python label_extractor.py --data_path /data5/eliwang/physion_data/readout_train_redyellow --output readout_labels.csv
+
+Files are read by a pool of processes and stop being read at the first frame where the label is true. The labels
+are cached in a csv next to the output (key: path, label, mtime and size of the file), so that when files are added or
+regenerated only those are read again.
+'''
+
+LABEL = 'target_contacting_zone'
+FILE_PATTERN = '*/*.hdf5'  # [DATA_PATH]/[SCENARIO]/[STIM_NAME].hdf5
+HEADER = [None, 'ground truth outcome']
+CACHE_FIELDS = ['path', 'label', 'mtime_ns', 'size', 'positive', 'first_frame']
+CACHE_SAVE_INTERVAL = 500  # save the cache after this many new files
+# per-frame labels written with --consolidated_labels (see stimuli/generation/controllers/frame_labels.py)
+CONSOLIDATED_LABELS_GROUP = 'frame_labels'
+CONSOLIDATED_FRAMES_SUFFIX = '.frames'
+
+
+def get_first_positive_frame(path, label=LABEL):
+    '''
+    output: number of the first frame where frames/<frame>/labels/<label> (or frame_labels/<label> in files with
+        consolidated labels) is true, or None if it is never true
+    '''
+    with h5py.File(path, 'r') as f:
+        if CONSOLIDATED_LABELS_GROUP in f:
+            group = f[CONSOLIDATED_LABELS_GROUP]
+            values = group[label][()]
+            if label + CONSOLIDATED_FRAMES_SUFFIX in group:
+                frames = group[label + CONSOLIDATED_FRAMES_SUFFIX][()]
+            else:
+                frames = np.arange(len(values))
+            positive = frames[values.reshape(len(values), -1).any(axis=1)]
+            return int(positive[0]) if len(positive) > 0 else None
+        value = None
+        for frame_num, key in enumerate(sorted(f['frames'].keys())):
+            # the low-level read of the scalar is several times faster than frames[key]['labels'][label][()]
+            dataset = h5py.h5d.open(f.id, 'frames/{}/labels/{}'.format(key, label).encode())
+            if value is None:
+                value = np.empty(dataset.shape, dtype=dataset.dtype)
+            dataset.read(h5py.h5s.ALL, h5py.h5s.ALL, value)
+            if value.any():
+                return frame_num
+    return None
+
+
+def get_file_key(path, label=LABEL):
+    # what the cached label of a file depends on
+    stat = os.stat(path)
+    return (os.path.abspath(path), label, stat.st_mtime_ns, stat.st_size)
+
+
+def _extract(args):
+    path, label = args
+    return path, get_first_positive_frame(path, label)
+
+
+def load_label_cache(cache_path):
+    '''
+    output: dict of (absolute path, label, mtime_ns, size) -> first positive frame (None if there is none)
+    '''
+    cache = {}
+    if cache_path is None or not os.path.exists(cache_path):
+        return cache
+    with open(cache_path, newline='') as f:
+        reader = csv.DictReader(f)
+        # caches without the label name do not say which label they hold; they are read again
+        if 'positive' not in (reader.fieldnames or []):
+            return cache
+        for row in reader:
+            first_frame = int(row['first_frame']) if row['first_frame'] != '' else None
+            cache[(row['path'], row['label'], int(row['mtime_ns']), int(row['size']))] = first_frame
+    return cache
+
+
+def save_label_cache(cache, cache_path):
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(CACHE_FIELDS)
+        for (path, label, mtime_ns, size), first_frame in sorted(cache.items()):
+            writer.writerow([path, label, mtime_ns, size, first_frame is not None,
+                             '' if first_frame is None else first_frame])
+    os.replace(tmp_path, cache_path)
+
+
+def extract_labels(paths, label=LABEL, workers=None, cache_path=None):
+    '''
+    input:
+        paths: HDF5 files
+        label: per-frame label to extract
+        workers: number of processes (default: number of cpus)
+        cache_path: csv of the labels that were extracted before, updated with the new ones (None: no cache)
+    output:
+        dict of path -> first frame where the label is true (None if it is never true)
+    '''
+    cache = load_label_cache(cache_path)
+    keys = {path: get_file_key(path, label) for path in paths}
+    # entries of files that changed or were removed are dropped from the cache; those of other labels are kept
+    current = set(keys.values())
+    extracted = set(key[:2] for key in current)
+    cache = {key: first_frame for key, first_frame in cache.items()
+             if key in current or (key[:2] not in extracted and os.path.exists(key[0]))}
+    todo = [path for path in paths if keys[path] not in cache]
+    print('{} of {} files cached, reading {}'.format(len(paths) - len(todo), len(paths), len(todo)))
+
+    start = time.time()
+    if len(todo) > 0:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(_extract, [(path, label) for path in todo], chunksize=16)
+            for num_done, (path, first_frame) in enumerate(tqdm(results, total=len(todo), desc='Extracting labels: '), 1):
+                cache[keys[path]] = first_frame
+                if cache_path is not None and num_done % CACHE_SAVE_INTERVAL == 0:
+                    save_label_cache(cache, cache_path)
+        seconds = time.time() - start
+        print('Read {} files in {:.1f}s ({:.1f} files/s)'.format(len(todo), seconds, len(todo) / max(seconds, 1e-9)))
+    if cache_path is not None:
+        save_label_cache(cache, cache_path)
+    return {path: cache[keys[path]] for path in paths}
+
+
+def write_labels_csv(labels, output_filename):
+    '''
+    write readout_labels.csv: one row per file with the stimulus name (file name without extension) and whether
+    the label is true in any frame
+    '''
+    with open(output_filename, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(HEADER)
+        for path in sorted(labels):
+            stim_name = os.path.splitext(os.path.basename(path))[0]
+            writer.writerow([stim_name, labels[path] is not None])
+
+
+def get_cache_path(output_filename):
+    return os.path.join(os.path.dirname(os.path.abspath(output_filename)),
+                        '.' + os.path.splitext(os.path.basename(output_filename))[0] + '_cache.csv')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_path', type=str, required=True, help='directory of the dataset')
+    parser.add_argument('--file_pattern', type=str, default=FILE_PATTERN, help='pattern of the HDF5s in data_path')
+    parser.add_argument('--output', type=str, default='readout_labels.csv')
+    parser.add_argument('--label', type=str, default=LABEL, help='per-frame label to extract')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: number of cpus)')
+    parser.add_argument('--cache', type=str, default=None, help='label cache (default: .<output>_cache.csv next to output)')
+    parser.add_argument('--no_cache', action='store_true', help='read all files again')
+    args = parser.parse_args()
+
+    files = sorted(glob(os.path.join(args.data_path, args.file_pattern)))
+    cache_path = None if args.no_cache else (args.cache if args.cache is not None else get_cache_path(args.output))
+    labels = extract_labels(files, args.label, args.workers, cache_path)
+    write_labels_csv(labels, args.output)
+    print('Wrote {} labels ({} positive) to {}'.format(len(labels), sum(v is not None for v in labels.values()), args.output))
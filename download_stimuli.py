@@ -1,22 +1,35 @@
 import os, sys
+import json
+import random
+import hashlib
 import boto3
 import botocore
+from botocore.config import Config
 import argparse
 from glob import glob
 from tqdm import tqdm
 import pandas as pd
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 '''
-To download mp4s and cueing maps, call: 
+To download mp4s and cueing maps, call:
 
-python download_stimuli.py 
+python download_stimuli.py
 
 #######
 
 To download hdf5s, call:
 
 python download_stimuli.py --hdf5s
+
+#######
+
+Files are downloaded by --workers threads that share one S3 client. Files that are already on disk with the size
+and ETag of the object in the bucket are skipped, so an interrupted download can just be started again.
+
+The listing of each bucket is kept in a manifest in <path_to_data>/.manifests and only listed again once it is older
+than --manifest_max_age hours (or when --refresh_manifest is passed).
 '''
 
 SCENARIOS = ['dominoes', 'support', 'collide', 'contain',
@@ -36,6 +49,14 @@ OLD_TO_NEW_SCENARIO_NAMES = {
 NEW_TO_OLD_SCENARIO_NAMES = {
     v:k for k,v in OLD_TO_NEW_SCENARIO_NAMES.items()}
 
+# name of the file in each scenario directory that records the ETag of every downloaded file
+ETAGS_FILENAME = '.etags.json'
+# where the manifests of the buckets are kept, relative to --path_to_data
+MANIFEST_DIRNAME = '.manifests'
+MANIFEST_COLS = ['key', 'size', 'etag', 'last_modified', 'scenario', 'template', 'type', 'redyellow', 'stim_ID', 'role']
+# errors that will not go away by trying again
+PERMANENT_ERROR_CODES = ['404', 'NoSuchKey', 'NoSuchBucket', '403', 'AccessDenied']
+
 def get_args():
 
     parser = argparse.ArgumentParser()
@@ -59,75 +80,304 @@ def get_args():
     parser.add_argument('--overwrite',
                         action='store_true',
                         help='If passed, overwrite local stimuli')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=16,
+                        help='number of files to download at the same time')
+    parser.add_argument('--retries',
+                        type=int,
+                        default=3,
+                        help='how often to retry a failed download')
+    parser.add_argument('--refresh_manifest',
+                        action='store_true',
+                        help='If passed, list the buckets again even if the local manifests are recent')
+    parser.add_argument('--manifest_max_age',
+                        type=float,
+                        default=24,
+                        help='hours after which the local manifest of a bucket is refreshed')
 
     args = parser.parse_args()
     return args
 
+
+def get_bucket_name(sc, redyellow=False):
+    bsuffix = '' if not (sc == 'drape') else ('sagging' if redyellow else 'iness')
+    return 'human-physics-benchmarking-%s-pilot' % \
+        (NEW_TO_OLD_SCENARIO_NAMES[sc] + bsuffix + ('-redyellow' if redyellow else ''))
+
+
+def get_prefix(sc):
+    return 'pilot' if not sc == 'drape' else 'test'
+
+
+def list_objects(client, bucket_name, prefix=''):
+    '''
+    output: list of dicts with the key, size and ETag (without quotes) of every object in the bucket under prefix
+    '''
+    objects = []
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            objects.append({'key': obj['Key'], 'size': obj['Size'], 'etag': obj['ETag'].strip('"'),
+                            'last_modified': obj['LastModified'].isoformat()})
+    return objects
+
+
+def get_template_name(key):
+    template_name = key.split('_0')
+    if len(template_name) > 2:
+        template_name = '_0'.join(template_name[:-1])
+    else:
+        template_name = template_name[0]
+    return template_name
+
+
+def describe_object(obj, sc):
+    '''
+    add the fields that the objects are selected by to an object dict as returned by list_objects:
+    e.g. pilot_dominoes_0mid_d3chairs_o1plants_tdwroom_0001-redyellow_img.mp4 is the mp4 (type), img (role),
+    redyellow version of the stimulus pilot_dominoes_0mid_d3chairs_o1plants_tdwroom_0001 (stim_ID)
+    '''
+    key = obj['key']
+    name = ''.join(key.split('.')[0].split('-redyellow'))
+    role = ''
+    for suffix in ['_img', '_map']:
+        if name.endswith(suffix):
+            name, role = name[:-len(suffix)], suffix[1:]
+    return dict(obj, scenario=sc, template=get_template_name(key), type=key.split('.')[-1],
+                redyellow='redyellow' in key, stim_ID=name, role=role)
+
+
+def get_manifest_path(save_path, bucket_name, prefix):
+    return os.path.join(save_path, MANIFEST_DIRNAME, '{}-{}.csv'.format(bucket_name, prefix))
+
+
+def load_manifest(path):
+    '''
+    output: dict of the manifest rows by key, empty if there is no manifest yet
+    '''
+    if not os.path.exists(path):
+        return {}
+    manifest = pd.read_csv(path, dtype={'key': str, 'etag': str, 'stim_ID': str, 'template': str},
+                           keep_default_na=False)
+    return {row['key']: row for row in manifest.to_dict('records')}
+
+
+def save_manifest(path, manifest):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pd.DataFrame(list(manifest.values()), columns=MANIFEST_COLS).to_csv(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+
+
+def refresh_manifest(client, bucket_name, prefix, sc, save_path, max_age=24, force=False):
+    '''
+    input:
+        max_age: hours for which a saved manifest is used without listing the bucket again
+        force: list the bucket even if the saved manifest is recent
+    output:
+        dict of the manifest rows (see MANIFEST_COLS) of the objects in the bucket under prefix, by key.
+        When the bucket is listed, only new and changed objects (by ETag and size) get new rows.
+    '''
+    path = get_manifest_path(save_path, bucket_name, prefix)
+    manifest = load_manifest(path)
+    if len(manifest) > 0 and not force and (time.time() - os.path.getmtime(path)) < max_age * 3600:
+        print('Using manifest {} ({} objects)'.format(path, len(manifest)))
+        return manifest
+
+    listed = list_objects(client, bucket_name, prefix)
+    new_manifest, num_new, num_changed = {}, 0, 0
+    for obj in listed:
+        row = manifest.get(obj['key'])
+        if row is not None and row['etag'] == obj['etag'] and row['size'] == obj['size']:
+            new_manifest[obj['key']] = row
+            continue
+        num_new += row is None
+        num_changed += row is not None
+        new_manifest[obj['key']] = describe_object(obj, sc)
+    num_removed = len(set(manifest) - set(new_manifest))
+    save_manifest(path, new_manifest)
+    print('Refreshed manifest {}: {} objects ({} new, {} changed, {} removed)'.format(
+        path, len(new_manifest), num_new, num_changed, num_removed))
+    return new_manifest
+
+
+def select_stims(manifest, sc, stim_names, hdf5s=False, redyellow=False):
+    '''
+    keep only the objects of the requested type that have response data
+    input: manifest rows (as returned by refresh_manifest) and the stim_ID/scenario table of the benchmark stimuli
+    '''
+    sc_names = set(stim_names[stim_names['scenario'] == sc]['stim_ID'])
+    if hdf5s:
+        types, roles = {'hdf5'}, {''}
+    else:
+        types, roles = {'mp4', 'png'}, ({'img'} if redyellow else {'img', 'map'})
+    return [row for row in manifest.values()
+            if row['type'] in types and row['role'] in roles and bool(row['redyellow']) == redyellow
+            and row['stim_ID'] in sc_names]
+
+
+def get_save_dir(key, scenario_path, directory_per_template=False, redyellow=False):
+    template_name = get_template_name(key)
+    sv_dir = scenario_path if not directory_per_template else os.path.join(scenario_path, template_name)
+    sv_type = key.split('.')[-1]
+    sv_type = 'maps' if sv_type == 'png' else (sv_type + 's')
+    if redyellow:
+        sv_type += '-redyellow'
+    return os.path.join(sv_dir, sv_type)
+
+
+def file_md5(path, block_size=2**20):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def is_up_to_date(path, size, etag, known_etag=None):
+    '''
+    input:
+        path: local file
+        size, etag: size and ETag of the object in the bucket
+        known_etag: ETag of the object that the local file was downloaded from, if it was recorded
+    output:
+        whether the local file is the same as the object. The size has to match, and the ETag either has to match
+        the recorded one or, for objects that were not uploaded in parts (their ETag is the MD5 of the content),
+        the MD5 of the file. Files of multipart objects without a recorded ETag are checked by size only.
+    '''
+    if not os.path.exists(path) or os.path.getsize(path) != size:
+        return False
+    if known_etag is not None:
+        return known_etag == etag
+    if '-' in etag:
+        return True
+    return file_md5(path) == etag
+
+
+def load_etags(scenario_path):
+    path = os.path.join(scenario_path, ETAGS_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_etags(scenario_path, etags):
+    path = os.path.join(scenario_path, ETAGS_FILENAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(etags, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def download_object(client, bucket_name, key, path, retries=3, backoff=1.0):
+    '''
+    download one object to path, retrying with exponential backoff. The object is written to path + '.part' first
+    so that an interrupted download never looks complete.
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.part'
+    for attempt in range(retries + 1):
+        try:
+            client.download_file(bucket_name, key, tmp_path)
+            os.replace(tmp_path, path)
+            return os.path.getsize(path)
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError, OSError) as e:
+            permanent = isinstance(e, botocore.exceptions.ClientError) and \
+                e.response.get('Error', {}).get('Code') in PERMANENT_ERROR_CODES
+            if permanent or attempt == retries:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            time.sleep(backoff * 2**attempt * (1 + random.random()))
+
+
+def download_objects(client, bucket_name, jobs, scenario_path, workers=16, retries=3, overwrite=False, backoff=1.0):
+    '''
+    input:
+        jobs: list of (object dict as returned by list_objects, local path) to download
+        scenario_path: directory whose ETAGS_FILENAME records what has been downloaded
+    output:
+        dict with the number of downloaded, skipped and failed files, bytes downloaded and seconds taken
+    '''
+    start = time.time()
+    etags = load_etags(scenario_path)
+    todo = []
+    skipped = 0
+    for obj, path in jobs:
+        rel_path = os.path.relpath(path, scenario_path)
+        if not overwrite and is_up_to_date(path, obj['size'], obj['etag'], etags.get(rel_path)):
+            etags[rel_path] = obj['etag']
+            skipped += 1
+        else:
+            todo.append((obj, path))
+
+    downloaded, failed, num_bytes = 0, [], 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(download_object, client, bucket_name, obj['key'], path, retries, backoff): (obj, path)
+                       for obj, path in todo}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                obj, path = futures[future]
+                try:
+                    num_bytes += future.result()
+                    downloaded += 1
+                    etags[os.path.relpath(path, scenario_path)] = obj['etag']
+                except Exception as e:
+                    print('Failed to download {}: {}'.format(obj['key'], e))
+                    failed.append(obj['key'])
+    finally:
+        # keep track of what was downloaded even if we got interrupted
+        os.makedirs(scenario_path, exist_ok=True)
+        save_etags(scenario_path, etags)
+    return {'downloaded': downloaded, 'skipped': skipped, 'failed': failed,
+            'bytes': num_bytes, 'seconds': time.time() - start}
+
+
+def download_scenario(client, sc, save_path, stim_names, hdf5s=False, redyellow=False,
+                      directory_per_template=False, overwrite=False, workers=16, retries=3,
+                      manifest_max_age=24, refresh=False):
+    bucket_name = get_bucket_name(sc, redyellow)
+    scenario_path = os.path.join(save_path, sc.capitalize())
+
+    print('Downloading Scenario: {}'.format(sc.capitalize()))
+    print('Bucket Name: {}'.format(bucket_name))
+    print('Data will download to: {}'.format(scenario_path))
+    print('Overwrite local data with downloaded data from S3? {}'.format(overwrite))
+
+    # create dir where this scenario will be stored
+    os.makedirs(scenario_path, exist_ok=True)
+
+    ## get stims for this scenario
+    manifest = refresh_manifest(client, bucket_name, get_prefix(sc), sc, save_path, manifest_max_age, refresh)
+    stims = select_stims(manifest, sc, stim_names, hdf5s, redyellow)
+    jobs = [(s, os.path.join(get_save_dir(s['key'], scenario_path, directory_per_template, redyellow), s['key']))
+            for s in stims]
+    return download_objects(client, bucket_name, jobs, scenario_path, workers, retries, overwrite)
+
+
+def get_client(workers=16):
+    # one client is shared by all threads, give it enough connections for all of them
+    return boto3.client('s3', config=Config(max_pool_connections=max(10, workers)))
+
+
 if __name__ == '__main__':
 
     args = get_args()
-    save_path = args.path_to_data
-    overwrite = args.overwrite
-    d_per_t = args.directory_per_template
-    stim_names = pd.read_csv('./stimuli/stimulus_names_and_labels.csv')[['stim_ID','scenario']]    
+    stim_names = pd.read_csv('./stimuli/stimulus_names_and_labels.csv')[['stim_ID','scenario']]
+    client = get_client(args.workers)
 
     scenarios = [s.lower() for s in args.scenarios.split(',')]
+    total_bytes, total_seconds = 0, 0
     for sc in scenarios:
-        start = time.time()
         assert sc in SCENARIOS, "%s is not one of the scenarios: %s" % (sc, SCENARIOS)
-        bsuffix = '' if not (sc == 'drape') else ('sagging' if args.redyellow else 'iness')
-        bucket_name = 'human-physics-benchmarking-%s-pilot' % \
-            (NEW_TO_OLD_SCENARIO_NAMES[sc] + bsuffix + ('-redyellow' if args.redyellow else ''))
-        scenario_path = os.path.join(save_path, sc.capitalize())        
-        
-        print('Downloading Scenario: {}'.format(sc.capitalize()))
-        print('Bucket Name: {}'.format(bucket_name))
-        print('Data will download to: {}'.format(scenario_path))
-        print('Overwrite local data with downloaded data from S3? {}'.format(overwrite))
-
-        # create dir where this scenario will be stored
-        os.makedirs(scenario_path) if not os.path.exists(scenario_path) else None
-        
-        # establish connection to s3
-        s3 = boto3.resource('s3')
-        bucket = s3.Bucket(bucket_name)
-
-        ## get stims for this scenario
-        r = list(bucket.objects.filter(Prefix=('pilot' if not sc == 'drape' else 'test')))
-        suffix = ['mp4', 'png'] if not args.hdf5s else ['hdf5']
-
-        stims = [stim for stim in r if any((s in str(stim) for s in suffix))]
-        if not args.redyellow:
-            stims = [s for s in stims if 'redyellow' not in s.key]
-        else:
-            stims = [s for s in stims if 'redyellow' in s.key]
-
-        # keep only the ones that have response data
-        sc_names = list(stim_names[stim_names['scenario'] == sc]['stim_ID'])
-        if not args.hdf5s:
-            sc_names = [nm + '_img' for nm in sc_names] + ([nm + '_map' for nm in sc_names] if not args.redyellow else [])
-
-        if not args.redyellow:
-            stims = [s for s in stims if s.key.split('.')[0] in sc_names]
-        else:
-            stims = [s for s in stims if ''.join(s.key.split('.')[0].split('-redyellow')) in sc_names]
-
-        # make the savedir if it doesn't exist and save it
-        for i,s in enumerate(tqdm(stims)):
-            template_name = s.key.split('_0')
-            if len(template_name) > 2:
-                template_name = '_0'.join(template_name[:-1])
-            else:
-                template_name = template_name[0]
-                
-            sv_dir = scenario_path if not d_per_t else os.path.join(scenario_path, template_name)
-            sv_type = s.key.split('.')[-1]
-            sv_type = 'maps' if sv_type == 'png' else (sv_type + 's')
-            if args.redyellow:
-                sv_type += '-redyellow'
-            sv_dir = os.path.join(sv_dir, sv_type)
-            os.makedirs(sv_dir) if not os.path.exists(sv_dir) else None
-            if overwrite or (not os.path.exists(os.path.join(sv_dir, s.key))):
-                s3.meta.client.download_file(bucket_name, s.key, os.path.join(sv_dir, s.key))
-        end = time.time()
-        print("Successfully downloaded the %s scenario: took %d seconds" % (sc.capitalize(), int(end - start)))
+        stats = download_scenario(client, sc, args.path_to_data, stim_names, args.hdf5s, args.redyellow,
+                                  args.directory_per_template, args.overwrite, args.workers, args.retries,
+                                  args.manifest_max_age, args.refresh_manifest)
+        total_bytes += stats['bytes']
+        total_seconds += stats['seconds']
+        print("Downloaded the %s scenario: %d files (%.1f MB) downloaded, %d up to date, %d failed; took %d seconds (%.1f MB/s)" % (
+            sc.capitalize(), stats['downloaded'], stats['bytes'] / 1e6, stats['skipped'], len(stats['failed']),
+            int(stats['seconds']), stats['bytes'] / 1e6 / max(stats['seconds'], 1e-9)))
+        if len(stats['failed']) > 0:
+            print("Run again to retry the failed files")
+    print("Total: %.1f MB in %d seconds (%.1f MB/s)" % (total_bytes / 1e6, int(total_seconds), total_bytes / 1e6 / max(total_seconds, 1e-9)))
@@ -8,6 +8,8 @@ from enum import Enum
 import random
 from typing import List, Dict, Tuple
 from weighted_collection import WeightedCollection
+from frame_labels import wrap_label_funcs, get_frame_label_kwargs
+from image_storage import get_image_storage_kwargs
 from tdw.tdw_utils import TDWUtils
 from tdw.librarian import ModelRecord, MaterialLibrarian
 from tdw.output_data import OutputData, Transforms
@@ -380,7 +382,7 @@ class Collision(Dominoes):
 
         funcs = Dominoes.get_controller_label_funcs(classname)
 
-        return funcs
+        return wrap_label_funcs(funcs)
     
     def is_done(self, resp: List[bytes], frame: int) -> bool:
         return frame > 150 # End after X frames even if objects are still moving.
@@ -469,7 +471,9 @@ if __name__ == "__main__":
         flex_only=args.only_use_flex_objects,
         no_moving_distractors=args.no_moving_distractors,
         match_probe_and_target_color=args.match_probe_and_target_color,
-        use_test_mode_colors=args.use_test_mode_colors        
+        use_test_mode_colors=args.use_test_mode_colors,
+        **get_frame_label_kwargs(args),
+        **get_image_storage_kwargs(args)
     )
 
     if bool(args.run):
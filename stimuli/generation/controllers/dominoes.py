@@ -10,6 +10,8 @@ import random
 from typing import List, Dict, Tuple
 from collections import OrderedDict
 from weighted_collection import WeightedCollection
+from frame_labels import FrameLabelBuffer, wrap_label_funcs
+from image_storage import load_storage_policy, StorageFramesGroup
 from tdw.tdw_utils import TDWUtils
 from tdw.librarian import ModelRecord, MaterialLibrarian
 from tdw.output_data import OutputData, Transforms, Images, CameraMatrices
@@ -294,6 +296,13 @@ def get_args(dataset_dir: str, parse=True):
     parser.add_argument("--match_probe_and_target_color",
                         action="store_true",
                         help="Probe and target will have the same color.")
+    parser.add_argument("--consolidated_labels",
+                        action="store_true",
+                        help="Write the per-frame labels of a trial as one dataset per label (frame_labels/<label>) instead of one per frame and label (see frame_labels.py)")
+    parser.add_argument("--image_storage",
+                        type=none_or_str,
+                        default=None,
+                        help="Storage options (codec, level, chunks, stacked, depth) of the written passes, as json or a json file; see image_storage.py")
 
     def postprocess(args):
 
@@ -581,6 +590,8 @@ class Dominoes(RigidbodiesDataset):
                  match_probe_and_target_color=False,
                  probe_horizontal=False,
                  use_test_mode_colors=False,
+                 consolidated_labels=False,
+                 image_storage=None,
                  **kwargs):
 
         ## get random port unless one is specified
@@ -703,6 +714,13 @@ class Dominoes(RigidbodiesDataset):
         self._fixed_target = False
         self.use_test_mode_colors = use_test_mode_colors
 
+        ## buffer the per-frame labels and write them once per trial
+        self.consolidated_labels = consolidated_labels
+        self._frame_label_buffer = FrameLabelBuffer() if consolidated_labels else None
+
+        ## how to store the image passes (None: as tdw_physics does)
+        self.image_storage = load_storage_policy(image_storage) if image_storage is not None else None
+
     def get_types(self,
                   objlist,
                   libraries=["models_flex.json"],
@@ -813,7 +831,7 @@ class Dominoes(RigidbodiesDataset):
                 return int(0)
         funcs += [room, trial_seed, push_time, num_distractors, num_occluders]
 
-        return funcs
+        return wrap_label_funcs(funcs)
 
     def get_field_of_view(self) -> float:
         return 55
@@ -996,6 +1014,8 @@ class Dominoes(RigidbodiesDataset):
                      resp: List[bytes],
                      frame_num: int) -> \
             Tuple[h5py.Group, h5py.Group, dict, bool]:
+        if self.image_storage is not None:
+            frames_grp = StorageFramesGroup(frames_grp, self.image_storage)
         frame, objs, tr, sleeping = super()._write_frame(frames_grp=frames_grp,
                                                          resp=resp,
                                                          frame_num=frame_num)
@@ -1019,6 +1039,8 @@ class Dominoes(RigidbodiesDataset):
                             frame_num: int,
                             sleeping: bool) -> Tuple[h5py.Group, List[bytes], int, bool]:
 
+        if self.consolidated_labels:
+            frame_grp = self._frame_label_buffer.frame_group(frame_grp)
         labels, resp, frame_num, done = super()._write_frame_labels(frame_grp, resp, frame_num, sleeping)
 
         # Whether this trial has a target or zone to track
@@ -1027,6 +1049,7 @@ class Dominoes(RigidbodiesDataset):
         labels.create_dataset("has_target", data=has_target)
         labels.create_dataset("has_zone", data=has_zone)
         if not (has_target or has_zone):
+            self._flush_frame_labels(done)
             return labels, resp, frame_num, done
 
         # Whether target moved from its initial position, and how much
@@ -1060,8 +1083,16 @@ class Dominoes(RigidbodiesDataset):
             target_zone_contact = bool(len(c_points))
             labels.create_dataset("target_contacting_zone", data=target_zone_contact)
 
+        self._flush_frame_labels(done)
         return labels, resp, frame_num, done
 
+    def _flush_frame_labels(self, done: bool) -> None:
+        # write the buffered labels at the end of the trial; labels that subclasses add to the last frame
+        # afterwards are written as they are added
+        frame_label_buffer = getattr(self, '_frame_label_buffer', None)
+        if frame_label_buffer is not None and done:
+            frame_label_buffer.flush()
+
     def is_done(self, resp: List[bytes], frame: int) -> bool:
         return frame > 300
 
@@ -1967,7 +1998,7 @@ class MultiDominoes(Dominoes):
 
         funcs += [num_middle_objects, remove_middle]
 
-        return funcs
+        return wrap_label_funcs(funcs)
 
     def _build_intermediate_structure(self) -> List[dict]:
         # set the middle object color
@@ -2122,7 +2153,9 @@ if __name__ == "__main__":
         flex_only=args.only_use_flex_objects,
         no_moving_distractors=args.no_moving_distractors,
         match_probe_and_target_color=args.match_probe_and_target_color,
-        use_test_mode_colors=args.use_test_mode_colors
+        use_test_mode_colors=args.use_test_mode_colors,
+        consolidated_labels=args.consolidated_labels,
+        image_storage=args.image_storage
     )
 
     if bool(args.run):
@@ -14,6 +14,9 @@ from tdw_physics.rigidbodies_dataset import RigidbodiesDataset
 from tdw_physics.util import MODEL_LIBRARIES, get_parser, none_or_str
 
 from tdw_physics.postprocessing.labels import get_all_label_funcs
+from frame_labels import wrap_label_funcs, get_frame_label_kwargs
+from image_storage import get_image_storage_kwargs
+from particle_distance import get_min_distance, get_flex_object_index
 
 # fluid
 from tdw.flex.fluid_types import FluidTypes
@@ -151,6 +154,7 @@ class ClothSagging(Dominoes, FlexDataset):
 
         # for detecting collisions
         self.collision_label_thresh = collision_label_threshold
+        self._flex_object_indices = {}
 
     def _set_add_physics_object(self):
         if self.all_flex_objects:
@@ -461,26 +465,29 @@ class ClothSagging(Dominoes, FlexDataset):
         return commands
 
     @staticmethod
-    def get_flex_object_collision(flex, obj1, obj2, collision_thresh=0.15):
+    def get_flex_object_collision(flex, obj1, obj2, collision_thresh=0.15, object_indices=None):
         '''
         flex: FlexParticles Data
+        object_indices: dict of object id -> index in flex, to reuse across frames (see get_flex_object_index)
         '''
         collision = False
         p1 = p2 = None
-        for n in range(flex.get_num_objects()):
-            if flex.get_id(n) == obj1:
-                p1 = flex.get_particles(n)
-            elif flex.get_id(n) == obj2:
-                p2 = flex.get_particles(n)
+        if object_indices is None:
+            object_indices = {}
+        n1 = get_flex_object_index(flex, obj1, object_indices)
+        n2 = get_flex_object_index(flex, obj2, object_indices)
+        if n1 is not None:
+            p1 = flex.get_particles(n1)
+        if n2 is not None and obj2 != obj1:
+            p2 = flex.get_particles(n2)
 
         if (p1 is not None) and (p2 is not None):
 
             p1 = np.array(p1)[:,0:3]
             p2 = np.array(p2)[:,0:3]
 
-            dists = np.sqrt(np.square(p1[:,None] - p2[None,:]).sum(-1))
-            collision = (dists < collision_thresh).max()
-            min_dist = dists.min()
+            # bounding-box reject and KD-tree instead of all N x M distances; same values
+            min_dist, collision = get_min_distance(p1, p2, collision_thresh)
             print(obj1, p1.shape, obj2, p2.shape, "min_dist", min_dist, "colliding?", collision)
 
         return (min_dist, collision)
@@ -491,6 +498,9 @@ class ClothSagging(Dominoes, FlexDataset):
                             frame_num: int,
                             sleeping: bool) -> Tuple[h5py.Group, List[bytes], int, bool]:
 
+        # the installed Dominoes buffers the labels only if it is this repo's dominoes.py
+        if getattr(self, 'consolidated_labels', False):
+            frame_grp = self._frame_label_buffer.frame_group(frame_grp)
         labels, resp, grame_num, done = RigidbodiesDataset._write_frame_labels(self, frame_grp, resp, frame_num, sleeping)
 
         has_target = (not self.remove_target) or self.replace_target
@@ -498,6 +508,7 @@ class ClothSagging(Dominoes, FlexDataset):
         labels.create_dataset("has_target", data=has_target)
         labels.create_dataset("has_zone", data=has_zone)
         if not (has_target or has_zone):
+            self._flush_frame_labels(done)
             return labels, resp, frame_num, done
 
         print("frame num", frame_num)
@@ -510,12 +521,19 @@ class ClothSagging(Dominoes, FlexDataset):
             min_dist, are_touching = self.get_flex_object_collision(flex,
                                                           obj1=self.target_id,
                                                           obj2=self.zone_id,
-                                                          collision_thresh=self.collision_label_thresh)
+                                                          collision_thresh=self.collision_label_thresh,
+                                                          object_indices=self._flex_object_indices)
             labels.create_dataset("minimum_distance_target_to_zone", data=min_dist)
             labels.create_dataset("target_contacting_zone", data=are_touching)
 
+        self._flush_frame_labels(done)
         return labels, resp, frame_num, done
 
+    def _flush_frame_labels(self, done: bool) -> None:
+        frame_label_buffer = getattr(self, '_frame_label_buffer', None)
+        if frame_label_buffer is not None and done:
+            frame_label_buffer.flush()
+
     @staticmethod
     def get_controller_label_funcs(classname = 'ClothSagging'):
 
@@ -531,7 +549,7 @@ class ClothSagging(Dominoes, FlexDataset):
 
         funcs += [minimum_distance_target_to_zone]
 
-        return funcs
+        return wrap_label_funcs(funcs)
 
     def _set_occlusion_attributes(self) -> None:
 
@@ -637,7 +655,9 @@ if __name__ == '__main__':
         anchor_height = args.anchor_height,
         anchor_jitter = args.anchor_jitter,
         height_jitter = args.height_jitter,
-        use_test_mode_colors=args.use_test_mode_colors
+        use_test_mode_colors=args.use_test_mode_colors,
+        **get_frame_label_kwargs(args),
+        **get_image_storage_kwargs(args)
     )
 
     if bool(args.run):
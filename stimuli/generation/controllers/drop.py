@@ -10,6 +10,8 @@ from enum import Enum
 import random
 from typing import List, Dict, Tuple
 from weighted_collection import WeightedCollection
+from frame_labels import get_frame_label_kwargs
+from image_storage import get_image_storage_kwargs
 from tdw.tdw_utils import TDWUtils
 from tdw.librarian import ModelRecord
 from tdw_physics.rigidbodies_dataset import (RigidbodiesDataset,
@@ -567,7 +569,9 @@ if __name__ == "__main__":
         num_occluders=args.num_occluders,
         flex_only=args.only_use_flex_objects,
         no_moving_distractors=args.no_moving_distractors,
-        use_test_mode_colors=args.use_test_mode_colors
+        use_test_mode_colors=args.use_test_mode_colors,
+        **get_frame_label_kwargs(args),
+        **get_image_storage_kwargs(args)
     )
 
     if bool(args.run):
@@ -0,0 +1,313 @@
+import functools
+from collections import OrderedDict
+import numpy as np
+
+'''
+Consolidated layout of the per-frame labels of a trial (--consolidated_labels in the controllers).
+
+By default every label of every frame is its own HDF5 dataset, frames/<frame>/labels/<label>, so a trial of 300 frames
+has thousands of tiny datasets. With the consolidated layout the labels of a trial are buffered in memory while it is
+generated (FrameLabelBuffer) and written once at its end as one chunked, resizable dataset per label,
+frame_labels/<label>, with one row per frame (in the order of f['frames'].keys()). A label that is not written on every
+frame also gets frame_labels/<label>.frames with the (0-based) frames it has.
+
+read_frame_label reads a label from files in either layout. wrap_label_funcs makes label functions that were written
+for the per-frame layout (e.g. those of tdw_physics.postprocessing.labels) read the consolidated layout as well.
+'''
+
+LABELS_GROUP = 'frame_labels'
+FRAMES_SUFFIX = '.frames'
+
+
+class FrameLabelBuffer(object):
+    '''
+    Buffers the labels that _write_frame_labels writes to frame_grp.create_group("labels") and writes them to the
+    trial file in the consolidated layout when flush is called at the end of the trial. Labels written after flush
+    (i.e. after the last frame was flushed) are appended to the file directly.
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.values = OrderedDict()  # label -> values, one per frame that has the label
+        self.frames = OrderedDict()  # label -> frames that have the label
+        self.written = {}            # label -> number of values that are in the file
+        self.num_frames = 0
+        self.file = None
+        self.flushed = False
+
+    def frame_group(self, frame_grp):
+        '''
+        input: h5py group of the next frame of the trial
+        output: stand-in for frame_grp whose "labels" group is buffered
+        '''
+        if self.flushed:
+            # first frame of the next trial
+            self.reset()
+        self.file = frame_grp.file
+        self.num_frames += 1
+        return BufferedFrameGroup(frame_grp, BufferedLabels(self, self.num_frames - 1))
+
+    def add(self, frame, name, data):
+        self.values.setdefault(name, []).append(np.asarray(data))
+        self.frames.setdefault(name, []).append(frame)
+        if self.flushed:
+            self.flush()
+
+    def flush(self):
+        '''
+        write the labels that are not in the file yet to LABELS_GROUP
+        '''
+        group = self.file.require_group(LABELS_GROUP)
+        for name, values in self.values.items():
+            start = self.written.get(name, 0)
+            if start == len(values):
+                continue
+            data = np.stack(values[start:])
+            if data.dtype.kind == 'U':
+                data = np.char.encode(data, 'utf8')
+            if name not in group:
+                # a trial is written once, so a chunk of num_frames rows holds the whole label
+                group.create_dataset(name, data=data, maxshape=(None,) + data.shape[1:],
+                                     chunks=(max(self.num_frames, len(data)),) + data.shape[1:])
+            else:
+                group[name].resize(len(values), axis=0)
+                group[name][start:] = data
+            frames = self.frames[name]
+            if frames != list(range(len(frames))):
+                if name + FRAMES_SUFFIX in group:
+                    del group[name + FRAMES_SUFFIX]
+                group.create_dataset(name + FRAMES_SUFFIX, data=np.array(frames, dtype=np.int32))
+            self.written[name] = len(values)
+        self.flushed = True
+
+
+class BufferedFrameGroup(object):
+    # stand-in for the h5py group of a frame: create_group("labels") gives the buffered labels of the frame
+    def __init__(self, frame_grp, labels):
+        self._frame_grp = frame_grp
+        self._labels = labels
+
+    def create_group(self, name, *args, **kwargs):
+        if name == 'labels':
+            return self._labels
+        return self._frame_grp.create_group(name, *args, **kwargs)
+
+    def __getitem__(self, name):
+        return self._labels if name == 'labels' else self._frame_grp[name]
+
+    def __contains__(self, name):
+        return name == 'labels' or name in self._frame_grp
+
+    def __getattr__(self, attr):
+        return getattr(self._frame_grp, attr)
+
+
+class BufferedLabels(object):
+    # stand-in for the "labels" group of a frame, with the part of the h5py.Group interface the controllers use
+    def __init__(self, buffer, frame):
+        self._buffer = buffer
+        self._frame = frame
+        self._names = []
+
+    def create_dataset(self, name, shape=None, dtype=None, data=None, **kwargs):
+        if name in self._names:
+            raise ValueError("Unable to create dataset (name already exists): {}".format(name))
+        self._buffer.add(self._frame, name, data)
+        self._names.append(name)
+
+    def __getitem__(self, name):
+        if name not in self._names:
+            raise KeyError(name)
+        return self._buffer.values[name][self._buffer.frames[name].index(self._frame)]
+
+    def keys(self):
+        return list(self._names)
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._names)
+
+
+def has_consolidated_labels(f):
+    return LABELS_GROUP in f
+
+
+def read_frame_label(f, name):
+    '''
+    input:
+        f: h5py file of a trial (or a group/view with the same layout)
+        name: per-frame label, e.g. target_contacting_zone
+    output:
+        (frames, values): numpy arrays of the (0-based) frames that have the label and its value in each of them,
+        from either layout. KeyError if no frame has the label.
+    '''
+    if has_consolidated_labels(f):
+        group = f[LABELS_GROUP]
+        values = np.asarray(group[name][()])
+        if name + FRAMES_SUFFIX in group:
+            frames = np.asarray(group[name + FRAMES_SUFFIX][()])
+        else:
+            frames = np.arange(len(values))
+        return frames, values
+    frames, values = [], []
+    for frame, frame_grp in enumerate(f['frames'].values()):
+        if 'labels' in frame_grp and name in frame_grp['labels']:
+            frames.append(frame)
+            values.append(frame_grp['labels'][name][()])
+    if len(frames) == 0:
+        raise KeyError(name)
+    return np.array(frames), np.stack(values)
+
+
+def get_path(group, path):
+    # group[path] one name at a time, for groups that only look up their own members
+    for name in path.strip('/').split('/'):
+        group = group[name]
+    return group
+
+
+class FrameLabelView(object):
+    '''
+    Read-only view of a trial file in the consolidated layout that serves the labels in the per-frame layout:
+    view['frames'][frame]['labels'][label] is the value of the label in that frame. Everything else is the file's.
+    '''
+    def __init__(self, f):
+        self._f = f
+        self._frames = None
+
+    def _get_frames(self):
+        if self._frames is None:
+            frame_keys = list(self._f['frames'].keys())
+            labels = [OrderedDict() for _ in frame_keys]
+            names = [name for name in self._f[LABELS_GROUP].keys() if not name.endswith(FRAMES_SUFFIX)]
+            for name in names:
+                frames, values = read_frame_label(self._f, name)
+                for frame, value in zip(frames, values):
+                    labels[frame][name] = value
+            self._frames = FrameLabelFramesView(self._f['frames'], frame_keys, labels)
+        return self._frames
+
+    def __getitem__(self, name):
+        if isinstance(name, str) and '/' in name.strip('/'):
+            return get_path(self, name)
+        if name == 'frames':
+            return self._get_frames()
+        return self._f[name]
+
+    def __contains__(self, name):
+        return name in self._f
+
+    def __iter__(self):
+        return iter(self._f.keys())
+
+    def __len__(self):
+        return len(self._f.keys())
+
+    def keys(self):
+        return self._f.keys()
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __getattr__(self, attr):
+        return getattr(self._f, attr)
+
+
+class FrameLabelFramesView(object):
+    # the "frames" group of a FrameLabelView
+    def __init__(self, frames_grp, frame_keys, labels):
+        self._frames_grp = frames_grp
+        self._frame_keys = frame_keys
+        self._index = {key: i for i, key in enumerate(frame_keys)}
+        self._labels = labels
+
+    def __getitem__(self, key):
+        if isinstance(key, str) and '/' in key.strip('/'):
+            return get_path(self, key)
+        if key not in self._index:
+            return self._frames_grp[key]
+        return FrameLabelFrameView(self._frames_grp[key], self._labels[self._index[key]])
+
+    def keys(self):
+        return list(self._frame_keys)
+
+    def values(self):
+        return [self[key] for key in self._frame_keys]
+
+    def items(self):
+        return [(key, self[key]) for key in self._frame_keys]
+
+    def __iter__(self):
+        return iter(self._frame_keys)
+
+    def __len__(self):
+        return len(self._frame_keys)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __getattr__(self, attr):
+        return getattr(self._frames_grp, attr)
+
+
+class FrameLabelFrameView(object):
+    # a frame of a FrameLabelView: "labels" is a dict of label -> value in the frame
+    def __init__(self, frame_grp, labels):
+        self._frame_grp = frame_grp
+        self._labels = labels
+
+    def __getitem__(self, name):
+        if isinstance(name, str) and '/' in name.strip('/'):
+            return get_path(self, name)
+        return self._labels if name == 'labels' else self._frame_grp[name]
+
+    def keys(self):
+        return list(self._frame_grp.keys()) + ['labels']
+
+    def __contains__(self, name):
+        return name == 'labels' or name in self._frame_grp
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getattr__(self, attr):
+        return getattr(self._frame_grp, attr)
+
+
+def wrap_label_func(func):
+    '''
+    output: label function that gives func a FrameLabelView of files in the consolidated layout
+    '''
+    if getattr(func, 'reads_consolidated_labels', False):
+        return func
+
+    @functools.wraps(func)
+    def wrapped(f):
+        if not isinstance(f, FrameLabelView) and has_consolidated_labels(f):
+            f = FrameLabelView(f)
+        return func(f)
+    wrapped.reads_consolidated_labels = True
+    return wrapped
+
+
+def wrap_label_funcs(funcs):
+    return [wrap_label_func(func) for func in funcs]
+
+
+def get_frame_label_kwargs(args):
+    '''
+    output: controller kwargs of --consolidated_labels; empty unless it was given, since the controllers other than
+    dominoes.py subclass the installed tdw_physics Dominoes, which only knows the option if it is this repo's dominoes.py
+    '''
+    if getattr(args, 'consolidated_labels', False):
+        return {'consolidated_labels': True}
+    return {}
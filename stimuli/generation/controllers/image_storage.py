@@ -0,0 +1,296 @@
+import os
+import json
+import numpy as np
+import h5py
+
+'''
+Storage options of the image passes that the controllers write to the HDF5s (--image_storage in the controllers,
+scripts/convert_hdf5_storage.py for existing HDF5s).
+
+A policy is a dict of pass (e.g. "_img", or "default" for the passes that are not listed) -> options:
+    codec: "gzip" (what tdw_physics uses), "lzf", "none", or "zstd", "lz4", "blosc" (these need hdf5plugin)
+    level: compression level of gzip (0-9), zstd (1-22) and blosc (0-9)
+    shuffle: apply the byte shuffle filter before compression
+    chunks: chunk shape, e.g. [64, 64, 3] (with stacked: [1, 64, 64, 3]; quantized depth has no channels); null lets
+        h5py choose
+    stacked: write the pass of all frames to one dataset, frame_images/<pass> with one row per frame, instead of one
+        dataset per frame (frames/<frame>/images/<pass>). Passes that are encoded images (png/jpg bytes) are stored
+        as variable-length rows, which the codec does not compress.
+    depth: "lossless", or "quantized" to keep only the 16 most significant bits of the 24-bit depth that the _depth
+        pass packs into its RGB channels (see TDWUtils.get_depth_values); its 8 least significant bits are lost.
+        It is stored decoded (uint16), and read_image gives it back RGB-packed and re-encoded as png if it was png
+Options that are not given are those of DEFAULT_OPTIONS, which is how tdw_physics writes the passes.
+
+read_image reads a pass of a frame from files with any policy.
+'''
+
+IMAGES_GROUP = 'frame_images'
+DEFAULT_OPTIONS = {'codec': 'gzip', 'level': 4, 'shuffle': False, 'chunks': None, 'stacked': False, 'depth': 'lossless'}
+CODECS = ['none', 'gzip', 'lzf', 'zstd', 'lz4', 'blosc']
+DEPTH_PASS = '_depth'
+
+
+def load_storage_policy(policy):
+    '''
+    input: policy as a dict, a json string or the path of a json file
+    output: dict of pass -> options, with the default options filled in
+    '''
+    if isinstance(policy, str):
+        if os.path.exists(policy):
+            with open(policy) as f:
+                policy = json.load(f)
+        else:
+            policy = json.loads(policy)
+    default = dict(DEFAULT_OPTIONS, **policy.get('default', {}))
+    policy = {pass_mask: dict(default, **options) for pass_mask, options in policy.items()}
+    policy['default'] = default
+    for pass_mask, options in policy.items():
+        unknown = set(options) - set(DEFAULT_OPTIONS)
+        if len(unknown) > 0:
+            raise ValueError("Unknown storage options of {}: {}".format(pass_mask, ', '.join(sorted(unknown))))
+        if options['codec'] not in CODECS:
+            raise ValueError("Unknown codec of {}: {} (one of {})".format(pass_mask, options['codec'], ', '.join(CODECS)))
+        if options['depth'] not in ['lossless', 'quantized']:
+            raise ValueError("depth of {} must be lossless or quantized, not {}".format(pass_mask, options['depth']))
+    return policy
+
+
+def get_pass_options(policy, pass_mask):
+    return policy.get(pass_mask, policy.get('default', DEFAULT_OPTIONS))
+
+
+def get_compression_kwargs(options):
+    '''
+    output: keyword arguments of h5py create_dataset for the codec, level and shuffle of options
+    '''
+    codec, level = options['codec'], options['level']
+    if codec == 'none':
+        kwargs = {}
+    elif codec == 'gzip':
+        kwargs = {'compression': 'gzip', 'compression_opts': level}
+    elif codec == 'lzf':
+        kwargs = {'compression': 'lzf'}
+    else:
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ImportError("The {} codec requires hdf5plugin (pip install hdf5plugin)".format(codec))
+        if codec == 'zstd':
+            kwargs = dict(hdf5plugin.Zstd(clevel=level))
+        elif codec == 'lz4':
+            kwargs = dict(hdf5plugin.LZ4())
+        else:
+            # blosc shuffles by itself
+            kwargs = dict(hdf5plugin.Blosc(cname='zstd', clevel=level, shuffle=hdf5plugin.Blosc.SHUFFLE
+                                           if options['shuffle'] else hdf5plugin.Blosc.NOSHUFFLE))
+    if options['shuffle'] and codec != 'blosc':
+        kwargs['shuffle'] = True
+    return kwargs
+
+
+def is_encoded(data):
+    # encoded images (png/jpg bytes) are 1-d uint8 arrays, decoded passes have a height and width
+    return data.ndim == 1
+
+
+def decode_image(data):
+    try:
+        import io
+        from PIL import Image
+    except ImportError:
+        raise ImportError("Decoding the encoded passes requires Pillow (pip install Pillow)")
+    return np.array(Image.open(io.BytesIO(data.tobytes())))
+
+
+def encode_image(data):
+    # array -> png bytes as a 1-d uint8 array, like the encoded passes of tdw_physics
+    try:
+        import io
+        from PIL import Image
+    except ImportError:
+        raise ImportError("Encoding the passes requires Pillow (pip install Pillow)")
+    buf = io.BytesIO()
+    Image.fromarray(data).save(buf, format='PNG')
+    return np.frombuffer(buf.getvalue(), dtype=np.uint8)
+
+
+def quantize_depth(data):
+    '''
+    input: _depth pass, with the depth packed into RGB (most significant byte in R), encoded or as an array
+    output: uint16 array of the 16 most significant bits of the depth
+    '''
+    if is_encoded(data):
+        data = decode_image(data)
+    return (data[..., 0].astype(np.uint16) << 8) | data[..., 1].astype(np.uint16)
+
+
+def dequantize_depth(data):
+    # quantized depth -> RGB-packed uint8 array (the least significant byte, B, is 0)
+    packed = np.zeros(data.shape + (3,), dtype=np.uint8)
+    packed[..., 0] = data >> 8
+    packed[..., 1] = data & 255
+    return packed
+
+
+def get_chunks(chunks, shape):
+    # chunks no larger than a fixed-size dataset of shape
+    if chunks is None:
+        return None
+    if len(chunks) != len(shape):
+        raise ValueError("Chunk shape {} does not match the shape of the data {}".format(tuple(chunks), shape))
+    return tuple(max(1, min(c, s)) if s is not None else max(1, c) for c, s in zip(chunks, shape))
+
+
+def write_image(frame_grp, pass_mask, data, policy):
+    '''
+    write a pass of the frame with the options of the policy for it
+    input:
+        frame_grp: h5py group of the frame (frames/<frame>)
+        pass_mask: e.g. _img
+        data: the pass as tdw_physics writes it (encoded image bytes or array)
+        policy: see load_storage_policy
+    '''
+    options = get_pass_options(policy, pass_mask)
+    data = np.asarray(data)
+    quantized = pass_mask == DEPTH_PASS and options['depth'] == 'quantized'
+    # quantized depth is stored decoded; remember to give it back as png bytes if that is how it came
+    encoded = is_encoded(data)
+    if quantized:
+        data = quantize_depth(data)
+    kwargs = get_compression_kwargs(options)
+    if options['stacked']:
+        group = frame_grp.file.require_group(IMAGES_GROUP)
+        if pass_mask not in group:
+            if is_encoded(data):
+                dtype, shape = h5py.vlen_dtype(data.dtype), ()
+            else:
+                dtype, shape = data.dtype, data.shape
+            chunks = get_chunks(options['chunks'], (None,) + shape) or (1,) + shape
+            dataset = group.create_dataset(pass_mask, shape=(0,) + shape, maxshape=(None,) + shape, dtype=dtype,
+                                           chunks=chunks, **kwargs)
+            if quantized:
+                dataset.attrs['depth'] = 'quantized'
+                dataset.attrs['encoded'] = encoded
+        dataset = group[pass_mask]
+        dataset.resize(len(dataset) + 1, axis=0)
+        dataset[len(dataset) - 1] = data
+    else:
+        chunks = get_chunks(options['chunks'], data.shape)
+        dataset = frame_grp.require_group('images').create_dataset(pass_mask, data=data, chunks=chunks, **kwargs)
+        if quantized:
+            dataset.attrs['depth'] = 'quantized'
+            dataset.attrs['encoded'] = encoded
+
+
+def get_image_passes(f):
+    '''
+    output: list of the passes in the file (from the first frame and frame_images)
+    '''
+    passes = list(f[IMAGES_GROUP].keys()) if IMAGES_GROUP in f else []
+    frames = f['frames']
+    keys = list(frames.keys())
+    if len(keys) > 0 and 'images' in frames[keys[0]]:
+        passes += [p for p in frames[keys[0]]['images'].keys() if p not in passes]
+    return passes
+
+
+def read_image(f, frame, pass_mask, decode_depth=True, frame_keys=None):
+    '''
+    input:
+        f: h5py file
+        frame: index of the frame (in the order of f['frames'].keys()) or its key, e.g. "0003"
+        pass_mask: e.g. _img
+        decode_depth: return quantized depth like the lossless _depth pass, i.e. RGB-packed and, if tdw_physics
+            wrote it as png bytes, encoded as png again (else as the stored uint16 array)
+        frame_keys: list(f['frames'].keys()), to not list them on every call
+    output:
+        the pass of the frame as tdw_physics wrote it, whatever the policy of the file (up to the bits that
+        quantized depth drops)
+    '''
+    if isinstance(frame, str):
+        key, index = frame, None
+    else:
+        key, index = None, frame
+    if IMAGES_GROUP in f and pass_mask in f[IMAGES_GROUP]:
+        dataset = f[IMAGES_GROUP][pass_mask]
+        if index is None:
+            index = (frame_keys or list(f['frames'].keys())).index(key)
+        data = dataset[index]
+    else:
+        if key is None:
+            key = (frame_keys or list(f['frames'].keys()))[index]
+        dataset = f['frames'][key]['images'][pass_mask]
+        data = dataset[()]
+    if decode_depth and dataset.attrs.get('depth') == 'quantized':
+        data = dequantize_depth(data)
+        if dataset.attrs.get('encoded', False):
+            data = encode_image(data)
+    return data
+
+
+class StorageFramesGroup(object):
+    '''
+    Stand-in for the "frames" group of a trial file for tdw_physics _write_frame, which writes the image passes of the
+    frames with the options of the policy instead of its own.
+    '''
+    def __init__(self, frames_grp, policy):
+        self._frames_grp = frames_grp
+        self._policy = policy
+
+    def create_group(self, name, *args, **kwargs):
+        return StorageFrameGroup(self._frames_grp.create_group(name, *args, **kwargs), self._policy)
+
+    def __getitem__(self, name):
+        return self._frames_grp[name]
+
+    def __contains__(self, name):
+        return name in self._frames_grp
+
+    def __getattr__(self, attr):
+        return getattr(self._frames_grp, attr)
+
+
+class StorageFrameGroup(object):
+    # stand-in for a frame group: create_group("images") gives a group that writes with the policy
+    def __init__(self, frame_grp, policy):
+        self._frame_grp = frame_grp
+        self._policy = policy
+
+    def create_group(self, name, *args, **kwargs):
+        if name == 'images':
+            return StorageImagesGroup(self._frame_grp, self._policy)
+        return self._frame_grp.create_group(name, *args, **kwargs)
+
+    def __getitem__(self, name):
+        return self._frame_grp[name]
+
+    def __contains__(self, name):
+        return name in self._frame_grp
+
+    def __getattr__(self, attr):
+        return getattr(self._frame_grp, attr)
+
+
+class StorageImagesGroup(object):
+    # stand-in for the "images" group of a frame; the h5py group is created by the first pass that is not stacked
+    def __init__(self, frame_grp, policy):
+        self._frame_grp = frame_grp
+        self._policy = policy
+
+    def create_dataset(self, name, shape=None, dtype=None, data=None, **kwargs):
+        # the compression arguments of tdw_physics are replaced by the policy
+        write_image(self._frame_grp, name, data, self._policy)
+
+    def __getattr__(self, attr):
+        return getattr(self._frame_grp.require_group('images'), attr)
+
+
+def get_image_storage_kwargs(args):
+    '''
+    output: controller kwargs of --image_storage; empty unless it was given, since the controllers other than
+    dominoes.py subclass the installed tdw_physics Dominoes, which only knows the option if it is this repo's dominoes.py
+    '''
+    image_storage = getattr(args, 'image_storage', None)
+    if image_storage is not None:
+        return {'image_storage': image_storage}
+    return {}
@@ -9,6 +9,8 @@ from enum import Enum
 import random
 from typing import List, Dict, Tuple
 from weighted_collection import WeightedCollection
+from frame_labels import wrap_label_funcs, get_frame_label_kwargs
+from image_storage import get_image_storage_kwargs
 from tdw.tdw_utils import TDWUtils
 from tdw.librarian import ModelRecord, MaterialLibrarian
 from tdw.output_data import OutputData, Transforms
@@ -329,7 +331,7 @@ class Linking(Tower):
     def get_controller_label_funcs(classname = "Linking"):
         funcs = Dominoes.get_controller_label_funcs(classname)
 
-        return funcs
+        return wrap_label_funcs(funcs)
 
     def _write_frame_labels(self,
                             frame_grp: h5py.Group,
@@ -690,7 +692,9 @@ if __name__ == "__main__":
         ramp_base_height_range=args.rheight,
         flex_only=args.only_use_flex_objects,
         no_moving_distractors=args.no_moving_distractors,
-        use_test_mode_colors=args.use_test_mode_colors
+        use_test_mode_colors=args.use_test_mode_colors,
+        **get_frame_label_kwargs(args),
+        **get_image_storage_kwargs(args)
     )
 
     if bool(args.run):
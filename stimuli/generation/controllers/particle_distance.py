@@ -0,0 +1,103 @@
+import numpy as np
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+'''
+Minimum distance between the particles of two Flex objects (ClothSagging.get_flex_object_collision), without the
+(N, M, 3) array of all pairwise differences, which takes hundreds of MB per frame for dense cloths.
+
+The particles that are farther from the bounding box of the other object than an upper bound of the minimum distance
+are dropped first. The closest pairs among the rest are found with a KD-tree (scipy), or by blocks of particles if
+scipy is not installed, and their distances are computed with the same float operations as the full array, so the
+minimum distance and the collision label are exactly those of get_min_distance_brute_force.
+'''
+
+BLOCK_PAIRS = 2 ** 20  # pairs per block without scipy (12 MB of float32 differences)
+# relative margin for the float32 rounding of the distances (< 1e-6) when the candidates are chosen in float64
+DISTANCE_MARGIN = 1e-5
+
+
+def get_pair_distances(p1, p2):
+    # what the full (N, M) array of distances holds, for the pairs p1[i], p2[i]
+    return np.sqrt(np.square(p1 - p2).sum(-1))
+
+
+def get_min_distance_brute_force(p1, p2, collision_thresh=0.15):
+    '''
+    the computation of ClothSagging.get_flex_object_collision over all pairs, as reference
+    output: (min_dist, collision)
+    '''
+    dists = np.sqrt(np.square(p1[:, None] - p2[None, :]).sum(-1))
+    return dists.min(), (dists < collision_thresh).max()
+
+
+def get_box_distance(points, box_min, box_max):
+    # distance of every point to the axis-aligned box
+    gap = np.maximum(np.maximum(box_min - points, points - box_max), 0).astype(np.float64)
+    return np.sqrt(np.square(gap).sum(-1))
+
+
+def get_candidates(p1, p2):
+    '''
+    output: indices of the particles of p1 and of p2 that can be in a closest pair: the particles that are not
+        farther from the bounding box of the other object than a pair of particles is from each other
+    '''
+    d1 = get_box_distance(p1, p2.min(0), p2.max(0))
+    d2 = get_box_distance(p2, p1.min(0), p1.max(0))
+    i, j = d1.argmin(), d2.argmin()
+    bound = np.sqrt(np.square(p1[i].astype(np.float64) - p2[j]).sum()) * (1 + DISTANCE_MARGIN) + 1e-9
+    return np.flatnonzero(d1 <= bound), np.flatnonzero(d2 <= bound)
+
+
+def get_min_distance(p1, p2, collision_thresh=0.15, use_tree=True, block_pairs=BLOCK_PAIRS):
+    '''
+    input:
+        p1, p2: (N, 3) and (M, 3) arrays of particle positions
+        collision_thresh: distance below which the objects are colliding
+        use_tree: use a KD-tree if scipy is installed (else blocks of particles)
+        block_pairs: number of pairs per block
+    output:
+        (min_dist, collision), the same values (and types) as get_min_distance_brute_force
+    '''
+    if len(p1) == 0 or len(p2) == 0:
+        return get_min_distance_brute_force(p1, p2, collision_thresh)
+    c1, c2 = get_candidates(p1, p2)
+    q1, q2 = p1[c1], p2[c2]
+    if use_tree and cKDTree is not None:
+        tree = cKDTree(q2.astype(np.float64))
+        nearest, _ = tree.query(q1.astype(np.float64), k=1)
+        radius = nearest.min() * (1 + DISTANCE_MARGIN) + 1e-9
+        close = np.flatnonzero(nearest <= radius)
+        neighbors = tree.query_ball_point(q1[close].astype(np.float64), radius)
+        i = np.repeat(close, [len(n) for n in neighbors])
+        j = np.concatenate([np.asarray(n, dtype=np.int64) for n in neighbors])
+        dists = get_pair_distances(q1[i], q2[j])
+        return dists.min(), (dists < collision_thresh).max()
+    min_dist = collision = None
+    rows = max(1, block_pairs // len(q2))
+    for start in range(0, len(q1), rows):
+        dists = np.sqrt(np.square(q1[start:start + rows, None] - q2[None, :]).sum(-1))
+        block_min, block_collision = dists.min(), (dists < collision_thresh).max()
+        min_dist = block_min if min_dist is None else min(min_dist, block_min)
+        collision = block_collision if collision is None else (collision | block_collision)
+    return min_dist, collision
+
+
+def get_flex_object_index(flex, object_id, object_indices):
+    '''
+    input:
+        flex: FlexParticles data
+        object_id: id of a Flex object
+        object_indices: dict of object id -> index of the object in flex, kept across frames; it is rebuilt
+            when the object at the cached index is not the one with object_id (e.g. in the next trial)
+    output:
+        index of the object in flex, or None if it is not in flex
+    '''
+    n = object_indices.get(object_id)
+    if n is None or n >= flex.get_num_objects() or flex.get_id(n) != object_id:
+        object_indices.clear()
+        for n in range(flex.get_num_objects()):
+            object_indices[flex.get_id(n)] = n
+    return object_indices.get(object_id)
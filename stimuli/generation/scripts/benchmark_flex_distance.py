@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'controllers'))
+import particle_distance as pd
+
+'''
+Checks that particle_distance.get_min_distance (used by ClothSagging.get_flex_object_collision) gives the same
+min_dist and collision as the full N x M distance array on synthetic particle clouds of a cloth draped over a zone
+object, and reports the time and peak memory of both, e.g.:
+python benchmark_flex_distance.py --cloth_particles 10000 --object_particles 2000 --frames 20
+'''
+
+
+def make_cloth(num_particles, height, rng):
+    # square cloth of about num_particles particles, sagging around the origin at the given height
+    side = int(np.ceil(np.sqrt(num_particles)))
+    x, z = np.meshgrid(np.linspace(-1, 1, side), np.linspace(-1, 1, side))
+    y = height - 0.4 * np.exp(-(x ** 2 + z ** 2) / 0.3) + rng.normal(scale=0.002, size=x.shape)
+    cloth = np.stack([x, y, z], -1).reshape(-1, 3)[:num_particles]
+    return cloth.astype(np.float32)
+
+
+def make_object(num_particles, rng, scale=0.3):
+    # particles on the surface of a box at the origin, like a Flex solid
+    points = rng.uniform(-scale, scale, size=(num_particles, 3))
+    axis = rng.randint(0, 3, num_particles)
+    points[np.arange(num_particles), axis] = scale * np.sign(rng.uniform(-1, 1, num_particles))
+    return points.astype(np.float32)
+
+
+def measure(func, *args):
+    # output, seconds and peak memory (MB) of func(*args)
+    tracemalloc.start()
+    start = time.time()
+    out = func(*args)
+    seconds = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return out, seconds, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cloth_particles', type=int, default=10000, help='number of particles of the cloth')
+    parser.add_argument('--object_particles', type=int, default=2000, help='number of particles of the zone object')
+    parser.add_argument('--frames', type=int, default=20, help='number of frames, from the cloth above the object to draped on it')
+    parser.add_argument('--collision_thresh', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    zone = make_object(args.object_particles, rng)
+    methods = [('full array', pd.get_min_distance_brute_force),
+               ('blocks', lambda p1, p2, t: pd.get_min_distance(p1, p2, t, use_tree=False))]
+    if pd.cKDTree is not None:
+        methods.append(('kd-tree', pd.get_min_distance))
+    else:
+        print('scipy is not installed, skipping the kd-tree')
+    totals = {name: [0.0, 0.0] for name, _ in methods}
+    num_collisions = 0
+    for frame, height in enumerate(np.linspace(1.5, 0.5, args.frames)):
+        cloth = make_cloth(args.cloth_particles, height, rng)
+        results = {}
+        for name, method in methods:
+            results[name], seconds, peak = measure(method, cloth, zone, args.collision_thresh)
+            totals[name][0] += seconds
+            totals[name][1] = max(totals[name][1], peak)
+        expected = results['full array']
+        for name, (min_dist, collision) in results.items():
+            assert min_dist == expected[0] and type(min_dist) == type(expected[0]), (frame, name, min_dist, expected[0])
+            assert collision == expected[1] and type(collision) == type(expected[1]), (frame, name, collision, expected[1])
+        num_collisions += bool(expected[1])
+
+    print('{} frames of {} cloth and {} object particles ({} colliding), same min_dist and collision with all methods'.format(
+        args.frames, len(cloth), len(zone), num_collisions))
+    for name, (seconds, peak) in totals.items():
+        print('{:>10}: {:8.2f} ms/frame, peak memory {:8.1f} MB ({:.1f}x faster than the full array)'.format(
+            name, 1000 * seconds / args.frames, peak, totals['full array'][0] / max(seconds, 1e-9)))
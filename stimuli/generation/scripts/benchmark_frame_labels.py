@@ -0,0 +1,126 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'controllers'))
+from frame_labels import FrameLabelBuffer, read_frame_label, wrap_label_func
+
+'''
+Compares the per-frame label layout of the controllers (frames/<frame>/labels/<label>) with the consolidated one
+(--consolidated_labels, see controllers/frame_labels.py) on synthetic trials with the labels of Tower: checks that
+both layouts give the same labels and reports the time to write them, the file size and the time to read them, e.g.:
+python benchmark_frame_labels.py --num_trials 20 --num_frames 300
+'''
+
+LABELS = ['trial_end', 'trial_timeout', 'trial_complete', 'has_target', 'has_zone', 'target_delta_position',
+          'target_has_moved', 'target_on_ground', 'target_contacting_zone', 'did_fall']
+
+
+def make_frame_labels(num_frames, seed=0):
+    '''
+    output: list with the labels (dict of label -> value) of every frame of a synthetic trial
+    '''
+    rng = np.random.RandomState(seed)
+    contact_frame = rng.randint(num_frames // 4, num_frames)
+    delta = np.cumsum(rng.normal(scale=0.01, size=(num_frames, 3)), axis=0)
+    frames = []
+    for frame in range(num_frames):
+        done = frame == num_frames - 1
+        frames.append({
+            'trial_end': done, 'trial_timeout': False, 'trial_complete': done,
+            'has_target': True, 'has_zone': True,
+            'target_delta_position': delta[frame].astype(np.float32),
+            'target_has_moved': bool(np.sqrt((delta[frame] ** 2).sum()) > 0.01),
+            'target_on_ground': frame >= contact_frame,
+            'target_contacting_zone': frame >= contact_frame,
+            'did_fall': frame >= 30 and frame >= contact_frame})
+    return frames
+
+
+def write_trial(path, frame_labels, consolidated=False):
+    '''
+    write a trial the way the controllers do: a group per frame with some object data, and the labels written by
+    the _write_frame_labels chain (the last one, did_fall, by the subclass after the buffer was flushed)
+    '''
+    buffer = FrameLabelBuffer() if consolidated else None
+    with h5py.File(path, 'w') as f:
+        f.create_group('static').create_dataset('num_objects', data=5)
+        frames_grp = f.create_group('frames')
+        for frame, values in enumerate(frame_labels):
+            frame_grp = frames_grp.create_group('{:04d}'.format(frame))
+            frame_grp.create_group('objects').create_dataset('positions', data=np.zeros((5, 3), dtype=np.float32))
+            if consolidated:
+                frame_grp = buffer.frame_group(frame_grp)
+            labels = frame_grp.create_group('labels')
+            for name in LABELS[:-1]:
+                labels.create_dataset(name, data=values[name])
+            if consolidated and values['trial_end']:
+                buffer.flush()
+            labels.create_dataset('did_fall', data=values['did_fall'])
+
+
+def first_target_contact_frame(f):
+    # a label function written for the per-frame layout
+    for frame, key in enumerate(f['frames'].keys()):
+        if f['frames'][key]['labels']['target_contacting_zone'][()]:
+            return frame
+    return None
+
+
+def time_write(paths, frame_labels, consolidated):
+    start = time.time()
+    for path, labels in zip(paths, frame_labels):
+        write_trial(path, labels, consolidated)
+    return time.time() - start
+
+
+def time_read(paths, func):
+    start = time.time()
+    out = []
+    for path in paths:
+        with h5py.File(path, 'r') as f:
+            out.append(func(f))
+    return out, time.time() - start
+
+
+def read_all_labels(f):
+    return {name: read_frame_label(f, name) for name in LABELS}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_trials', type=int, default=20, help='number of synthetic trials')
+    parser.add_argument('--num_frames', type=int, default=300, help='number of frames per trial')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        frame_labels = [make_frame_labels(args.num_frames, seed) for seed in range(args.num_trials)]
+        results = {}
+        for layout, consolidated in [('per-frame', False), ('consolidated', True)]:
+            os.makedirs(os.path.join(tmp_dir, layout))
+            paths = [os.path.join(tmp_dir, layout, '{:04d}.hdf5'.format(i)) for i in range(args.num_trials)]
+            write_seconds = time_write(paths, frame_labels, consolidated)
+            size = sum(os.path.getsize(p) for p in paths)
+            labels, read_seconds = time_read(paths, read_all_labels)
+            contact, contact_seconds = time_read(paths, wrap_label_func(first_target_contact_frame))
+            results[layout] = (labels, contact)
+            print('{:>12}: write {:6.1f} ms/trial, {:7.1f} KB/trial, read all labels {:6.2f} ms/trial, '
+                  'first_target_contact_frame {:6.2f} ms/trial'.format(
+                      layout, 1000 * write_seconds / args.num_trials, size / 1024. / args.num_trials,
+                      1000 * read_seconds / args.num_trials, 1000 * contact_seconds / args.num_trials))
+
+        (labels, contact), (consolidated_labels, consolidated_contact) = results['per-frame'], results['consolidated']
+        assert contact == consolidated_contact
+        for trial, consolidated_trial in zip(labels, consolidated_labels):
+            for name in LABELS:
+                assert np.array_equal(trial[name][0], consolidated_trial[name][0]), name
+                assert np.array_equal(trial[name][1], consolidated_trial[name][1]), name
+        print('Both layouts give the same labels')
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'controllers'))
+from image_storage import IMAGES_GROUP, load_storage_policy, get_image_passes, read_image
+from convert_hdf5_storage import convert_file
+
+'''
+Reports, for several storage policies of the image passes (see controllers/image_storage.py), the compression ratio
+(size of the passes as read / size in the file) and the decode speed (MB of passes read per second) of every pass,
+and checks that the lossless policies give back the same passes, e.g. on some HDF5s of a dataset:
+
+python benchmark_image_storage.py --files ~/physion_data/dominoes/train/pilot_dominoes_0mid_d3chairs_o1plants_tdwroom/000*.hdf5
+
+Without --files the trials are synthetic passes (as arrays; the encoded png/jpg passes of TDW cannot be made without
+rendering), so the numbers only show how the policies compare.
+'''
+
+POLICIES = [
+    ('tdw_physics (gzip 4)', {}),
+    ('none', {'default': {'codec': 'none'}}),
+    ('lzf', {'default': {'codec': 'lzf'}}),
+    ('gzip 1', {'default': {'codec': 'gzip', 'level': 1}}),
+    ('gzip 9 + shuffle', {'default': {'codec': 'gzip', 'level': 9, 'shuffle': True}}),
+    ('gzip 4 stacked', {'default': {'stacked': True}}),
+    ('gzip 4 quantized depth', {'_depth': {'depth': 'quantized'}}),
+]
+PLUGIN_POLICIES = [
+    ('zstd 3', {'default': {'codec': 'zstd', 'level': 3}}),
+    ('blosc zstd 5 + shuffle', {'default': {'codec': 'blosc', 'level': 5, 'shuffle': True}}),
+]
+
+
+def make_trial(path, num_frames=50, height=256, width=256, seed=0):
+    '''
+    write a synthetic trial with the passes _img, _id, _depth (24-bit depth packed into RGB), _normals and _flow of
+    a few boxes that move over a floor, per frame and with gzip like tdw_physics
+    '''
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32) / max(height, width)
+    boxes = [(rng.uniform(0.1, 0.6), rng.uniform(0.1, 0.6), rng.uniform(0.1, 0.3), rng.randint(0, 255, 3),
+              rng.normal(scale=0.005, size=2)) for _ in range(5)]
+    with h5py.File(path, 'w') as f:
+        frames_grp = f.create_group('frames')
+        for frame in range(num_frames):
+            img = (np.stack([120 + 60 * y, 110 + 40 * x, 100 + 30 * (x + y)], -1)
+                   + rng.normal(scale=3, size=(height, width, 3)))
+            ids = np.zeros((height, width, 3), dtype=np.uint8)
+            depth = 2.0 + 3.0 * (1 - y)
+            flow = np.zeros((height, width, 3), dtype=np.uint8)
+            for i, (by, bx, size, color, velocity) in enumerate(boxes):
+                by, bx = by + frame * velocity[0], bx + frame * velocity[1]
+                mask = (y > by) & (y < by + size) & (x > bx) & (x < bx + size)
+                img[mask] = color + 20 * (y[mask, None] - by)
+                ids[mask] = (i + 1) * 40
+                depth[mask] = 1.5 + 0.2 * i + 0.5 * (x[mask] - bx)
+                flow[mask] = np.clip(128 + 2000 * np.array([velocity[0], velocity[1], 0]), 0, 255)
+            code = np.round(depth / 10.0 * (256 ** 3 - 1)).astype(np.uint32)
+            packed = np.stack([code >> 16, (code >> 8) & 255, code & 255], -1).astype(np.uint8)
+            normals = np.zeros((height, width, 3), dtype=np.uint8)
+            normals[..., 1] = 255
+            normals[ids[..., 0] > 0] = (128, 128, 255)
+            images = frames_grp.create_group('{:04d}'.format(frame)).create_group('images')
+            for pass_mask, data in [('_img', np.clip(img, 0, 255).astype(np.uint8)), ('_id', ids),
+                                    ('_depth', packed), ('_normals', normals), ('_flow', flow)]:
+                images.create_dataset(pass_mask, data=data, compression='gzip')
+
+
+def get_stored_bytes(f, pass_mask):
+    if IMAGES_GROUP in f and pass_mask in f[IMAGES_GROUP]:
+        return f[IMAGES_GROUP][pass_mask].id.get_storage_size()
+    return sum(f['frames'][key]['images'][pass_mask].id.get_storage_size() for key in f['frames'].keys())
+
+
+def read_pass(path, pass_mask):
+    '''
+    output: list of the pass in every frame, and the seconds it took to read them
+    '''
+    start = time.time()
+    with h5py.File(path, 'r') as f:
+        frame_keys = list(f['frames'].keys())
+        images = [read_image(f, frame, pass_mask, frame_keys=frame_keys) for frame in range(len(frame_keys))]
+    return images, time.time() - start
+
+
+def benchmark_policy(paths, policy, tmp_dir):
+    '''
+    output: dict of pass -> (compression ratio, decode MB/s, maximum difference to the original), and the total size
+    of the converted files in bytes
+    '''
+    policy = load_storage_policy(policy)
+    converted = [os.path.join(tmp_dir, '{:04d}.hdf5'.format(i)) for i in range(len(paths))]
+    size = sum(convert_file(src, dst, policy)[1] for src, dst in zip(paths, converted))
+    with h5py.File(paths[0], 'r') as f:
+        passes = get_image_passes(f)
+    results = {}
+    for pass_mask in passes:
+        raw_bytes, stored_bytes, seconds, max_diff = 0, 0, 0.0, 0
+        for src, dst in zip(paths, converted):
+            with h5py.File(dst, 'r') as f:
+                stored_bytes += get_stored_bytes(f, pass_mask)
+            images, read_seconds = read_pass(dst, pass_mask)
+            originals, _ = read_pass(src, pass_mask)
+            seconds += read_seconds
+            raw_bytes += sum(image.nbytes for image in originals)
+            for image, original in zip(images, originals):
+                if image.shape != original.shape:
+                    max_diff = np.inf
+                elif image.size > 0:
+                    max_diff = max(max_diff, int(np.abs(image.astype(np.int64) - original.astype(np.int64)).max()))
+        results[pass_mask] = (raw_bytes / max(stored_bytes, 1), raw_bytes / 1e6 / max(seconds, 1e-9), max_diff)
+    for path in converted:
+        os.remove(path)
+    return results, size
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=str, nargs='*', default=None, help='HDF5s to benchmark on (default: synthetic trials)')
+    parser.add_argument('--num_trials', type=int, default=2, help='number of synthetic trials')
+    parser.add_argument('--num_frames', type=int, default=50, help='number of frames per synthetic trial')
+    parser.add_argument('--size', type=int, default=256, help='height and width of the synthetic passes')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        paths = args.files
+        if not paths:
+            paths = [os.path.join(tmp_dir, 'synthetic_{:04d}.hdf5'.format(i)) for i in range(args.num_trials)]
+            for i, path in enumerate(paths):
+                make_trial(path, args.num_frames, args.size, args.size, seed=i)
+        policies = POLICIES
+        try:
+            import hdf5plugin
+            policies = POLICIES + PLUGIN_POLICIES
+        except ImportError:
+            print('hdf5plugin is not installed, skipping {}'.format(', '.join(name for name, _ in PLUGIN_POLICIES)))
+
+        os.makedirs(os.path.join(tmp_dir, 'converted'))
+        print('{:<24} {:<9} {:>7} {:>11} {:>9}'.format('policy', 'pass', 'ratio', 'decode MB/s', 'max diff'))
+        for name, policy in policies:
+            results, size = benchmark_policy(paths, policy, os.path.join(tmp_dir, 'converted'))
+            for pass_mask, (ratio, mb_per_second, max_diff) in results.items():
+                print('{:<24} {:<9} {:>6.2f}x {:>11.1f} {:>9}'.format(name, pass_mask, ratio, mb_per_second, max_diff))
+            print('{:<24} {:<9} {:>6.1f} MB per trial'.format(name, 'file', size / 1e6 / len(paths)))
+    finally:
+        shutil.rmtree(tmp_dir)
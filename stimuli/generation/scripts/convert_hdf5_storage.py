@@ -0,0 +1,108 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+import h5py
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'controllers'))
+from image_storage import IMAGES_GROUP, load_storage_policy, get_image_passes, read_image, write_image
+
+'''
+Rewrites existing HDF5s with another storage policy for their image passes (see controllers/image_storage.py), e.g.
+to store the depth of a dataset quantized and all passes with stronger compression:
+
+python convert_hdf5_storage.py --files ~/physion_data/dominoes/train/*/*.hdf5 --output_dir ~/physion_data/dominoes/converted \
+    --policy '{"default": {"codec": "gzip", "level": 9, "shuffle": true}, "_depth": {"depth": "quantized"}}'
+
+The files are converted by a pool of processes. Everything but the image passes is copied as it is. Without
+--output_dir the files are replaced (each is written to a temporary file first). In an output_dir, the files keep
+their path relative to the common directory of the inputs, and the metadata.json and trial_stats.json of their
+directories are copied along.
+'''
+
+
+def convert_file(src_path, dst_path, policy):
+    '''
+    write the HDF5 at src_path to dst_path with the image passes stored with the policy
+    output: (size of src_path, size of dst_path) in bytes
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(dst_path)), exist_ok=True)
+    tmp_path = dst_path + '.tmp'
+    with h5py.File(src_path, 'r') as src, h5py.File(tmp_path, 'w') as dst:
+        for key, value in src.attrs.items():
+            dst.attrs[key] = value
+        for name in src.keys():
+            if name not in ['frames', IMAGES_GROUP]:
+                src.copy(src[name], dst, name=name)
+        passes = get_image_passes(src)
+        frames_grp = dst.create_group('frames')
+        frame_keys = list(src['frames'].keys())
+        for frame, key in enumerate(frame_keys):
+            frame_grp = frames_grp.create_group(key)
+            for attr, value in src['frames'][key].attrs.items():
+                frame_grp.attrs[attr] = value
+            for name in src['frames'][key].keys():
+                if name != 'images':
+                    src.copy(src['frames'][key][name], frame_grp, name=name)
+            for pass_mask in passes:
+                write_image(frame_grp, pass_mask, read_image(src, frame, pass_mask, frame_keys=frame_keys), policy)
+    size = os.path.getsize(src_path)
+    os.replace(tmp_path, dst_path)
+    return size, os.path.getsize(dst_path)
+
+
+def _convert(args):
+    src_path, dst_path, policy = args
+    return convert_file(src_path, dst_path, policy)
+
+
+def get_output_paths(paths, output_dir=None):
+    # the inputs keep their path relative to their common directory in output_dir (or are replaced)
+    if output_dir is None:
+        return list(paths)
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths])
+    return [os.path.join(output_dir, os.path.relpath(os.path.abspath(p), root)) for p in paths]
+
+
+def convert_files(paths, policy, output_dir=None, workers=None):
+    '''
+    input:
+        paths: HDF5s to convert
+        policy: storage policy (see image_storage.load_storage_policy)
+        output_dir: where to write the converted files (None: replace them)
+        workers: number of processes (default: number of cpus)
+    output:
+        dict of input path -> (size before, size after)
+    '''
+    policy = load_storage_policy(policy)
+    dst_paths = get_output_paths(paths, output_dir)
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        sizes = list(executor.map(_convert, [(src, dst, policy) for src, dst in zip(paths, dst_paths)], chunksize=4))
+    seconds = time.time() - start
+    if output_dir is not None:
+        for src_dir, dst_dir in sorted(set((os.path.dirname(src), os.path.dirname(dst)) for src, dst in zip(paths, dst_paths))):
+            for name in ['metadata.json', 'trial_stats.json']:
+                if os.path.exists(os.path.join(src_dir, name)) and not os.path.samefile(src_dir, dst_dir):
+                    shutil.copy2(os.path.join(src_dir, name), os.path.join(dst_dir, name))
+    before, after = sum(s[0] for s in sizes), sum(s[1] for s in sizes)
+    print('Converted {} files in {:.1f}s ({:.1f} files/s): {:.1f} MB -> {:.1f} MB ({:.2f}x)'.format(
+        len(paths), seconds, len(paths) / max(seconds, 1e-9), before / 1e6, after / 1e6, before / max(after, 1)))
+    return dict(zip(paths, sizes))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=str, nargs='+', required=True, help='HDF5s, or directories of HDF5s, to convert')
+    parser.add_argument('--policy', type=str, required=True, help='storage policy, as json or a json file')
+    parser.add_argument('--output_dir', type=str, default=None, help='where to write the converted files (default: replace them)')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: number of cpus)')
+    args = parser.parse_args()
+
+    files = []
+    for path in args.files:
+        files += sorted(glob(os.path.join(path, '*.hdf5'))) if os.path.isdir(path) else [path]
+    convert_files(files, args.policy, args.output_dir, args.workers)
@@ -0,0 +1,479 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+from glob import glob
+import numpy as np
+
+'''
+Runs the trials of one or more configs with several controller processes at once, instead of one controller
+process per config as in the bash scripts. The trials of a config are split into contiguous ranges of trial
+indices (shards), and each shard is run by its own controller process with its own port, temp file and output
+directory. When all shards of a config are done, their files are moved into the output directory of the config and
+their metadata.json files are merged and trial_stats.json is recomputed from the labels of all HDF5s of the config,
+as the controllers compute it (the labels in metadata.json are rounded, so their average can differ in the last
+decimal).
+
+The split only depends on the number of trials and shards. Since the controllers name the trials and seed them by
+their index (trial_seed = MAX_TRIALS * seed + trial index when --random 0), the trials are the same as the ones of a
+serial run with the same arguments. Configs that are generated with --random 1 (the default, unless
+--training_data_mode, --readout_data_mode or --random 0 is given) are random either way.
+
+A shard that starts at trial index i > 0 relies on the controllers (tdw_physics) skipping the trials up to the
+highest index that is already in their output directory: an empty placeholder file (i-1).hdf5 is put there before
+the shard starts and removed once its first trial has started. Shards that were interrupted continue where they
+stopped when the script is run again.
+
+Arguments that are not listed below are passed to every controller process, e.g. to generate training data
+(see generate_train_and_readout_data.sh):
+python generate_parallel.py --configs ../configs/dominoes/* --output_dir ~/physion_data/dominoes/train --workers 8 \
+    --height 256 --width 256 --seed 0 --save_passes '' --write_passes '_img,_id' --save_meshes \
+    --num_multiplier 7.25 --training_data_mode
+
+The controller can be any script with the same command line (--dir, --num, --port, --temp), so the scheduling and
+merging can be checked with a fake controller that writes files instead of running TDW (see --controller).
+'''
+
+SHARD_DIR = '.shards'
+TRIAL_FILE = re.compile(r'^(\d+)\.hdf5$')
+# files that every shard writes; the merged ones are written from the metadata of all shards, the other ones are
+# taken from the last shard (the only one that was run with --num of the whole config)
+MERGED_FILES = ['metadata.json', 'trial_stats.json']
+ARGS_FILES = ['commandline_args.txt', 'args.txt']
+POLL_INTERVAL = 0.1
+LABEL_DECIMALS = 3
+
+
+def get_controller(config_dir, controller_dir='../controllers'):
+    '''
+    controller script of a config, as in the bash scripts: the one named after the scenario, except for the
+    collision configs of roll, which use collide.py
+    '''
+    scenario = os.path.basename(os.path.dirname(os.path.abspath(config_dir)))
+    if scenario == 'roll' and 'collision' in os.path.basename(os.path.abspath(config_dir)):
+        return os.path.join(controller_dir, 'collide.py')
+    return os.path.join(controller_dir, scenario + '.py')
+
+
+def read_controller_args(config_dir, extra_args=[]):
+    '''
+    output: the arguments of the controllers that decide which trials a run produces, as the controller would
+        parse them from commandline_args.txt of the config followed by extra_args
+    '''
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@', allow_abbrev=False, add_help=False)
+    parser.add_argument('--num', type=int, default=3000)
+    parser.add_argument('--num_multiplier', type=float, default=1.0)
+    parser.add_argument('--random', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--training_data_mode', action='store_true')
+    parser.add_argument('--readout_data_mode', action='store_true')
+    args, _ = parser.parse_known_args(['@' + os.path.join(config_dir, 'commandline_args.txt')] + list(extra_args))
+    return args
+
+
+def get_num_trials(args):
+    # same as the postprocessing of the controller arguments (get_args in dominoes.py)
+    if args.training_data_mode or args.readout_data_mode:
+        return int(float(args.num) * args.num_multiplier)
+    return args.num
+
+
+def is_random(args):
+    return not (args.training_data_mode or args.readout_data_mode) and args.random != 0
+
+
+def split_trials(start, stop, num_shards):
+    '''
+    output: list of (start, stop) of contiguous ranges of trial indices that cover [start, stop), the sizes of the
+        ranges differ by at most one. There are no empty ranges, so there are fewer shards than num_shards if there
+        are fewer trials.
+    '''
+    num_shards = max(1, min(num_shards, stop - start))
+    bounds = start + (np.arange(num_shards + 1) * (stop - start)) // num_shards
+    return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def get_trial_indices(path):
+    # indices of the trials in a directory (files 0000.hdf5, 0001.hdf5, ...)
+    if not os.path.isdir(path):
+        return []
+    return sorted(int(m.group(1)) for m in (TRIAL_FILE.match(f) for f in os.listdir(path)) if m is not None)
+
+
+def get_trial_path(path, index):
+    return os.path.join(path, '{:04d}.hdf5'.format(index))
+
+
+def get_shard_dir(output_dir, shard_num):
+    # the shard directory has the same name as the output directory, because the stimulus names are made from it
+    output_dir = os.path.abspath(output_dir)
+    return os.path.join(output_dir, SHARD_DIR, str(shard_num), os.path.basename(output_dir))
+
+
+def plan_config(config_dir, output_dir, num_shards, extra_args=[], controller=None, controller_dir='../controllers'):
+    '''
+    output: dict describing the shards of a config (see make_plan). Trials that are already in output_dir are not
+        generated again, as the controllers do: generation continues after the highest trial index there.
+    '''
+    args = read_controller_args(config_dir, extra_args)
+    existing = get_trial_indices(output_dir)
+    first = existing[-1] + 1 if len(existing) > 0 else 0
+    ranges = split_trials(first, get_num_trials(args), num_shards)
+    return make_plan(config_dir, output_dir, ranges, extra_args, controller, controller_dir)
+
+
+def make_plan(config_dir, output_dir, ranges, extra_args=[], controller=None, controller_dir='../controllers'):
+    '''
+    input:
+        ranges: list of (start, stop) of the trial indices of each shard
+    output:
+        dict describing the shards of a config: controller, total number of trials, and a list of shards, each a
+        dict with its trial range and directory
+    '''
+    args = read_controller_args(config_dir, extra_args)
+    shards = []
+    for shard_num, (start, stop) in enumerate(ranges):
+        shard_dir = get_shard_dir(output_dir, shard_num)
+        shards.append({'config': config_dir, 'shard': shard_num, 'start': start, 'stop': stop, 'dir': shard_dir,
+                       'done': set(range(start, stop)) <= set(get_trial_indices(shard_dir))})
+    return {'config': os.path.abspath(config_dir), 'output_dir': os.path.abspath(output_dir),
+            'num_trials': get_num_trials(args), 'first': ranges[0][0] if len(ranges) > 0 else get_num_trials(args),
+            'random': is_random(args), 'extra_args': list(extra_args), 'shards': shards,
+            'controller': os.path.abspath(controller if controller is not None else get_controller(config_dir, controller_dir)),
+            'multiplied': args.training_data_mode or args.readout_data_mode}
+
+
+def get_shard_command(plan, shard, port, temp_path, gpu=None, python=sys.executable):
+    '''
+    output: command line of the controller process of a shard: the arguments of the config and the extra
+        arguments, followed by the ones of the shard (which override them)
+    '''
+    cmd = [python, plan['controller'], '@' + os.path.join(plan['config'], 'commandline_args.txt')]
+    cmd += plan['extra_args']
+    cmd += ['--dir', shard['dir'], '--num', str(shard['stop']), '--port', str(port), '--temp', temp_path]
+    if plan['multiplied']:
+        # --num is the number of trials already, it must not be multiplied again
+        cmd += ['--num_multiplier', '1']
+    if gpu is not None:
+        cmd += ['--gpu', str(gpu)]
+    return cmd
+
+
+def start_shard(plan, shard, port, gpu=None, python=sys.executable):
+    '''
+    start the controller process of a shard. Its output goes to log.txt next to the shard directory.
+    output: dict with the process and what is needed to follow it
+    '''
+    os.makedirs(shard['dir'], exist_ok=True)
+    shard_root = os.path.dirname(shard['dir'])
+    temp_path = os.path.join(shard_root, 'temp.hdf5')
+    placeholder = None
+    existing = get_trial_indices(shard['dir'])
+    if shard['start'] > 0 and (len(existing) == 0 or existing[-1] < shard['start'] - 1):
+        # make the controller skip the trials before the shard
+        placeholder = get_trial_path(shard['dir'], shard['start'] - 1)
+        open(placeholder, 'w').close()
+    meta_path = os.path.join(shard['dir'], 'metadata.json')
+    if os.path.exists(meta_path):
+        # a controller that continues an interrupted shard only writes the labels of the trials it generates
+        os.replace(meta_path, os.path.join(shard_root, 'metadata-{}.json'.format(len(get_saved_metadata(shard)))))
+    cmd = get_shard_command(plan, shard, port, temp_path, gpu, python)
+    log = open(os.path.join(shard_root, 'log.txt'), 'a')
+    log.write(' '.join(cmd) + '\n')
+    log.flush()
+    process = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+    return {'plan': plan, 'shard': shard, 'process': process, 'log': log, 'port': port, 'placeholder': placeholder,
+            'temp_path': temp_path, 'start_time': time.time(), 'num_before': count_shard_trials(shard)}
+
+
+def get_saved_metadata(shard):
+    # metadata of the earlier runs of a shard, oldest first
+    shard_root = os.path.dirname(shard['dir'])
+    paths = [f for f in os.listdir(shard_root) if re.match(r'^metadata-\d+\.json$', f)]
+    return [os.path.join(shard_root, f) for f in sorted(paths, key=lambda f: int(f[9:-5]))]
+
+
+def count_shard_trials(shard):
+    return len([i for i in get_trial_indices(shard['dir']) if shard['start'] <= i < shard['stop']])
+
+
+def remove_placeholder(running):
+    '''
+    remove the placeholder of a shard once the controller has started its first trial, i.e. is past the trials it
+    skips (the controllers also compute trial_stats.json from all trial files in the directory at the end)
+    '''
+    placeholder = running['placeholder']
+    if placeholder is None:
+        return
+    started = os.path.exists(running['temp_path']) or count_shard_trials(running['shard']) > 0
+    if started or running['process'].poll() is not None:
+        if os.path.exists(placeholder):
+            os.remove(placeholder)
+        running['placeholder'] = None
+
+
+def run_shards(plans, workers=4, base_port=1071, gpus=None, python=sys.executable, report_interval=60):
+    '''
+    run the shards of all plans that are not done yet, at most workers at a time. Every running shard gets its own
+    port (base_port, base_port + 1, ...) and its own temp file.
+    input:
+        plans: list of plans (see plan_config)
+        gpus: list of gpus that are given to the shards in turn, or None to leave --gpu to the extra arguments
+    output:
+        list of dicts with config, shard, return code, number of trials generated and seconds, one per shard run
+    '''
+    queue = [(plan, shard) for plan in plans for shard in plan['shards'] if not shard['done']]
+    free_slots = list(range(workers))
+    running, results = [], []
+    start, last_report = time.time(), time.time()
+    while len(queue) > 0 or len(running) > 0:
+        while len(queue) > 0 and len(free_slots) > 0:
+            plan, shard = queue.pop(0)
+            slot = free_slots.pop(0)
+            gpu = gpus[slot % len(gpus)] if gpus else None
+            print('Starting shard {} of {} (trials {}-{}) on port {}'.format(
+                shard['shard'], plan['config'], shard['start'], shard['stop'] - 1, base_port + slot))
+            r = start_shard(plan, shard, base_port + slot, gpu, python)
+            r['slot'] = slot
+            running.append(r)
+
+        time.sleep(POLL_INTERVAL)
+        for r in list(running):
+            remove_placeholder(r)
+            returncode = r['process'].poll()
+            if returncode is None:
+                continue
+            remove_placeholder(r)
+            r['log'].close()
+            running.remove(r)
+            free_slots.append(r['slot'])
+            shard = r['shard']
+            shard['done'] = count_shard_trials(shard) == shard['stop'] - shard['start']
+            result = {'config': r['plan']['config'], 'shard': shard['shard'], 'returncode': returncode,
+                      'trials': count_shard_trials(shard) - r['num_before'], 'seconds': time.time() - r['start_time']}
+            results.append(result)
+            log_path = os.path.join(os.path.dirname(shard['dir']), 'log.txt')
+            if not shard['done']:
+                print('Shard {} of {} failed with return code {}, see {}'.format(
+                    shard['shard'], r['plan']['config'], returncode, log_path))
+            else:
+                if returncode != 0:
+                    # e.g. computing its own trial_stats.json, which is recomputed when the shards are merged
+                    print('Shard {} of {} wrote all its trials but exited with return code {}, see {}'.format(
+                        shard['shard'], r['plan']['config'], returncode, log_path))
+                print('Finished shard {} of {}: {} trials in {:.0f}s ({:.1f} trials/hour)'.format(
+                    shard['shard'], r['plan']['config'], result['trials'], result['seconds'],
+                    trials_per_hour(result['trials'], result['seconds'])))
+
+        if time.time() - last_report > report_interval and len(running) > 0:
+            num_trials = sum(count_shard_trials(r['shard']) - r['num_before'] for r in running) + sum(
+                res['trials'] for res in results)
+            print('{} trials in {:.0f}s ({:.1f} trials/hour), {} shards running, {} waiting'.format(
+                num_trials, time.time() - start, trials_per_hour(num_trials, time.time() - start), len(running), len(queue)))
+            last_report = time.time()
+    return results
+
+
+def trials_per_hour(num_trials, seconds):
+    return num_trials * 3600. / max(seconds, 1e-9)
+
+
+class LabelEncoder(json.JSONEncoder):
+    # numpy values that the label functions return; their floats are rounded as in the controllers' metadata.json
+    def default(self, obj):
+        if isinstance(obj, np.floating):
+            return round(float(obj), LABEL_DECIMALS)
+        if isinstance(obj, np.integer):
+            return int(obj)
+        if isinstance(obj, np.bool_):
+            return bool(obj)
+        if isinstance(obj, np.ndarray):
+            return obj[()] if obj.ndim == 0 else list(obj)
+        return super().default(obj)
+
+
+def average_label(values):
+    '''
+    average of a label over trials as in trial_stats.json: the mean of the values that are not None or NaN (per key
+    for dicts, per element for lists), rounded to 3 decimals, and the first value for strings. The values have to be
+    the ones the label functions return: averaging the rounded values of metadata.json can round the other way.
+    '''
+    values = [v.tolist() if isinstance(v, np.ndarray) else v for v in values if v is not None]
+    if len(values) == 0:
+        return None
+    if isinstance(values[0], str):
+        return values[0]
+    if isinstance(values[0], dict):
+        return {k: average_label([v.get(k) for v in values]) for k in values[0]}
+    if isinstance(values[0], list):
+        return [average_label([v[i] for v in values if len(v) > i]) for i in range(len(values[0]))]
+    values = [v for v in (float(v) for v in values) if not np.isnan(v)]
+    if len(values) == 0:
+        return None
+    return round(float(np.mean(values)), LABEL_DECIMALS)
+
+
+def get_trial_stats(labels):
+    '''
+    input: list of the labels of the trials, as the label functions return them (see relabel_dataset.label_files)
+    output: dict of label/avg_label -> average over the trials, the range of stimulus names, and num_trials
+    '''
+    stats = {}
+    if len(labels) > 0:
+        for key in labels[0]:
+            if key == 'stimulus_name':
+                stats[key + '/avg_label'] = labels[0][key] + '-' + labels[-1][key]
+            else:
+                stats[key + '/avg_label'] = average_label([l.get(key) for l in labels])
+    stats['num_trials'] = len(labels)
+    return stats
+
+
+def compute_trial_stats(hdf5_dir, controller_path, class_name, workers=None):
+    '''
+    output: trial_stats.json of a directory as the controllers compute it, from the labels of all its HDF5s
+    '''
+    # relabel_dataset imports this module
+    from relabel_dataset import label_files
+    paths = sorted(glob(os.path.join(hdf5_dir, '*.hdf5')))
+    return get_trial_stats(label_files(paths, controller_path, class_name, workers))
+
+
+def load_metadata(meta_path):
+    if not os.path.exists(meta_path):
+        return []
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def write_json(obj, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=4, cls=LabelEncoder)
+    os.replace(tmp_path, path)
+
+
+def merge_shards(plan, remove_shards=True, args_files=True, workers=None):
+    '''
+    move the files of all shards of a config into its output directory, merge their metadata.json with the
+    metadata of the other trials that were there before (in order of trial index) and recompute trial_stats.json
+    from the HDF5s with the label functions of the controller. Only merges if all shards are done.
+    input:
+        args_files: also move commandline_args.txt and args.txt of the shards (those of the last shard are kept)
+        workers: number of processes that compute the labels for trial_stats.json (default: number of cpus)
+    output:
+        merged metadata, or None if some shards are not done
+    '''
+    output_dir = plan['output_dir']
+    if not all(shard['done'] for shard in plan['shards']):
+        return None
+    os.makedirs(output_dir, exist_ok=True)
+    generated = set(i for shard in plan['shards'] for i in range(shard['start'], shard['stop']))
+    metadata = [m for m in load_metadata(os.path.join(output_dir, 'metadata.json')) if trial_index(m) not in generated]
+    for shard in plan['shards']:
+        shard_metadata = {}
+        for meta_path in get_saved_metadata(shard) + [os.path.join(shard['dir'], 'metadata.json')]:
+            shard_metadata.update({trial_index(m): m for m in load_metadata(meta_path)})
+        for i in range(shard['start'], shard['stop']):
+            if i in shard_metadata:
+                metadata.append(shard_metadata[i])
+        for root, _, files in os.walk(shard['dir']):
+            rel_root = os.path.relpath(root, shard['dir'])
+            os.makedirs(os.path.join(output_dir, rel_root), exist_ok=True)
+            for f in files:
+                rel_path = os.path.normpath(os.path.join(rel_root, f))
+                if rel_path in MERGED_FILES:
+                    continue
+                m = TRIAL_FILE.match(f) if rel_root == '.' else None
+                if m is not None and not shard['start'] <= int(m.group(1)) < shard['stop']:
+                    continue
+                if rel_path in ARGS_FILES:
+                    if not args_files:
+                        continue
+                    replace_in_file(os.path.join(root, f), shard['dir'], output_dir)
+                os.replace(os.path.join(root, f), os.path.join(output_dir, rel_path))
+
+    metadata = sorted(metadata, key=lambda m: -1 if trial_index(m) is None else trial_index(m))
+    if len(metadata) > 0:
+        write_json(metadata, os.path.join(output_dir, 'metadata.json'))
+        stats_path = os.path.join(output_dir, 'trial_stats.json')
+        try:
+            stats = compute_trial_stats(output_dir, plan['controller'], metadata[0]['controller_name'], workers)
+        except Exception as e:
+            # e.g. a controller without label functions; stats of only some of the trials would be wrong
+            print('Could not compute the trial stats of {} ({}), run relabel_dataset.py on it'.format(output_dir, e))
+            if os.path.exists(stats_path):
+                os.remove(stats_path)
+        else:
+            write_json(stats, stats_path)
+    if remove_shards:
+        shutil.rmtree(os.path.join(output_dir, SHARD_DIR), ignore_errors=True)
+    return metadata
+
+
+def trial_index(meta):
+    # trial index from the stimulus name (<config name>_<index>)
+    m = re.search(r'_(\d+)$', meta.get('stimulus_name', ''))
+    return int(m.group(1)) if m is not None else None
+
+
+def replace_in_file(path, old, new):
+    # point the saved arguments to the output directory instead of the shard directory
+    with open(path) as f:
+        text = f.read()
+    with open(path, 'w') as f:
+        f.write(text.replace(old, new))
+
+
+def run_configs(configs, output_dir, workers=4, num_shards=None, extra_args=[], controller=None,
+                controller_dir='../controllers', base_port=1071, gpus=None, python=sys.executable):
+    '''
+    generate the trials of every config into output_dir/<config name> with a pool of workers controller
+    processes, and merge the shards of every config that has all its shards done.
+    output: dict of config -> merged metadata (None for the configs that failed)
+    '''
+    num_shards = workers if num_shards is None else num_shards
+    plans = [plan_config(c, os.path.join(output_dir, os.path.basename(os.path.normpath(c))), num_shards, extra_args,
+                         controller, controller_dir) for c in configs]
+    for plan in plans:
+        if plan['random']:
+            print('Warning: {} is generated with --random 1, the trials will differ from a serial run'.format(plan['config']))
+        if len(plan['shards']) == 0:
+            print('{}: all {} trials are in {}'.format(plan['config'], plan['num_trials'], plan['output_dir']))
+        else:
+            print('{}: trials {}-{} in {} shards -> {}'.format(plan['config'], plan['first'], plan['num_trials'] - 1,
+                                                              len(plan['shards']), plan['output_dir']))
+    start = time.time()
+    results = run_shards(plans, workers, base_port, gpus, python)
+    seconds = time.time() - start
+    merged = {plan['config']: merge_shards(plan) for plan in plans}
+    num_trials = sum(r['trials'] for r in results)
+    failed = [c for c, m in merged.items() if m is None]
+    print('Generated {} trials of {} configs in {:.0f}s ({:.1f} trials/hour), {} configs failed{}'.format(
+        num_trials, len(configs), seconds, trials_per_hour(num_trials, seconds), len(failed),
+        ': ' + ', '.join(failed) if len(failed) > 0 else ''))
+    return merged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate the trials of configs with several controller processes. '
+                                                 'Unknown arguments are passed to the controllers.')
+    parser.add_argument('--configs', type=str, nargs='+', required=True, help='config directories, e.g. ../configs/dominoes/*')
+    parser.add_argument('--output_dir', type=str, default=os.path.join(os.path.expanduser('~'), 'physion_data'),
+                        help='the trials of each config go to output_dir/<config name>')
+    parser.add_argument('--workers', type=int, default=4, help='number of controller processes at a time')
+    parser.add_argument('--num_shards', type=int, default=None, help='shards per config (default: workers)')
+    parser.add_argument('--controller', type=str, default=None, help='controller script for all configs (default: by scenario)')
+    parser.add_argument('--controller_dir', type=str, default='../controllers')
+    parser.add_argument('--base_port', type=int, default=1071, help='worker n uses port base_port + n')
+    parser.add_argument('--gpus', type=str, default=None, help='comma-separated gpus that are given to the workers in turn')
+    args, extra_args = parser.parse_known_args()
+
+    configs = [c for c in args.configs if os.path.exists(os.path.join(c, 'commandline_args.txt'))]
+    merged = run_configs(configs, args.output_dir, args.workers, args.num_shards, extra_args, args.controller,
+                         args.controller_dir, args.base_port, args.gpus.split(',') if args.gpus else None)
+    sys.exit(0 if all(m is not None for m in merged.values()) else 1)
@@ -0,0 +1,176 @@
+import os
+import re
+import sys
+import json
+import argparse
+from glob import glob
+
+from generate_parallel import read_controller_args, is_random, make_plan, run_shards, merge_shards, trials_per_hour
+
+'''
+Regenerates individual stimuli by name instead of rerunning the whole batch of a config. The stimulus names are
+looked up in an index built from the metadata.json files of the configs, which gives the config, its seed and the
+trial number of every stimulus. Only those trials are then run (with generate_parallel.py, one shard per run of
+consecutive trials), and written to output_dir/<stimulus name without trial number>/<trial number>.hdf5 so that
+the regenerated stimuli get the same names as the originals. The metadata.json and trial_stats.json in that
+directory are updated with the regenerated trials.
+
+The controllers seed every trial from the seed of the config and its trial number
+(trial_seed = MAX_TRIALS * seed + trial number), so a single trial can be regenerated without the ones before it.
+
+e.g. to regenerate the stimuli that were flagged as glitchy as human stimuli (see generate_human_stimuli.sh):
+python regenerate_stims.py --stims_file ../../../analysis/manual_stim_evaluation_glitchy_test_stims.txt \
+    --output_dir ~/physion_data/regenerated --height 512 --width 512 --save_passes '_img' --write_passes '_img,_id'
+
+Arguments that are not listed below are passed to the controllers. Use --list to only show what would be run.
+'''
+
+MAX_TRIALS = 1000  # Dominoes.MAX_TRIALS
+STIM_NAME = re.compile(r'^(.*)_(\d+)$')
+
+
+def split_stim_name(name):
+    '''
+    output: (name without trial number, trial number) of a stimulus name, e.g. pilot_dominoes_4mid_boxroom_0003 ->
+        (pilot_dominoes_4mid_boxroom, 3). Suffixes of the human stimuli (-redyellow) and file extensions are removed.
+    '''
+    name = os.path.basename(name.strip())
+    name = re.sub(r'\.(hdf5|mp4|png|gif)$', '', name)
+    name = re.sub(r'(_img)?(-redyellow)?$', '', name)
+    m = STIM_NAME.match(name)
+    if m is None:
+        raise ValueError("{} is not a stimulus name (<config name>_<trial number>)".format(name))
+    return m.group(1), int(m.group(2))
+
+
+def build_stim_index(configs_dir='../configs'):
+    '''
+    input:
+        configs_dir: directory with the configs, as <scenario>/<config>/{commandline_args.txt, metadata.json}
+    output:
+        dict of stimulus name -> dict with config (directory), scenario, seed, trial and trial_seed, from the
+        metadata.json of every config, and dict of stimulus name without trial number -> config, to find the
+        configs of stimuli that are not in their metadata (e.g. training or readout stimuli)
+    '''
+    index, prefixes = {}, {}
+    for meta_path in sorted(glob(os.path.join(configs_dir, '*', '*', 'metadata.json'))):
+        config_dir = os.path.dirname(meta_path)
+        if not os.path.exists(os.path.join(config_dir, 'commandline_args.txt')):
+            continue
+        args = read_controller_args(config_dir)
+        with open(meta_path) as f:
+            metadata = json.load(f)
+        mismatched = []
+        for meta in metadata:
+            prefix, trial = split_stim_name(meta['stimulus_name'])
+            if meta.get('trial_seed') not in (None, -1, MAX_TRIALS * args.seed + trial):
+                mismatched.append(meta['stimulus_name'])
+            index[prefix + '_{:04d}'.format(trial)] = {
+                'config': config_dir, 'scenario': os.path.basename(os.path.dirname(config_dir)),
+                'seed': args.seed, 'trial': trial, 'trial_seed': meta.get('trial_seed'), 'random': is_random(args)}
+            prefixes[prefix] = config_dir
+        if len(mismatched) > 0:
+            print('Warning: the trial_seed of {} stimuli of {} (e.g. {}) does not match seed {} of the config'.format(
+                len(mismatched), config_dir, mismatched[0], args.seed))
+    return index, prefixes
+
+
+def resolve_stims(names, index, prefixes):
+    '''
+    output: dict of stimulus name -> index entry (see build_stim_index), and list of the names that could not be
+        resolved. Names that are not in the index but whose config is known get the trial number from their name.
+    '''
+    resolved, unresolved = {}, []
+    for name in names:
+        try:
+            prefix, trial = split_stim_name(name)
+        except ValueError:
+            unresolved.append(name)
+            continue
+        stim_name = prefix + '_{:04d}'.format(trial)
+        if stim_name in index:
+            resolved[stim_name] = index[stim_name]
+        elif prefix in prefixes:
+            entry = dict(index[next(k for k in index if index[k]['config'] == prefixes[prefix])])
+            entry.update({'trial': trial, 'trial_seed': None})
+            resolved[stim_name] = entry
+        else:
+            unresolved.append(name)
+    return resolved, unresolved
+
+
+def get_trial_ranges(trials):
+    # consecutive trial numbers as (start, stop) ranges, e.g. [1, 2, 3, 7] -> [(1, 4), (7, 8)]
+    ranges = []
+    for trial in sorted(set(trials)):
+        if len(ranges) > 0 and ranges[-1][1] == trial:
+            ranges[-1] = (ranges[-1][0], trial + 1)
+        else:
+            ranges.append((trial, trial + 1))
+    return ranges
+
+
+def plan_regeneration(resolved, output_dir, extra_args=[], controller=None, controller_dir='../controllers'):
+    '''
+    output: list of plans (see generate_parallel.make_plan), one per config and name of the stimuli, with a shard
+        for every run of consecutive trials
+    '''
+    groups = {}
+    for stim_name, entry in sorted(resolved.items()):
+        prefix, trial = split_stim_name(stim_name)
+        groups.setdefault((entry['config'], prefix), []).append(trial)
+    return [make_plan(config_dir, os.path.join(output_dir, prefix), get_trial_ranges(trials), extra_args, controller,
+                      controller_dir) for (config_dir, prefix), trials in sorted(groups.items())]
+
+
+def regenerate_stims(names, output_dir, configs_dir='../configs', workers=4, extra_args=[], controller=None,
+                     controller_dir='../controllers', base_port=1071, gpus=None, python=sys.executable, dry_run=False):
+    '''
+    regenerate the stimuli with the given names into output_dir
+    output: dict of the output directories -> their merged metadata (None where trials failed), and the list of
+        names that could not be resolved
+    '''
+    index, prefixes = build_stim_index(configs_dir)
+    resolved, unresolved = resolve_stims(names, index, prefixes)
+    for name in unresolved:
+        print('Could not find the config of {}'.format(name))
+    for stim_name, entry in sorted(resolved.items()):
+        if entry['random']:
+            print('Warning: {} was generated with --random 1 and cannot be regenerated exactly'.format(stim_name))
+        print('{} -> {} seed {} trial {}'.format(stim_name, entry['config'], entry['seed'], entry['trial']))
+    plans = plan_regeneration(resolved, output_dir, extra_args, controller, controller_dir)
+    if dry_run:
+        return {}, unresolved
+
+    results = run_shards(plans, workers, base_port, gpus, python)
+    merged = {plan['output_dir']: merge_shards(plan, args_files=False) for plan in plans}
+    num_trials, seconds = sum(r['trials'] for r in results), sum(r['seconds'] for r in results)
+    print('Regenerated {} of {} stimuli ({:.1f} trials/hour per worker), {} not found'.format(
+        num_trials, len(resolved), trials_per_hour(num_trials, seconds), len(unresolved)))
+    return merged, unresolved
+
+
+def read_stims_file(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() != '' and not line.startswith('#')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Regenerate stimuli by name. Unknown arguments are passed to the controllers.')
+    parser.add_argument('--stims', type=str, nargs='*', default=[], help='stimulus names, e.g. pilot_dominoes_4mid_boxroom_0003')
+    parser.add_argument('--stims_file', type=str, default=None, help='file with one stimulus name per line')
+    parser.add_argument('--output_dir', type=str, default=os.path.join(os.path.expanduser('~'), 'physion_data', 'regenerated'))
+    parser.add_argument('--configs_dir', type=str, default='../configs')
+    parser.add_argument('--workers', type=int, default=4, help='number of controller processes at a time')
+    parser.add_argument('--controller', type=str, default=None, help='controller script for all stimuli (default: by scenario)')
+    parser.add_argument('--controller_dir', type=str, default='../controllers')
+    parser.add_argument('--base_port', type=int, default=1071, help='worker n uses port base_port + n')
+    parser.add_argument('--gpus', type=str, default=None, help='comma-separated gpus that are given to the workers in turn')
+    parser.add_argument('--list', action='store_true', help='only show the config, seed and trial of the stimuli')
+    args, extra_args = parser.parse_known_args()
+
+    names = args.stims + (read_stims_file(args.stims_file) if args.stims_file is not None else [])
+    merged, unresolved = regenerate_stims(names, args.output_dir, args.configs_dir, args.workers, extra_args,
+                                          args.controller, args.controller_dir, args.base_port,
+                                          args.gpus.split(',') if args.gpus else None, dry_run=args.list)
+    sys.exit(0 if len(unresolved) == 0 and all(m is not None for m in merged.values()) else 1)
@@ -0,0 +1,244 @@
+import os
+import sys
+import json
+import time
+import argparse
+import importlib.util
+from glob import glob
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import h5py
+
+from generate_parallel import LabelEncoder, get_trial_stats, write_json
+
+'''
+Recomputes the labels (metadata.json and trial_stats.json) of directories of finished HDF5s with the label functions
+of a controller (get_controller_label_funcs), e.g. after fixing a label function, without generating the trials again:
+
+python relabel_dataset.py --dirs ~/physion_data/dominoes/train/* --controller ../controllers/dominoes.py
+
+The files are labeled by a pool of processes. Each file is opened once for all label functions, and every dataset
+they read is read from the file only once and shared between them (e.g. the per-frame labels that several functions
+go through), except for datasets larger than MAX_SHARED_BYTES like the images, which are read when they are used.
+metadata.json holds what the label functions return, in the same format as the one the controllers write.
+trial_stats.json is the average of the labels over the trials (see generate_parallel.get_trial_stats), taken before
+they are rounded for metadata.json, as the controllers do.
+
+The controller class is the controller_name in the metadata.json that is already in a directory, unless
+--controller_class is given. Use --dry_run to only show which labels change.
+'''
+
+MAX_SHARED_BYTES = 16 * 1024 ** 2
+
+
+class SharedReadGroup(object):
+    '''
+    Read-only view of an h5py file or group for the label functions: datasets are read once (as numpy arrays) and
+    then shared, groups and their keys are looked up once. Datasets larger than max_shared_bytes are returned as
+    h5py datasets. Everything else (attrs, name, ...) is taken from the h5py object. Objects are opened with the
+    low-level h5py API, which is much faster than h5py.Group.__getitem__ for files with many small datasets.
+    '''
+    def __init__(self, group, max_shared_bytes=MAX_SHARED_BYTES):
+        self._id = group.id if isinstance(group, h5py.Group) else group
+        self._max_shared_bytes = max_shared_bytes
+        self._group = None
+        self._items = {}
+        self._keys = None
+
+    def __getitem__(self, name):
+        if isinstance(name, str) and '/' in name.strip('/'):
+            item = self
+            for part in name.strip('/').split('/'):
+                item = item[part]
+            return item
+        if name not in self._items:
+            if not isinstance(name, str) or name.encode() not in self._id:
+                # e.g. h5py references, or a KeyError like the one h5py raises
+                return self._get_group()[name]
+            object_id = h5py.h5o.open(self._id, name.encode())
+            if isinstance(object_id, h5py.h5g.GroupID):
+                item = SharedReadGroup(object_id, self._max_shared_bytes)
+            elif isinstance(object_id, h5py.h5d.DatasetID):
+                item = self._read(object_id)
+            else:
+                item = self._get_group()[name]
+            self._items[name] = item
+        return self._items[name]
+
+    def _read(self, dataset_id):
+        shape = dataset_id.shape
+        if shape is None or int(np.prod(shape)) * dataset_id.dtype.itemsize > self._max_shared_bytes:
+            return h5py.Dataset(dataset_id)
+        value = np.empty(dataset_id.shape, dtype=dataset_id.dtype)
+        if value.size > 0:
+            dataset_id.read(h5py.h5s.ALL, h5py.h5s.ALL, value)
+        return value
+
+    def _get_group(self):
+        if self._group is None:
+            self._group = h5py.Group(self._id)
+        return self._group
+
+    def keys(self):
+        if self._keys is None:
+            self._keys = list(self._get_group().keys())
+        return self._keys
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, name):
+        return name in self._items or name in self._get_group()
+
+    def __getattr__(self, attr):
+        return getattr(self._get_group(), attr)
+
+
+def load_controller_class(controller_path, class_name):
+    '''
+    import the controller script (without running it) and return the controller class
+    '''
+    controller_path = os.path.abspath(controller_path)
+    sys.path.insert(0, os.path.dirname(controller_path))
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(controller_path))[0], controller_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return getattr(module, class_name)
+
+
+def get_label_funcs(controller_path, class_name):
+    # the label functions that the controller uses for its metadata.json (see Dataset.run in tdw_physics)
+    return load_controller_class(controller_path, class_name).get_controller_label_funcs(class_name)
+
+
+def compute_labels(path, label_funcs, share_reads=True):
+    '''
+    output: OrderedDict of label function name -> label of the HDF5 at path, as tdw_physics get_labels_from
+    '''
+    labels = OrderedDict()
+    with h5py.File(path, 'r') as f:
+        f = SharedReadGroup(f) if share_reads else f
+        for func in label_funcs:
+            labels[func.__name__] = func(f)
+    return labels
+
+
+# label functions of the worker processes; they are closures, so every process makes its own
+_label_funcs = None
+
+
+def _init_worker(controller_path, class_name):
+    global _label_funcs
+    _label_funcs = get_label_funcs(controller_path, class_name)
+
+
+def _compute_labels(args):
+    path, share_reads = args
+    return compute_labels(path, _label_funcs, share_reads)
+
+
+def label_files(paths, controller_path, class_name, workers=None, share_reads=True):
+    '''
+    output: list of the labels of the HDF5s at paths (see compute_labels), computed by a pool of processes
+    '''
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(controller_path, class_name)) as executor:
+        return list(executor.map(_compute_labels, [(p, share_reads) for p in paths], chunksize=8))
+
+
+def get_controller_name(hdf5_dir):
+    # controller class that made the labels in the directory
+    meta_path = os.path.join(hdf5_dir, 'metadata.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            metadata = json.load(f)
+        if len(metadata) > 0 and 'controller_name' in metadata[0]:
+            return metadata[0]['controller_name']
+    return None
+
+
+def compare_metadata(old, new):
+    '''
+    output: dict of label -> number of trials where it changed (trials are matched by stimulus name)
+    '''
+    old = {m.get('stimulus_name'): m for m in old}
+    changed = OrderedDict()
+    for m in new:
+        before = old.get(m.get('stimulus_name'), {})
+        for key, value in m.items():
+            if json.dumps(before.get(key)) != json.dumps(value):
+                changed[key] = changed.get(key, 0) + 1
+    return changed
+
+
+def relabel_dirs(hdf5_dirs, controller_path, class_name=None, workers=None, share_reads=True, dry_run=False):
+    '''
+    recompute metadata.json and trial_stats.json of every directory of HDF5s (files 0000.hdf5, 0001.hdf5, ...)
+    output: dict of directory -> recomputed metadata
+    '''
+    jobs = {}
+    for hdf5_dir in hdf5_dirs:
+        name = class_name if class_name is not None else get_controller_name(hdf5_dir)
+        if name is None:
+            print('Skipping {}: no metadata.json to take the controller from, pass --controller_class'.format(hdf5_dir))
+            continue
+        jobs.setdefault(name, []).append(hdf5_dir)
+
+    results = {}
+    for name, dirs in jobs.items():
+        paths = {d: sorted(glob(os.path.join(d, '*.hdf5'))) for d in dirs}
+        all_paths = [p for d in dirs for p in paths[d]]
+        start = time.time()
+        labels = label_files(all_paths, controller_path, name, workers, share_reads)
+        seconds = time.time() - start
+        print('Labeled {} files with {} in {:.1f}s ({:.1f} files/s)'.format(
+            len(all_paths), name, seconds, len(all_paths) / max(seconds, 1e-9)))
+
+        labels = dict(zip(all_paths, labels))
+        for d in dirs:
+            trial_labels = [labels[p] for p in paths[d]]
+            # the labels as they are written to metadata.json
+            metadata = json.loads(json.dumps(trial_labels, cls=LabelEncoder))
+            meta_path = os.path.join(d, 'metadata.json')
+            if os.path.exists(meta_path):
+                with open(meta_path) as f:
+                    changed = compare_metadata(json.load(f), metadata)
+                print('{}: {}'.format(d, ', '.join('{} changed in {} trials'.format(k, v) for k, v in changed.items())
+                                      if len(changed) > 0 else 'no labels changed'))
+            if not dry_run and len(metadata) > 0:
+                write_json(metadata, meta_path)
+                write_json(get_trial_stats(trial_labels), os.path.join(d, 'trial_stats.json'))
+            results[d] = metadata
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dirs', type=str, nargs='+', required=True, help='directories of HDF5s to relabel')
+    parser.add_argument('--controller', type=str, required=True, help='controller script with the label functions')
+    parser.add_argument('--controller_class', type=str, default=None,
+                        help='controller class (default: controller_name in the metadata.json of each directory)')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: number of cpus)')
+    parser.add_argument('--no_shared_reads', action='store_true',
+                        help='give the label functions the h5py file itself, e.g. if one of them needs h5py objects')
+    parser.add_argument('--dry_run', action='store_true', help='only show which labels change')
+    args = parser.parse_args()
+
+    relabel_dirs([d for d in args.dirs if os.path.isdir(d)], args.controller, args.controller_class, args.workers,
+                 not args.no_shared_reads, args.dry_run)
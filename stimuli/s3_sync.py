@@ -0,0 +1,182 @@
+import os
+import math
+import time
+import hashlib
+import mimetypes
+import threading
+from glob import glob
+import boto3
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+
+'''
+Helpers to sync local files to an S3 bucket (used by upload_stims_to_s3.py and analysis/upload_results.py):
+the bucket is listed once, local files are compared to it by size and MD5 (ETag), and only new or changed files are
+uploaded, by a pool of threads that share one client. ACL and content type are set in the upload itself.
+
+e.g.
+client = get_client(workers=16)
+local_files = collect_local_files('stimuli', ext='mp4')
+plan = plan_sync(local_files, list_remote(client, 'my-bucket'))
+print_plan(plan)
+stats = run_sync(client, 'my-bucket', plan, acl='public-read', workers=16)
+'''
+
+MB = 1024 ** 2
+# multipart settings of the uploads, also used to recompute the ETags of multipart uploads
+MULTIPART_THRESHOLD = 8 * MB
+MULTIPART_CHUNKSIZE = 8 * MB
+
+
+def get_client(workers=16):
+    # one client is shared by all threads, give it enough connections for all of them and let it retry throttling
+    return boto3.client('s3', config=Config(max_pool_connections=max(10, workers),
+                                            retries={'max_attempts': 5, 'mode': 'standard'}))
+
+
+def collect_local_files(path, ext=None, recursive=True):
+    '''
+    output: dict of key -> local path for the files under path (with extension ext if given). The key is the path
+        relative to path (or just the file name if not recursive)
+    '''
+    pattern = '*.{}'.format(ext) if ext is not None else '*'
+    if recursive:
+        paths = [y for x in os.walk(path) for y in glob(os.path.join(x[0], pattern))]
+    else:
+        paths = glob(os.path.join(path, pattern))
+    paths = [p for p in paths if os.path.isfile(p)]
+    return {os.path.relpath(p, path).replace(os.sep, '/'): p for p in sorted(paths)}
+
+
+def list_remote(client, bucket_name, prefix=''):
+    '''
+    output: dict of key -> (size, ETag without quotes) of the objects in the bucket under prefix
+    '''
+    remote = {}
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            remote[obj['Key']] = (obj['Size'], obj['ETag'].strip('"'))
+    return remote
+
+
+def compute_etag(path, num_parts=None, chunk_size=MULTIPART_CHUNKSIZE):
+    '''
+    ETag that S3 gives the file: the MD5 of the content for single part uploads, and the MD5 of the MD5s of the
+    parts followed by -<number of parts> for multipart uploads
+    '''
+    if not num_parts:
+        h = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(MB), b''):
+                h.update(block)
+        return h.hexdigest()
+    part_md5s = []
+    with open(path, 'rb') as f:
+        for part in iter(lambda: f.read(chunk_size), b''):
+            part_md5s.append(hashlib.md5(part).digest())
+    return '{}-{}'.format(hashlib.md5(b''.join(part_md5s)).hexdigest(), len(part_md5s))
+
+
+def same_content(path, etag):
+    '''
+    whether the local file has the given ETag. For multipart ETags the part size is not known, so both the part
+    size of our uploads and the smallest whole number of MB that gives the same number of parts are tried.
+    '''
+    if '-' not in etag:
+        return compute_etag(path) == etag
+    num_parts = int(etag.split('-')[-1])
+    size = os.path.getsize(path)
+    chunk_sizes = [MULTIPART_CHUNKSIZE, int(math.ceil(size / float(num_parts) / MB)) * MB]
+    return any(compute_etag(path, num_parts, c) == etag for c in chunk_sizes
+               if c > 0 and int(math.ceil(size / float(c))) == num_parts)
+
+
+def plan_sync(local_files, remote, overwrite=False, check_md5=True):
+    '''
+    input:
+        local_files: dict of key -> local path (see collect_local_files)
+        remote: dict of key -> (size, ETag) (see list_remote)
+        overwrite: upload everything
+        check_md5: compare files of the same size by MD5, otherwise files of the same size are taken to be the same
+    output:
+        list of (key, local path, reason) to upload, reason is one of 'new', 'size', 'md5' or 'overwrite',
+        and list of the keys that are up to date
+    '''
+    uploads, up_to_date = [], []
+    for key, path in local_files.items():
+        if overwrite:
+            uploads.append((key, path, 'overwrite'))
+        elif key not in remote:
+            uploads.append((key, path, 'new'))
+        elif os.path.getsize(path) != remote[key][0]:
+            uploads.append((key, path, 'size'))
+        elif check_md5 and not same_content(path, remote[key][1]):
+            uploads.append((key, path, 'md5'))
+        else:
+            up_to_date.append(key)
+    return uploads, up_to_date
+
+
+def print_plan(plan):
+    uploads, up_to_date = plan
+    for key, path, reason in uploads:
+        print('upload {} -> {} ({})'.format(path, key, reason))
+    print('{} files to upload ({:.1f} MB), {} up to date'.format(
+        len(uploads), sum(os.path.getsize(p) for _, p, _ in uploads) / 1e6, len(up_to_date)))
+
+
+def run_sync(client, bucket_name, plan, acl=None, metadata=None, workers=16, content_type=True):
+    '''
+    upload the files of a plan (see plan_sync)
+    input:
+        acl: canned ACL of the uploaded objects, e.g. public-read
+        metadata: dict of user metadata of the uploaded objects
+        content_type: set the content type of the objects from their extension
+    output:
+        dict with the number of uploaded files, the keys that failed, bytes uploaded and seconds taken
+    '''
+    uploads, _ = plan
+    transfer_config = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, multipart_chunksize=MULTIPART_CHUNKSIZE,
+                                     use_threads=False)
+    total = sum(os.path.getsize(p) for _, p, _ in uploads)
+    progress = tqdm(total=total, unit='B', unit_scale=True, unit_divisor=1024)
+    lock = threading.Lock()
+
+    def update(num_bytes):
+        with lock:
+            progress.update(num_bytes)
+
+    def upload(key, path):
+        extra_args = {}
+        if acl is not None:
+            extra_args['ACL'] = acl
+        if metadata is not None:
+            extra_args['Metadata'] = metadata
+        guessed_type = mimetypes.guess_type(path)[0]
+        if content_type and guessed_type is not None:
+            extra_args['ContentType'] = guessed_type
+        client.upload_file(path, bucket_name, key, ExtraArgs=extra_args, Config=transfer_config, Callback=update)
+        return os.path.getsize(path)
+
+    start = time.time()
+    uploaded, failed, num_bytes = 0, [], 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(upload, key, path): key for key, path, _ in uploads}
+        for future in as_completed(futures):
+            try:
+                num_bytes += future.result()
+                uploaded += 1
+            except Exception as e:
+                tqdm.write('Failed to upload {}: {}'.format(futures[future], e))
+                failed.append(futures[future])
+    progress.close()
+    return {'uploaded': uploaded, 'failed': failed, 'bytes': num_bytes, 'seconds': time.time() - start}
+
+
+def print_stats(stats):
+    print('Uploaded {} files ({:.1f} MB) in {:.1f}s ({:.1f} MB/s, {:.1f} files/s), {} failed'.format(
+        stats['uploaded'], stats['bytes'] / 1e6, stats['seconds'], stats['bytes'] / 1e6 / max(stats['seconds'], 1e-9),
+        stats['uploaded'] / max(stats['seconds'], 1e-9), len(stats['failed'])))
@@ -1,13 +1,23 @@
 import boto3
 import logging
 from pathlib import Path
-from botocore.exceptions import ClientError
+from botocore.config import Config
+from botocore.exceptions import ClientError, EndpointConnectionError, ConnectionClosedError, ReadTimeoutError
 from boto3.s3.transfer import TransferConfig
 from hurry.filesize import size, si
 import errno
 import sys, os
 import threading
 import ntpath
+import math
+import json
+import time
+import argparse
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+
+from s3_sync import list_remote
 
 # to log progress
 log = logging.getLogger('s3_uploader')
@@ -17,9 +27,17 @@ stream_handler = logging.StreamHandler(sys.stdout)
 stream_handler.setFormatter(format)
 log.addHandler(stream_handler)
 
-MP_THRESHOLD = 1
+MB = 1024 ** 2
+GB = 1024 ** 3
+MP_THRESHOLD = 1  # GB
 MP_CONCURRENCY = 10
 MAX_RETRY_COUNT = 3
+# multipart part sizes: S3 needs parts of at least 5 MB and allows at most 10000 parts
+MIN_CHUNKSIZE = 8 * MB
+MAX_PARTS = 1000
+JOURNAL_SAVE_INTERVAL = 5  # seconds
+# files of at least this size are uploaded in parts when uploading a directory/pattern
+MULTIFILE_MP_THRESHOLD = 64 * MB
 
 s3_client = None
 
@@ -39,15 +57,35 @@ class ProgressPercentage(object):
             sys.stdout.flush()
 
 
+login_lock = threading.Lock()
+
+
 def login():
     global s3_client
-    s3_client = boto3.client('s3')
+    with login_lock:
+        s3_client = boto3.client('s3', config=Config(max_pool_connections=64))
+
+
+def is_expired_token(e):
+    if isinstance(e, ClientError):
+        return e.response['Error']['Code'] == 'ExpiredToken'
+    return 'ExpiredToken' in str(e)
+
+
+def choose_chunksize(file_size, max_parts=MAX_PARTS):
+    '''
+    part size for a multipart upload of file_size bytes: at least MIN_CHUNKSIZE and large enough to need at most
+    max_parts parts (rounded up to whole MB), so big files are not split into thousands of tiny parts
+    '''
+    chunk = max(MIN_CHUNKSIZE, int(math.ceil(file_size / float(max_parts))))
+    return int(math.ceil(chunk / float(MB))) * MB
 
-def upload_file_multipart(file, bucket, object_path, metadata=None):
+
+def upload_file_multipart(file, bucket, object_path, metadata=None, callback=None):
     log.info("Uploading [" + file + "] to [" + bucket + "] bucket ...")
     log.info("S3 path: [ s3://" + bucket + "/" + object_path + " ]")
 
-    if not Path(file).is_file:
+    if not Path(file).is_file():
         log.error("File [" + file + "] does not exist!")
         raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), file)
 
@@ -55,73 +93,284 @@ def upload_file_multipart(file, bucket, object_path, metadata=None):
         log.error("object_path is null!")
         raise ValueError("S3 object must be set!")
 
-    GB = 1024 ** 3
-    mp_threshold = MP_THRESHOLD * GB
-    concurrency = MP_CONCURRENCY
-    transfer_config = TransferConfig(multipart_threshold=mp_threshold,
+    file_size = Path(file).stat().st_size
+    transfer_config = TransferConfig(multipart_threshold=MP_THRESHOLD * GB,
+                                     multipart_chunksize=choose_chunksize(file_size),
                                      use_threads=True,
-                                     max_concurrency=concurrency)
-
-    login_attempt = False
-    retry = MAX_RETRY_COUNT
+                                     max_concurrency=MP_CONCURRENCY)
+    if callback is None:
+        callback = ProgressPercentage(file)
 
-    while retry > 0:
+    for attempt in range(MAX_RETRY_COUNT):
         try:
             s3_client.upload_file(file, bucket, object_path, Config=transfer_config,
-                                  ExtraArgs=metadata, Callback=ProgressPercentage(file))
+                                  ExtraArgs=metadata, Callback=callback)
             sys.stdout.write('\n')
             log.info("File [" + file + "] uploaded successfully")
             log.info("Object name: [" + object_path + "]")
-            retry = 0
-
-        except ClientError as e:
+            return
+        except (ClientError, boto3.exceptions.S3UploadFailedError) as e:
             log.error("Failed to upload object!")
             log.exception(e)
-            if e.response['Error']['Code'] == 'ExpiredToken':
-                log.warning('Login token expired')
-                retry = 1
-                log.debug("retry = " + str(retry))
-                login_attempt = True
-                login()
-            else:
-                log.error("Unhandled error code:")
-                log.debug(e.response['Error']['Code'])
+            if not is_expired_token(e):
+                log.error("Unhandled error!")
                 raise
+            log.warning('Login token expired')
+            login()
 
-        except boto3.exceptions.S3UploadFailedError as e:
-            log.error("Failed to upload object!")
-            log.exception(e)
-            if 'ExpiredToken' in str(e):
+    raise Exception("Tried to login " + str(MAX_RETRY_COUNT) + " times but failed to upload!")
+
+
+class AggregateProgress(object):
+    '''
+    progress (bytes, files, MB/s) over all files of a multi-file upload
+    '''
+    def __init__(self, total_bytes, total_files):
+        self._bar = tqdm(total=total_bytes, unit='B', unit_scale=True, unit_divisor=1024)
+        self._total_files = total_files
+        self._files_done = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, bytes_amount):
+        with self._lock:
+            self._bar.update(bytes_amount)
+
+    def file_done(self):
+        with self._lock:
+            self._files_done += 1
+            self._bar.set_postfix_str('{}/{} files'.format(self._files_done, self._total_files))
+
+    def close(self):
+        self._bar.close()
+
+
+class UploadJournal(object):
+    '''
+    json file with the multipart uploads that are in progress: for each object, the upload id, the file it is
+    uploaded from (with its size and mtime, to notice changes), the part size and the ETags of the finished parts.
+    An interrupted upload continues from the parts that are in the journal.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+        self._last_save = 0
+
+    def save(self, force=False):
+        # saving after every part would rewrite the journal thousands of times, so save at most every few seconds
+        if not force and time.time() - self._last_save < JOURNAL_SAVE_INTERVAL:
+            return
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+        self._last_save = time.time()
+
+
+def call_with_retries(func, *args, **kwargs):
+    '''
+    call func(s3_client, ...) at most MAX_RETRY_COUNT times, logging in again if the token expired and backing off
+    on other errors
+    '''
+    for attempt in range(MAX_RETRY_COUNT):
+        try:
+            return func(s3_client, *args, **kwargs)
+        except (ClientError, EndpointConnectionError, ConnectionClosedError, ReadTimeoutError) as e:
+            if attempt == MAX_RETRY_COUNT - 1:
+                raise
+            if is_expired_token(e):
                 log.warning('Login token expired')
-                log.info("Handling...")
-                retry -= 1
-                log.debug("retry = " + str(retry))
-                login_attempt = True
                 login()
-            else:
-                log.error("Unknown error!")
+            elif isinstance(e, ClientError) and e.response['Error']['Code'] in ['NoSuchUpload', 'NoSuchBucket', 'AccessDenied']:
                 raise
+            else:
+                time.sleep(2 ** attempt)
 
-        except Exception as e:
-            log.error("Unknown exception occurred!")
-            template = "An exception of type {0} occurred. Arguments:\n{1!r}"
-            message = template.format(type(e).__name__, e.args)
-            log.debug(message)
-            log.exception(e)
-            raise
 
-    if login_attempt:
-        raise Exception("Tried to login " + str(MAX_RETRY_COUNT) + " times but failed to upload!")
+def upload_part(client, bucket, key, upload_id, file, part_number, offset, length):
+    with open(file, 'rb') as f:
+        f.seek(offset)
+        body = f.read(length)
+    response = client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=body)
+    return response['ETag']
+
+
+def put_object(client, bucket, key, file, extra_args):
+    with open(file, 'rb') as f:
+        client.put_object(Bucket=bucket, Key=key, Body=f, **extra_args)
+
+
+def start_multipart(journal, file, bucket, key, extra_args):
+    '''
+    output: (upload id, part size, dict of the part numbers that are already uploaded -> ETag), resuming the
+        journaled upload of key if it is of the same (unchanged) file and still known to S3
+    '''
+    st = os.stat(file)
+    entry = journal.entries.get(key)
+    if entry is not None:
+        if entry['file'] == os.path.abspath(file) and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+            try:
+                listed = call_with_retries(lambda c: c.list_parts(Bucket=bucket, Key=key, UploadId=entry['upload_id']))
+                done = {str(p['PartNumber']): p['ETag'] for p in listed.get('Parts', [])}
+                parts = {n: etag for n, etag in entry['parts'].items() if done.get(n) == etag}
+                log.info("Resuming upload of [" + file + "]: " + str(len(parts)) + " parts already uploaded")
+                entry['parts'] = parts
+                return entry
+            except ClientError:
+                pass
+        else:
+            # the file changed since the upload started, start over
+            try:
+                call_with_retries(lambda c: c.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=entry['upload_id']))
+            except ClientError:
+                pass
+    response = call_with_retries(lambda c: c.create_multipart_upload(Bucket=bucket, Key=key, **extra_args))
+    entry = {'upload_id': response['UploadId'], 'bucket': bucket, 'file': os.path.abspath(file),
+             'size': st.st_size, 'mtime': st.st_mtime, 'chunksize': choose_chunksize(st.st_size), 'parts': {}}
+    journal.entries[key] = entry
+    journal.save(force=True)
+    return entry
+
+
+def upload_many(files, bucket, workers=16, journal_path='.upload_journal.json', metadata=None, skip_existing=True):
+    '''
+    upload many files through one pool of workers: small files are put in one request, large files are split
+    into parts, and the parts of all files share the pool.
+
+    input:
+        files: dict of object path -> local file
+        workers: number of requests in flight
+        journal_path: journal of the multipart uploads (see UploadJournal), delete it to start over
+        metadata: ExtraArgs of the uploads, e.g. {'ACL': 'public-read'}
+        skip_existing: skip files that are already in the bucket with the same size
+    output:
+        list of the object paths that failed
+    '''
+    extra_args = metadata or {}
+    journal = UploadJournal(journal_path)
+    sizes = {key: Path(file).stat().st_size for key, file in files.items()}
+    if skip_existing and len(files) > 0:
+        # one listing of the bucket instead of a request per file
+        remote = list_remote(s3_client, bucket, os.path.commonprefix(list(files)))
+        existing = {key for key in files if key not in journal.entries and remote.get(key, (None,))[0] == sizes[key]}
+        if len(existing) > 0:
+            log.info("Skipping " + str(len(existing)) + " files that are already in the bucket")
+        files = {key: file for key, file in files.items() if key not in existing}
+        sizes = {key: sizes[key] for key in files}
+    progress = AggregateProgress(sum(sizes.values()), len(files))
+    start = time.time()
+    failed = []
+    pending = {}  # object path -> number of parts still to upload
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for key, file in files.items():
+                if sizes[key] < MULTIFILE_MP_THRESHOLD:
+                    futures[executor.submit(call_with_retries, put_object, bucket, key, file, extra_args)] = (key, None, sizes[key])
+                    continue
+                try:
+                    entry = start_multipart(journal, file, bucket, key, extra_args)
+                except ClientError as e:
+                    log.error("Could not start the upload of [" + file + "]: " + str(e))
+                    failed.append(key)
+                    continue
+                chunk = entry['chunksize']
+                num_parts = int(math.ceil(sizes[key] / float(chunk)))
+                todo = [n for n in range(1, num_parts + 1) if str(n) not in entry['parts']]
+                progress(sizes[key] - sum(min(chunk, sizes[key] - (n - 1) * chunk) for n in todo))
+                pending[key] = len(todo)
+                for n in todo:
+                    length = min(chunk, sizes[key] - (n - 1) * chunk)
+                    future = executor.submit(call_with_retries, upload_part, bucket, key, entry['upload_id'],
+                                             file, n, (n - 1) * chunk, length)
+                    futures[future] = (key, n, length)
+                if len(todo) == 0:
+                    futures[executor.submit(lambda: None)] = (key, 0, 0)
+
+            for future in as_completed(futures):
+                key, part_number, length = futures[future]
+                try:
+                    etag = future.result()
+                except Exception as e:
+                    if key not in failed:
+                        log.error("Failed to upload [" + files[key] + "]: " + str(e))
+                        failed.append(key)
+                    continue
+                progress(length)
+                if part_number is None:
+                    progress.file_done()
+                    continue
+                entry = journal.entries[key]
+                if part_number > 0:
+                    # keep the part even if another part of the file failed, so that a rerun can resume
+                    entry['parts'][str(part_number)] = etag
+                    pending[key] -= 1
+                    journal.save()
+                if pending[key] == 0 and key not in failed:
+                    parts = [{'PartNumber': int(n), 'ETag': e} for n, e in sorted(entry['parts'].items(), key=lambda x: int(x[0]))]
+                    try:
+                        call_with_retries(lambda c: c.complete_multipart_upload(
+                            Bucket=bucket, Key=key, UploadId=entry['upload_id'], MultipartUpload={'Parts': parts}))
+                        del journal.entries[key]
+                        journal.save(force=True)
+                        progress.file_done()
+                    except ClientError as e:
+                        log.error("Failed to complete the upload of [" + files[key] + "]: " + str(e))
+                        failed.append(key)
+    finally:
+        journal.save(force=True)
+        progress.close()
+
+    seconds = time.time() - start
+    total = sum(sizes[k] for k in files if k not in failed)
+    log.info("Uploaded {} of {} files ({:.1f} MB) in {:.0f}s ({:.1f} MB/s)".format(
+        len(files) - len(failed), len(files), total / 1e6, seconds, total / 1e6 / max(seconds, 1e-9)))
+    if len(journal.entries) == 0 and os.path.exists(journal_path):
+        os.remove(journal_path)
+    return failed
+
+
+def collect_files(source, prefix=''):
+    '''
+    files to upload for a directory (all files below it) or a glob pattern, as a dict of object path -> file.
+    Object paths are prefix + the path relative to the directory (or the file name for glob patterns)
+    '''
+    if os.path.isdir(source):
+        paths = [os.path.join(root, name) for root, _, names in os.walk(source) for name in names]
+        keys = [os.path.relpath(p, source).replace(os.sep, '/') for p in paths]
+    else:
+        paths = [p for p in glob(source, recursive=True) if os.path.isfile(p)]
+        keys = [os.path.basename(p) for p in paths]
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    return {prefix + k: p for k, p in sorted(zip(keys, paths))}
+
 
 def main(args):
+    parser = argparse.ArgumentParser(description='Upload a file, a directory or a glob pattern of files to S3')
+    parser.add_argument('source', help='file, directory or glob pattern (quote it) to upload')
+    parser.add_argument('bucket')
+    parser.add_argument('object_path', nargs='?', default=None,
+                        help='object path of a single file, or prefix of the object paths of a directory/pattern')
+    parser.add_argument('--workers', type=int, default=16, help='number of requests in flight (directory/pattern)')
+    parser.add_argument('--journal', default='.upload_journal.json', help='journal of interrupted multipart uploads')
+    parser.add_argument('--overwrite', action='store_true', help='also upload files that are already in the bucket')
+    args = parser.parse_args(args)
+
     login()
-    filename = args[0]
-    bucket = args[1]
-    if len(args) > 2:
-        object_path = args[2]
+    if os.path.isfile(args.source):
+        object_path = args.object_path if args.object_path is not None else args.source.split('/')[-1]
+        upload_file_multipart(args.source, args.bucket, object_path, metadata=None)
     else:
-        object_path = filename.split('/')[-1]
-    upload_file_multipart(filename, bucket, object_path, metadata=None)
+        files = collect_files(args.source, args.object_path or '')
+        log.info("Uploading " + str(len(files)) + " files to [" + args.bucket + "] bucket ...")
+        failed = upload_many(files, args.bucket, workers=args.workers, journal_path=args.journal,
+                             skip_existing=not args.overwrite)
+        if len(failed) > 0:
+            log.error("Failed to upload " + str(len(failed)) + " files, run again to retry them")
+            sys.exit(1)
     log.info("Upload finished!")
 
 if __name__ == '__main__':
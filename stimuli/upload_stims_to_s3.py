@@ -3,76 +3,61 @@
 
 """NOTE: while this file might be useful to script uploading to S3, use `upload_stims_to_s3.ipynb` for the recent code instead."""
 
-import os
-from glob import glob
-import boto3
 import botocore
-from IPython.display import clear_output
-import json
-import pandas as pd
-from PIL import Image
 import argparse
 
-def list_files(path, ext='png'):
-    result = [y for x in os.walk(path) for y in glob(os.path.join(x[0], '*.%s' % ext))]
-    return result
+from s3_sync import get_client, collect_local_files, list_remote, plan_sync, print_plan, run_sync, print_stats
 
-
-## helper to speed things up by not uploading images if they already exist, can be overriden 
-def check_exists(s3, bucket_name, stim_name):
-    try:
-        s3.Object(bucket_name,stim_name).load()    
-        return True
-    except botocore.exceptions.ClientError as e:    
-        if (e.response['Error']['Code'] == "404"):
-            print('The object does not exist.')
-            return False
-        else:
-            print('Something else has gone wrong with {}'.format(stim_name))
+def str2bool(v):
+    return v.lower() in ("yes", "true", "t", "1", "True", "TRUE")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--bucket_name', type=str, default='human-physics-benchmarking')
     parser.add_argument('--path_to_stim', type=str, default='stimuli')
-    parser.add_argument('--overwrite', type=bool, default=False)
+    parser.add_argument('--overwrite', type=str2bool, default='False')
+    parser.add_argument('--dry_run', type=str2bool, default='False', help='only print what would be uploaded')
+    parser.add_argument('--workers', type=int, default=16, help='number of files to upload at the same time')
     args = parser.parse_args()
     
     ## set up paths, etc.
     bucket_name = args.bucket_name
     path_to_stim = args.path_to_stim
-    full_stim_paths = [os.path.abspath(os.path.join(path_to_stim,i)) for i in os.listdir(path_to_stim)]
-    print('We have {} images to upload.'.format(len(full_stim_paths)))
+    ## stimuli are uploaded under their file name
+    local_files = collect_local_files(path_to_stim, recursive=False)
+    print('We have {} images to upload.'.format(len(local_files)))
 
     ## tell user some useful information
     print('Path to stimuli is : {}'.format(path_to_stim))
     print('Uploading to this bucket: {}'.format(bucket_name))
 
     ## establish connection to s3 
-    s3 = boto3.resource('s3')
+    client = get_client(args.workers)
 
-    ## create a bucket with the appropriate bucket name
-    try: 
-        b = s3.create_bucket(Bucket=bucket_name) 
-        print('Created new bucket.')
-    except:
-        b = s3.Bucket(bucket_name)
-        print('Bucket already exists or credentials missing')
+    if not args.dry_run:
+        ## create a bucket with the appropriate bucket name
+        try:
+            client.create_bucket(Bucket=bucket_name)
+            print('Created new bucket.')
+        except botocore.exceptions.ClientError:
+            print('Bucket already exists or credentials missing')
 
-    ## do we want to overwrite files on s3?
-    overwrite = args.overwrite
+        ## set bucket and objects to public
+        client.put_bucket_acl(Bucket=bucket_name, ACL='public-read') ## sets bucket to public
 
-    ## set bucket and objects to public
-    b.Acl().put(ACL='public-read') ## sets bucket to public
-
-    ## now let's loop through stim paths and actually upload to s3 (woot!)
-    for i,path_to_file in enumerate(full_stim_paths):        # use sorted(full_stim_paths) when not using photodraw32
-        stim_name = os.path.split(path_to_file)[-1]
-        if ((check_exists(s3, bucket_name, stim_name)==False) | (overwrite==True)):
-            print('Now uploading {} as {} | {} of {}'.format(os.path.split(path_to_file)[-1],stim_name,(i+1),len(full_stim_paths)))
-            s3.Object(bucket_name,stim_name).put(Body=open(path_to_file,'rb')) ## upload stimuli
-            s3.Object(bucket_name,stim_name).Acl().put(ACL='public-read') ## set access controls
-        else: 
-            print('Skipping {} | {} of {} because it already exists.'.format(os.path.split(path_to_file)[-1],(i+1),len(full_stim_paths)))
-        clear_output(wait=True)
+    ## compare with what is in the bucket (listed once), overwrite files on s3 if asked to
+    try:
+        remote = list_remote(client, bucket_name)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchBucket':
+            raise
+        remote = {}
+    plan = plan_sync(local_files, remote, overwrite=args.overwrite)
+    print_plan(plan)
+
+    ## now let's upload the new and changed stimuli, setting access controls in the same request (woot!)
+    if not args.dry_run:
+        stats = run_sync(client, bucket_name, plan, acl='public-read', workers=args.workers)
+        print_stats(stats)
 
     print('Done!')